@@ -0,0 +1,177 @@
+"""
+Where BatchScorer reads images from. An image source has a fetch(image_id) method that returns
+the bytes of one image as an io.BytesIO; it is called from several download threads at once.
+
+HttpImageSource is what score.py uses on AML, for both blob containers (through the container's
+SAS URL) and public URLs. LocalImageSource reads a local folder instead of a blob container, so that
+the scorer can be run and tested offline; a folder served over HTTP can stand in for a blob container
+or for public URLs with HttpImageSource.
+"""
+
+import io
+import os
+import random
+import threading
+import time
+from urllib import parse
+
+# HTTP status codes worth retrying; anything else (e.g. 403, 404) fails the image right away
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class LocalImageSource:
+    """
+    Reads images from a local folder; image_ids are paths relative to it. Stands in for a blob
+    container when running the scorer offline.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def fetch(self, image_id):
+        with open(os.path.join(self.root_dir, image_id), 'rb') as f:
+            return io.BytesIO(f.read())
+
+
+class FetchStats:
+    """
+    Counts of the requests made by an image source, for reporting a shard's download throughput.
+    Updated from the download threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n_images = 0  # images downloaded successfully
+        self.n_failed = 0  # images that could not be downloaded, after retries
+        self.n_retries = 0
+        self.n_bytes = 0
+        self.request_seconds = 0.0  # summed over threads, including the retries, not the backoffs
+        self.start_time = None
+        self.end_time = None
+
+    def record(self, n_bytes=0, request_seconds=0.0, failed=False, retried=False):
+        with self.lock:
+            now = time.time()
+            if self.start_time is None:
+                self.start_time = now - request_seconds
+            self.end_time = now
+            self.request_seconds += request_seconds
+            if retried:
+                self.n_retries += 1
+            elif failed:
+                self.n_failed += 1
+            else:
+                self.n_images += 1
+                self.n_bytes += n_bytes
+
+    def summary(self):
+        """
+        Returns the counts and the throughput over the wall time between the first and the last
+        request, as a dict.
+        """
+        with self.lock:
+            wall_seconds = 0.0 if self.start_time is None else self.end_time - self.start_time
+            n_requests = self.n_images + self.n_failed + self.n_retries
+            return {
+                'n_images': self.n_images,
+                'n_failed': self.n_failed,
+                'n_retries': self.n_retries,
+                'megabytes': self.n_bytes / 1e6,
+                'wall_seconds': wall_seconds,
+                'images_per_second': self.n_images / wall_seconds if wall_seconds > 0 else 0.0,
+                'megabytes_per_second': self.n_bytes / 1e6 / wall_seconds if wall_seconds > 0 else 0.0,
+                'mean_request_seconds': self.request_seconds / n_requests if n_requests > 0 else 0.0
+            }
+
+
+class HttpImageSource:
+    """
+    Reads images over HTTP into memory, reusing connections and retrying transient errors.
+
+    An image's URL is url_prefix + '/' + image_id (quoted) + '?' + query, or the image_id itself if
+    url_prefix is None (public URLs). Each download thread keeps its own requests.Session, so a
+    thread reuses its connection to the server from one image to the next instead of opening one
+    per image.
+
+    Connection errors, timeouts and the status codes in RETRY_STATUS_CODES are retried up to
+    max_retries times, waiting about retry_backoff_seconds, then twice that, etc. between attempts.
+    Counts and timings are kept in self.stats.
+    """
+
+    def __init__(self, url_prefix=None, query=None, timeout=60, max_retries=4, retry_backoff_seconds=0.5):
+        # imported here so that the other sources don't need requests
+        import requests
+
+        self.requests = requests
+        self.url_prefix = None if url_prefix is None else url_prefix.rstrip('/')
+        self.query = query
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.stats = FetchStats()
+        self.local = threading.local()
+
+    @staticmethod
+    def from_container_sas(input_container_sas, **kwargs):
+        """
+        Returns a source reading blobs, named by image_id, from the container of a container SAS URL.
+        """
+        url_parts = parse.urlsplit(input_container_sas)
+        url_prefix = parse.urlunsplit((url_parts.scheme, url_parts.netloc, url_parts.path, '', ''))
+        return HttpImageSource(url_prefix, url_parts.query, **kwargs)
+
+    def get_url(self, image_id):
+        if self.url_prefix is None:
+            return image_id
+        url = self.url_prefix + '/' + parse.quote(image_id)
+        if self.query:
+            url += '?' + self.query
+        return url
+
+    def get_session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.requests.Session()
+            self.local.session = session
+        return session
+
+    def fetch(self, image_id):
+        url = self.get_url(image_id)
+        session = self.get_session()
+
+        for i_attempt in range(self.max_retries + 1):
+            request_start = time.time()
+            try:
+                response = session.get(url, timeout=self.timeout)
+                content = response.content
+                error = None
+                if response.status_code != 200:
+                    error = '{} status code {}'.format(image_id, response.status_code)
+                retriable = response.status_code in RETRY_STATUS_CODES
+            except (self.requests.ConnectionError, self.requests.Timeout,
+                    self.requests.exceptions.ChunkedEncodingError) as e:
+                error = '{}: {}'.format(image_id, str(e))
+                retriable = True
+            request_seconds = time.time() - request_start
+
+            if error is None:
+                self.stats.record(n_bytes=len(content), request_seconds=request_seconds)
+                return io.BytesIO(content)
+
+            if not retriable or i_attempt == self.max_retries:
+                self.stats.record(request_seconds=request_seconds, failed=True)
+                raise IOError('Failed to download {} after {} attempt(s): {}'.format(
+                    image_id, i_attempt + 1, error))
+
+            self.stats.record(request_seconds=request_seconds, retried=True)
+            # exponential backoff with jitter, so that the threads don't all retry at once
+            time.sleep(self.retry_backoff_seconds * (2 ** i_attempt) * random.uniform(0.5, 1.5))
+
+
+def get_image_source(input_container_sas=None, use_url=False):
+    """
+    Returns the image source for score.py's arguments.
+    """
+    if use_url:
+        return HttpImageSource()
+    return HttpImageSource.from_container_sas(input_container_sas)
@@ -0,0 +1,131 @@
+"""
+Tests for HttpImageSource against a local HTTP server serving a folder of images.
+"""
+
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from image_sources import HttpImageSource
+
+
+class FolderRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves a folder over HTTP/1.1 (so connections are kept alive), counting connections and
+    answering the first request for each path in server.flaky_paths with a 503.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        with self.server.lock:
+            self.server.queries.append(self.path.partition('?')[2])
+            flaky = path in self.server.flaky_paths
+            self.server.flaky_paths.discard(path)
+        if flaky:
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpImageSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.image_ids = []
+        for i_image in range(30):
+            image_id = 'cam {}/IMG_{:04d}.JPG'.format(i_image % 3, i_image)
+            os.makedirs(os.path.join(self.temp_dir, os.path.dirname(image_id)), exist_ok=True)
+            Image.new('RGB', (32, 24), (i_image, 0, 0)).save(os.path.join(self.temp_dir, image_id))
+            self.image_ids.append(image_id)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          functools.partial(FolderRequestHandler, directory=self.temp_dir))
+        self.server.lock = threading.Lock()
+        self.server.n_connections = 0
+        self.server.queries = []
+        self.server.flaky_paths = set()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url_prefix = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def fetch_all(self, source, image_ids, n_workers):
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(source.fetch, image_ids))
+
+    def test_connection_reuse(self):
+        source = HttpImageSource.from_container_sas(self.url_prefix + '/?sv=2018&sig=abc',
+                                                    retry_backoff_seconds=0.01)
+        streams = self.fetch_all(source, self.image_ids, n_workers=4)
+
+        for image_id, stream in zip(self.image_ids, streams):
+            with open(os.path.join(self.temp_dir, image_id), 'rb') as f:
+                self.assertEqual(stream.read(), f.read())
+        self.assertTrue(all(query == 'sv=2018&sig=abc' for query in self.server.queries))
+
+        # one connection per download thread, not per image
+        self.assertLessEqual(self.server.n_connections, 4)
+
+        stats = source.stats.summary()
+        self.assertEqual(stats['n_images'], 30)
+        self.assertEqual(stats['n_failed'], 0)
+        self.assertEqual(stats['n_retries'], 0)
+        self.assertAlmostEqual(stats['megabytes'], sum(len(s.getvalue()) for s in streams) / 1e6)
+
+    def test_retries(self):
+        flaky_ids = self.image_ids[:5]
+        self.server.flaky_paths.update('/' + image_id.replace(' ', '%20') for image_id in flaky_ids)
+
+        source = HttpImageSource(self.url_prefix, retry_backoff_seconds=0.01)
+        self.fetch_all(source, self.image_ids, n_workers=4)
+
+        stats = source.stats.summary()
+        self.assertEqual(stats['n_images'], 30)
+        self.assertEqual(stats['n_retries'], 5)
+
+        # not found is not retried
+        with self.assertRaises(IOError):
+            source.fetch('cam 0/missing.JPG')
+        self.assertEqual(source.stats.summary()['n_failed'], 1)
+        self.assertEqual(source.stats.summary()['n_retries'], 5)
+
+    def test_public_urls(self):
+        source = HttpImageSource(retry_backoff_seconds=0.01)
+        image_id = self.image_ids[0]
+        stream = source.fetch('{}/{}'.format(self.url_prefix, image_id.replace(' ', '%20')))
+        self.assertEqual(Image.open(stream).size, (32, 24))
+
+        # nothing listening
+        source = HttpImageSource('http://127.0.0.1:1', max_retries=2, retry_backoff_seconds=0.01)
+        with self.assertRaises(IOError):
+            source.fetch(image_id)
+        self.assertEqual(source.stats.summary()['n_retries'], 2)
+        self.assertEqual(source.stats.summary()['n_failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
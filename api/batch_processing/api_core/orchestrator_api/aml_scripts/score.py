@@ -1,32 +1,36 @@
 import argparse
-import io
+import collections
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib import request
 
-import azureml.core
-from azureml.core.model import Model
-from azureml.core.run import Run
+from tf_detector import TFDetector, batch_size
+from image_sources import get_image_source
 
-from tf_detector import TFDetector
-from sas_blob_utils import SasBlob
+# number of threads downloading and decoding images while the detector runs
+NUM_DOWNLOAD_WORKERS = 8
 
-print('score.py, beginning, using AML version {}'.format(azureml.core.__version__))
+# maximum number of images downloaded or being downloaded ahead of the detector; this, not the
+# shard size, bounds the memory used for images
+MAX_IMAGES_IN_MEMORY = 64
 
 
 class BatchScorer:
     """
     Coordinates scoring a batch of images using model at model_path.
-    The images are first downloaded and all loaded before scoring is performed.
+    Images are downloaded and decoded by a pool of threads while the detector scores the
+    images that are already loaded, so at most max_images_in_memory images are held at a time.
     """
 
     def __init__(self, **kwargs):
         print('BatchScorer, __init__()')
 
-        model_path = kwargs.get('model_path')
-        self.detector = TFDetector(model_path)
+        # a detector can be passed in instead of a model path, e.g. for testing
+        self.detector = kwargs.get('detector')
+        if self.detector is None:
+            self.detector = TFDetector(kwargs.get('model_path'), kwargs.get('batch_size') or batch_size)
 
         self.job_id = kwargs.get('job_id')
 
@@ -37,7 +41,15 @@ class BatchScorer:
 
         self.image_ids_to_score = kwargs.get('image_ids_to_score')
         self.use_url = kwargs.get('use_url')
-        self.images = []
+
+        # object with a fetch(image_id) method returning an image's bytes, see image_sources.py
+        self.image_source = kwargs.get('image_source')
+        if self.image_source is None:
+            self.image_source = get_image_source(self.input_container_sas, self.use_url)
+
+        self.num_download_workers = kwargs.get('num_download_workers') or NUM_DOWNLOAD_WORKERS
+        self.max_images_in_memory = max(kwargs.get('max_images_in_memory') or MAX_IMAGES_IN_MEMORY,
+                                        self.num_download_workers)
 
         # determine if there is metadata attached to each image_id
         self.metadata_available = True if isinstance(self.image_ids_to_score[0], list) else False
@@ -49,57 +61,83 @@ class BatchScorer:
         self.failed_metas = []  # their corresponding metadata
 
 
-    def download_images(self):
+    def load_image(self, image_id):
+        """Downloads and decodes one image; called on the download threads."""
+        # open is lazy; resizing to the detector's input size here, before the image is decoded,
+        # lets JPEGs be decoded at a reduced resolution, and load() makes sure the image can be read
+        image = TFDetector.open_image(self.image_source.fetch(image_id))
+        image = TFDetector.resize_image(image)
+        image.load()
+        return image
 
-        print('BatchScorer, download_images(), use_url is {}, metadata_available is {}'.format(
-            self.use_url, self.metadata_available))
-
-        if not self.use_url:
-            print('blob_service created')
-            blob_service = SasBlob.get_service_from_uri(self.input_container_sas)
-            container_name = SasBlob.get_container_from_uri(self.input_container_sas)
+    def load_images(self):
+        """
+        Yields (image_id, image_meta, image) for the images that could be downloaded and opened,
+        in the order of image_ids_to_score; the others are recorded in failed_images and
+        failed_metas.
 
-        for i in self.image_ids_to_score:
-            if self.metadata_available:
-                image_id = i[0]
-                image_meta = i[1]
-            else:
-                image_id = i
-                image_meta = None
+        At most max_images_in_memory images are downloaded ahead of the consumer.
+        """
+        print('BatchScorer, load_images(), use_url is {}, metadata_available is {}, {} download workers'.format(
+            self.use_url, self.metadata_available, self.num_download_workers))
 
-            try:
-                if self.use_url:
-                    # im_to_open will be a tempfile with a generated name
-                    im_to_open, headers = request.urlretrieve(image_id)  # TODO do not save to disk
+        def _items():
+            for i in self.image_ids_to_score:
+                if self.metadata_available:
+                    yield i[0], i[1]
                 else:
-                    im_to_open = io.BytesIO()
-                    _ = blob_service.get_blob_to_stream(container_name, image_id, im_to_open)
-
-                # open is lazy; load() loads the image so we know it can be read successfully
-                image = TFDetector.open_image(im_to_open)
-                image.load()
+                    yield i, None
+
+        items = _items()
+        pending = collections.deque()
+
+        with ThreadPoolExecutor(max_workers=self.num_download_workers) as executor:
+            while True:
+                while len(pending) < self.max_images_in_memory:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    pending.append((item[0], item[1], executor.submit(self.load_image, item[0])))
+
+                if len(pending) == 0:
+                    break
+
+                image_id, image_meta, future = pending.popleft()
+                try:
+                    image = future.result()
+                except Exception as e:
+                    print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
+                    self.failed_images.append(image_id)
+                    self.failed_metas.append(image_meta)
+                    continue
 
-                self.images.append(image)
                 self.image_ids.append(image_id)
                 self.image_metas.append(image_meta)
-            except Exception as e:
-                print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
-                self.failed_images.append(image_id)
-                self.failed_metas.append(image_meta)
-                continue
-
+                yield image_id, image_meta, image
 
     def score(self):
+        """Downloads and scores all images in image_ids_to_score."""
         print('BatchScorer, score()')
-        # self.image_ids does not include any failed images; self.image_ids is overwritten here
-        self.detections, failed_images, failed_metas = self.detector.generate_detections_batch(
-            images=self.images, image_ids=self.image_ids,
-            detection_threshold=self.detection_threshold,
-            image_metas=self.image_metas, metadata_available=self.metadata_available)
+        self.detections, failed_images, failed_metas = self.detector.generate_detections_stream(
+            self.load_images(), detection_threshold=self.detection_threshold,
+            metadata_available=self.metadata_available)
 
         self.failed_images.extend(failed_images)
         self.failed_metas.extend(failed_metas)
 
+        download_stats = self.get_download_stats()
+        if download_stats is not None:
+            print('BatchScorer, score(), download stats: {}'.format(download_stats))
+
+    def get_download_stats(self):
+        """Returns the image source's counts and throughput for this shard as a dict, or None if the
+        image source doesn't keep them.
+        """
+        stats = getattr(self.image_source, 'stats', None)
+        if stats is None:
+            return None
+        return stats.summary()
+
     def write_output(self):
         """Uploads a json containing all the detections (a subset of the "images" field of the final
         output), as well as a json list of failed images.
@@ -123,7 +161,11 @@ class BatchScorer:
 
 
 if __name__ == '__main__':
-    print('score.py, in __main__')
+    import azureml.core
+    from azureml.core.model import Model
+    from azureml.core.run import Run
+
+    print('score.py, in __main__, using AML version {}'.format(azureml.core.__version__))
 
     run = Run.get_context()
     start_time = datetime.now()
@@ -144,6 +186,10 @@ if __name__ == '__main__':
 
     parser.add_argument('--detection_threshold', type=float, default=0.05)
 
+    parser.add_argument('--batch_size', type=int, default=batch_size)  # images per session.run
+    parser.add_argument('--num_download_workers', type=int, default=NUM_DOWNLOAD_WORKERS)
+    parser.add_argument('--max_images_in_memory', type=int, default=MAX_IMAGES_IN_MEMORY)
+
     args = parser.parse_args()
 
     # bool argument parsing is tricky - bool(any string) is True
@@ -206,18 +252,17 @@ if __name__ == '__main__':
                          image_ids_to_score=image_ids_to_score,
                          use_url=args.use_url,
                          output_dir=args.output_dir,
-                         detection_threshold=args.detection_threshold)
-
-    try:
-        scorer.download_images()
-    except Exception as e:
-        raise RuntimeError('Exception in scorer.download_images(): {}'.format(str(e)))
+                         detection_threshold=args.detection_threshold,
+                         batch_size=args.batch_size,
+                         num_download_workers=args.num_download_workers,
+                         max_images_in_memory=args.max_images_in_memory)
 
     try:
         score_start = datetime.now()
         scorer.score()
         inference_duration_seconds = datetime.now() - score_start
-        print('score.py - inference_duration_seconds (inference only):', inference_duration_seconds)
+        print('score.py - inference_duration_seconds (downloading overlapped with inference):',
+              inference_duration_seconds)
     except Exception as e:
         raise RuntimeError('Exception in scorer.score(): {}'.format(str(e)))
 
@@ -228,5 +273,15 @@ if __name__ == '__main__':
         print('score.py - run_duration_seconds (load, inference, writing output):', run_duration_seconds)
         run.log('run_duration_seconds', str(run_duration_seconds))
         run.log('inference_duration_seconds', str(inference_duration_seconds))
+        # read by the orchestrator's job scheduler to size later jobs
+        run.log('num_images', len(image_ids_to_score))
+        run.log('scoring_seconds', inference_duration_seconds.total_seconds())
+        run.log('num_batches', len(scorer.detector.batch_timings))
+        run.log('session_run_seconds', sum(t[3] for t in scorer.detector.batch_timings))
+
+        download_stats = scorer.get_download_stats()
+        if download_stats is not None:
+            for k, v in download_stats.items():
+                run.log('download_' + k, v)
     except Exception as e:
         raise RuntimeError('Exception in writing output or logging to AML: {}'.format(str(e)))
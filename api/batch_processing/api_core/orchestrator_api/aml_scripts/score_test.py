@@ -0,0 +1,112 @@
+"""
+Tests for the streaming BatchScorer, using a local folder as the image source and a detector
+that only records which images it was given.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import tensorflow  # imported by tf_detector
+except ImportError:
+    tensorflow = None
+
+if tensorflow is not None:
+    from image_sources import LocalImageSource
+    from score import BatchScorer
+
+
+class CountingImageSource:
+
+    def __init__(self, root_dir):
+        self.source = LocalImageSource(root_dir)
+        self.lock = threading.Lock()
+        self.n_fetched = 0
+
+    def fetch(self, image_id):
+        with self.lock:
+            self.n_fetched += 1
+        return self.source.fetch(image_id)
+
+
+class RecordingDetector:
+
+    def __init__(self, test, image_source, max_images_in_memory):
+        self.test = test
+        self.image_source = image_source
+        self.max_images_in_memory = max_images_in_memory
+        self.scorer = None
+
+    def generate_detections_stream(self, images, detection_threshold, metadata_available=False):
+        detections = []
+        n_consumed = 0
+        for image_id, image_meta, image in images:
+            n_consumed += 1
+            # images are never fetched too far ahead of the detector
+            n_done = n_consumed + len(self.scorer.failed_images)
+            self.test.assertLessEqual(self.image_source.n_fetched - n_done, self.max_images_in_memory)
+            self.test.assertEqual(image.mode, 'RGB')
+            detection = {'file': image_id, 'max_detection_conf': 0.0, 'detections': []}
+            if metadata_available:
+                detection['meta'] = image_meta
+            detections.append(detection)
+        return detections, [], []
+
+
+@unittest.skipIf(tensorflow is None, 'tensorflow is not installed')
+class BatchScorerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.image_ids = []
+        for i_image in range(40):
+            image_id = 'cam{}/IMG_{:04d}.JPG'.format(i_image % 3, i_image)
+            os.makedirs(os.path.join(self.temp_dir, os.path.dirname(image_id)), exist_ok=True)
+            if i_image % 10 == 7:
+                # not an image
+                with open(os.path.join(self.temp_dir, image_id), 'w') as f:
+                    f.write('not an image')
+            elif i_image % 10 != 9:
+                # (images ending in 9 don't exist)
+                Image.new('RGB', (32, 24), (i_image, 0, 0)).save(os.path.join(self.temp_dir, image_id))
+            self.image_ids.append(image_id)
+        self.failed_ids = [image_id for i_image, image_id in enumerate(self.image_ids) if i_image % 10 in (7, 9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def score(self, image_ids_to_score, max_images_in_memory):
+        image_source = CountingImageSource(self.temp_dir)
+        detector = RecordingDetector(self, image_source, max_images_in_memory)
+        scorer = BatchScorer(detector=detector,
+                             image_source=image_source, job_id='request0_jobindex0', output_dir=self.temp_dir,
+                             detection_threshold=0.1, image_ids_to_score=image_ids_to_score,
+                             num_download_workers=4, max_images_in_memory=max_images_in_memory)
+        detector.scorer = scorer
+        scorer.score()
+        return scorer
+
+    def test_streaming(self):
+        scorer = self.score(self.image_ids, max_images_in_memory=6)
+        self.assertEqual([d['file'] for d in scorer.detections],
+                         [image_id for image_id in self.image_ids if image_id not in self.failed_ids])
+        self.assertEqual(scorer.failed_images, self.failed_ids)
+        self.assertEqual(scorer.failed_metas, [None] * len(self.failed_ids))
+
+    def test_metadata(self):
+        scorer = self.score([[image_id, 'meta_' + image_id] for image_id in self.image_ids],
+                            max_images_in_memory=4)
+        self.assertTrue(all(d['meta'] == 'meta_' + d['file'] for d in scorer.detections))
+        self.assertEqual(scorer.failed_metas, ['meta_' + image_id for image_id in self.failed_ids])
+
+
+if __name__ == '__main__':
+    unittest.main()
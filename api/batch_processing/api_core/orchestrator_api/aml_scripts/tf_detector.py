@@ -1,3 +1,6 @@
+import math
+import time
+
 import PIL.Image as Image
 import numpy as np
 import tensorflow as tf
@@ -6,17 +9,53 @@ print('tensorflow tf version:', tf.__version__)
 print('tf_detector.py, tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
 
-batch_size = 1
+# Default number of images per session.run; larger batches lower the cost per image on the GPU
+# cluster, up to what fits in GPU memory
+batch_size = 8
+
+# The model's keep_aspect_ratio_resizer resizes an image so that the smaller edge is MIN_DIM pixels,
+# unless the longer edge is then more than MAX_DIM pixels, in which case the longer edge is MAX_DIM
+# pixels (same values as in the synchronous API's api_config.py). Images are resized to about that
+# size before inference, so that the images of a batch can be stacked.
+MIN_DIM = 600
+MAX_DIM = 1024
+
+# Images are batched with images of a similar aspect ratio: aspect ratios are rounded to a power of
+# (1 + ASPECT_RATIO_STEP), and all images with the same rounded aspect ratio are resized to the same
+# size, so are stretched by at most about ASPECT_RATIO_STEP / 2 and never padded.
+ASPECT_RATIO_STEP = 0.05
 
 # Number of decimal places to round to for confidence and bbox coordinates
 CONF_DIGITS = 3
 COORD_DIGITS = 4
 
 
+def get_batch_image_size(width, height):
+    """
+    Returns the (width, height) that an image of size width x height is resized to before inference;
+    all images with the same rounded aspect ratio (see ASPECT_RATIO_STEP) get the same size.
+    """
+    step = math.log(1 + ASPECT_RATIO_STEP)
+    aspect_ratio = math.exp(round(math.log(width / height) / step) * step)
+
+    # size of the shorter and of the longer edge
+    short_edge, long_edge = MIN_DIM, MIN_DIM * max(aspect_ratio, 1 / aspect_ratio)
+    if long_edge > MAX_DIM:
+        short_edge, long_edge = short_edge * MAX_DIM / long_edge, MAX_DIM
+
+    if aspect_ratio >= 1:
+        return int(round(long_edge)), int(round(short_edge))
+    return int(round(short_edge)), int(round(long_edge))
+
+
 class TFDetector:
 
-    def __init__(self, model_path):
+    def __init__(self, model_path, batch_size=batch_size):
         self.detection_graph = self.load_model(model_path)
+        self.batch_size = batch_size
+
+        # (number of images, width, height, seconds in session.run) for each batch run
+        self.batch_timings = []
 
     def load_model(self, model_path):
         """Loads a detection model (i.e., create a graph) from a .pb file.
@@ -59,51 +98,87 @@ class TFDetector:
         return image
 
     @staticmethod
-    def round_and_make_float(d):
-        return round(float(d), COORD_DIGITS)
+    def resize_image(image):
+        """Resizes an image to its get_batch_image_size(), unless it already has that size.
 
-    @staticmethod
-    def convert_coords(np_array):
-        """ Two functionalities: convert the numpy floats to Python floats, and also change the coordinates from
-        [y1, x1, y2, x2] to [x1, y1, width_box, height_box] (in relative coordinates still).
+        If the image is not loaded yet, JPEGs are decoded at a reduced resolution where that is still
+        at least the target size, which is much faster than decoding the full image; score.py calls
+        this on its download threads for that reason.
 
         Args:
-            np_array: array of predicted bounding box coordinates from the TF detector
+            image: PIL image in RGB mode, e.g. from open_image()
+
+        Returns:
+            a PIL image of size get_batch_image_size(*image.size)
+        """
+        target_size = get_batch_image_size(*image.size)
+        if image.size == target_size:
+            return image
+
+        # no-op for images that are not JPEGs or are already loaded
+        image.draft('RGB', target_size)
+        # the model's own resizer is bilinear
+        return image.resize(target_size, Image.BILINEAR)
+
+    @staticmethod
+    def convert_detections(boxes, scores, classes, detection_threshold):
+        """ Applies the confidence threshold to the output tensors for one image, changes the box
+        coordinates from [y1, x1, y2, x2] to [x1, y1, width_box, height_box] (in relative coordinates still),
+        and rounds confidences and coordinates to Python floats with CONF_DIGITS and COORD_DIGITS
+        decimal places.
 
-        Returns: array of predicted bounding box coordinates as Python floats and in [x1, y1, width_box, height_box]
+        Args:
+            boxes, scores, classes: arrays of predicted bounding boxes, confidences and classes from the TF detector
+            detection_threshold: detection confidence above which to record the detection result
 
+        Returns: a list of detection entries, and the maximum confidence among them (0 if there are none)
         """
+        keep = scores > detection_threshold
+        kept_boxes = boxes[keep]
+
         # change from [y1, x1, y2, x2] to [x1, y1, width_box, height_box]
-        width_box = np_array[3] - np_array[1]
-        height_box = np_array[2] - np_array[0]
+        coords = np.stack([kept_boxes[:, 1], kept_boxes[:, 0],
+                           kept_boxes[:, 3] - kept_boxes[:, 1], kept_boxes[:, 2] - kept_boxes[:, 0]], axis=1)
+        # tolist() converts the numpy floats to Python floats, for json serialization
+        coords = [[round(x, COORD_DIGITS) for x in bbox] for bbox in coords.tolist()]
+        confs = [round(conf, CONF_DIGITS) for conf in scores[keep].tolist()]
+        categories = classes[keep].astype(np.int64).tolist()
 
-        new = [np_array[1], np_array[0], width_box, height_box]  # cannot be a numpy array; needs to be a list
+        detections = []
+        for bbox, conf, category in zip(coords, confs, categories):
+            detections.append({
+                'category': str(category),  # use string type for the numerical class label, not int
+                'conf': conf,
+                'bbox': bbox
+            })
 
-        # convert numpy floats to Python floats
-        for i, d in enumerate(new):
-            new[i] = TFDetector.round_and_make_float(d)
-        return new
+        max_detection_conf = round(float(scores[keep].max()), CONF_DIGITS) if len(confs) > 0 else 0.0
 
-    def _generate_detections_batch(self, images, sess, image_tensor, box_tensor, score_tensor, class_tensor):
-        print('_generate_detections_batch')
-        np_images = [np.asarray(image, np.uint8) for image in images]
-        images_stacked = np.expand_dims(np_images[0], axis=0)
+        return detections, max_detection_conf
 
-        print('images_stacked shape: ', images_stacked.shape)
+    def _generate_detections_batch(self, images, sess, image_tensor, box_tensor, score_tensor, class_tensor):
+        # the images of a batch all have the same size, see resize_image()
+        images_stacked = np.stack([np.asarray(image, np.uint8) for image in images], axis=0)
 
         # performs inference
+        start_time = time.time()
         (box_tensor, score_tensor, class_tensor) = sess.run(
             [box_tensor, score_tensor, class_tensor],
             feed_dict={image_tensor: images_stacked})
+        elapsed = time.time() - start_time
+
+        n_images, height, width = images_stacked.shape[:3]
+        self.batch_timings.append((n_images, width, height, elapsed))
+        print('tf_detector.py, batch {}: {} images of {}x{} in {:.3f}s ({:.1f} images/s)'.format(
+            len(self.batch_timings), n_images, width, height, elapsed, n_images / max(elapsed, 1e-6)))
 
-        print('box_tensor shape: ', box_tensor.shape)
         return box_tensor, score_tensor, class_tensor
 
     def generate_detections_batch(self, images, image_ids, detection_threshold,
                                   image_metas=None, metadata_available=False):
         """
         Args:
-            images: resized images to be processed by the detector
+            images: images to be processed by the detector
             image_ids: list of strings, IDs for the images
             detection_threshold: detection confidence above which to record the detection result
             image_metas: list of strings, same length as image_ids
@@ -120,22 +195,46 @@ class TFDetector:
             failed_metas: list of image_metas for images that failed to process
         """
 
-        # number of images should be small - all are loaded at once and a copy of resized version exists at one point
-        # 2000 images are okay on a NC6s_v3
-        print('tf_detector.py: generate_detections_batch...')
-
-        # group the images into batches; image_batches is a list of lists
-        image_batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
-
-        # we keep track of the image_ids (and image_metas when available) to be able to output the list of failed images
-        image_id_batches = [image_ids[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        # all images are loaded at once here; use generate_detections_stream to process
+        # images as they are loaded
         if image_metas is None:
             image_metas = [None] * len(images)
-        image_meta_batches = [image_metas[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        return self.generate_detections_stream(zip(image_ids, image_metas, images), detection_threshold,
+                                               metadata_available=metadata_available)
+
+    def generate_detections_stream(self, images, detection_threshold, metadata_available=False):
+        """
+        Like generate_detections_batch, but takes the images from an iterable, so only the images
+        waiting for a full batch need to be in memory.
+
+        Each image is resized with resize_image() and held back until there are self.batch_size
+        images of its size, which are then run in one session.run. At most 4 * self.batch_size
+        images are held back; beyond that the largest partial batch is run. The detections and
+        failures are returned in the order of the input.
+
+        Args:
+            images: iterable of (image_id, image_meta, image) tuples
+            detection_threshold: detection confidence above which to record the detection result
+            metadata_available: whether to add the image_metas to the detection entries
+
+        Returns:
+            detections, failed_images, failed_metas, as for generate_detections_batch
+        """
+        print('tf_detector.py: generate_detections_stream...')
 
+        # (index in the input, entry) tuples, sorted by index at the end
         detections = []
-        failed_images = []
-        failed_metas = []
+        failures = []
+
+        def _resized_images():
+            for i_image, (image_id, image_meta, image) in enumerate(images):
+                try:
+                    image = TFDetector.resize_image(image)
+                except Exception as e:
+                    print('tf_detector.py, failed to resize image {}: {}'.format(image_id, str(e)))
+                    failures.append((i_image, image_id, image_meta))
+                    continue
+                yield image.size, (i_image, image_id, image_meta, image)
 
         # start the TF session to process all images
         with tf.Session(graph=self.detection_graph) as sess:
@@ -145,43 +244,67 @@ class TFDetector:
             score_tensor = self.detection_graph.get_tensor_by_name('detection_scores:0')
             class_tensor = self.detection_graph.get_tensor_by_name('detection_classes:0')
 
-            for i_batch, (image_batch, image_id_batch, image_meta_batch) in enumerate(zip(
-                    image_batches, image_id_batches, image_meta_batches)):
+            batches = TFDetector.iterate_batches_by_key(_resized_images(), self.batch_size,
+                                                        4 * self.batch_size)
+            for batch in batches:
+                index_batch, image_id_batch, image_meta_batch, image_batch = zip(*batch)
                 try:
-                    print('tf_detector.py, processing batch {} out of {}.'.format(i_batch + 1, len(image_batches)))
-
                     b_box, b_score, b_class = self._generate_detections_batch(image_batch,
                                                                               sess, image_tensor,
                                                                               box_tensor, score_tensor, class_tensor)
-                    for i, (image_id, image_meta) in enumerate(zip(image_id_batch, image_meta_batch)):
-                        # apply the confidence threshold
-                        boxes, scores, classes = b_box[i], b_score[i], b_class[i]
-                        detections_cur_image = []  # will be empty for an image with no confident detections
-                        max_detection_conf = 0.0
-                        for b, s, c in zip(boxes, scores, classes):
-                            if s > detection_threshold:
-                                detection_entry = {
-                                    'category': str(int(c)),  # use string type for the numerical class label, not int
-                                    'conf': round(float(s), CONF_DIGITS),  # cast to float for json serialization
-                                    'bbox': TFDetector.convert_coords(b)
-                                }
-                                detections_cur_image.append(detection_entry)
-                                if s > max_detection_conf:
-                                    max_detection_conf = s
+                    for i, (i_image, image_id, image_meta) in enumerate(zip(index_batch, image_id_batch,
+                                                                            image_meta_batch)):
+                        # apply the confidence threshold; detections_cur_image will be empty for an image
+                        # with no confident detections
+                        detections_cur_image, max_detection_conf = TFDetector.convert_detections(
+                            b_box[i], b_score[i], b_class[i], detection_threshold)
 
                         detection = {
                             'file': image_id,
-                            'max_detection_conf': round(float(max_detection_conf), CONF_DIGITS),
+                            'max_detection_conf': max_detection_conf,
                             'detections': detections_cur_image
                         }
                         if metadata_available:
                             detection['meta'] = image_meta
-                        detections.append(detection)
+                        detections.append((i_image, detection))
 
                 except Exception as e:
-                    failed_images.extend(image_id_batch)
-                    failed_metas.extend(image_meta_batch)
+                    failures.extend(zip(index_batch, image_id_batch, image_meta_batch))
                     print('tf_detector.py, one batch of images failed, exception: {}'.format(str(e)))
                     continue
 
+        n_images = sum(t[0] for t in self.batch_timings)
+        inference_seconds = sum(t[3] for t in self.batch_timings)
+        print('tf_detector.py, {} images in {} batches, {:.1f}s in session.run ({:.1f} images/s)'.format(
+            n_images, len(self.batch_timings), inference_seconds, n_images / max(inference_seconds, 1e-6)))
+
+        detections = [detection for _, detection in sorted(detections, key=lambda t: t[0])]
+        failures = sorted(failures, key=lambda t: t[0])
+        failed_images = [image_id for _, image_id, _ in failures]
+        failed_metas = [image_meta for _, _, image_meta in failures]
         return detections, failed_images, failed_metas
+
+    @staticmethod
+    def iterate_batches_by_key(items, n, max_buffered):
+        """
+        Yields lists of up to n items with the same key from the iterable of (key, item) tuples
+        items. Items are held back until there are n items with their key, or until more than
+        max_buffered items are held back in total, in which case the largest list is yielded; the
+        remaining lists are yielded at the end.
+        """
+        pending = {}
+        n_pending = 0
+        for key, item in items:
+            pending.setdefault(key, []).append(item)
+            n_pending += 1
+
+            if len(pending[key]) == n:
+                n_pending -= n
+                yield pending.pop(key)
+            elif n_pending > max_buffered:
+                largest_key = max(pending, key=lambda k: len(pending[k]))
+                n_pending -= len(pending[largest_key])
+                yield pending.pop(largest_key)
+
+        for batch in pending.values():
+            yield batch
@@ -0,0 +1,139 @@
+"""
+Tests for batching in the AML TFDetector, with a stand-in for the TF graph and session whose
+"detections" are computed from the pixels of each image, so that mixing up the images of a batch
+shows in the results.
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import tensorflow
+except ImportError:
+    tensorflow = None
+
+if tensorflow is not None:
+    import tf_detector
+    from tf_detector import TFDetector, get_batch_image_size
+
+
+class FakeGraph:
+
+    def get_tensor_by_name(self, name):
+        return name
+
+
+class FakeSession:
+    """
+    Returns one box per image, with the image's red level (0-255) / 1000 as its confidence.
+    """
+
+    batch_shapes = []
+
+    def __init__(self, graph=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, fetches, feed_dict):
+        images = feed_dict['image_tensor:0']
+        FakeSession.batch_shapes.append(images.shape)
+        n = images.shape[0]
+        boxes = np.array([[[0.1, 0.25, 0.5, 0.75]]] * n)
+        scores = images[:, 0, 0, 0].reshape(n, 1) / 1000.0
+        classes = np.array([[1.0]] * n, dtype=np.float32)
+        return boxes, scores, classes
+
+
+@unittest.skipIf(tensorflow is None, 'tensorflow is not installed')
+class TFDetectorBatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeSession.batch_shapes = []
+        patches = [mock.patch.object(TFDetector, 'load_model', return_value=FakeGraph()),
+                   mock.patch.object(tf_detector.tf, 'Session', FakeSession, create=True)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_batch_image_size(self):
+        self.assertEqual(get_batch_image_size(4000, 3000), (804, 600))
+        self.assertEqual(get_batch_image_size(2048, 1536), (804, 600))
+        self.assertEqual(get_batch_image_size(3000, 4000), (600, 804))
+        self.assertEqual(get_batch_image_size(1920, 1080), (1024, 570))
+        self.assertEqual(get_batch_image_size(600, 600), (600, 600))
+        self.assertEqual(get_batch_image_size(4000, 1000), (1024, 261))  # 4 rounds to 1.05 ** 28
+
+    def test_batches(self):
+        # 4:3, 16:9 and portrait images, interleaved
+        sizes = [(400, 300), (1920, 1080), (300, 400)]
+        images = []
+        for i_image in range(23):
+            image_id = 'IMG_{:04d}.JPG'.format(i_image)
+            image = Image.new('RGB', sizes[i_image % 3], (10 * i_image, 0, 0))
+            images.append((image_id, 'meta{}'.format(i_image), image))
+        # an image that fails to load
+        images.insert(5, ('broken.JPG', 'meta_broken', mock.Mock(size=(400, 300), draft=mock.Mock(),
+                                                                  resize=mock.Mock(side_effect=OSError))))
+
+        detector = TFDetector('model.pb', batch_size=4)
+        detections, failed_images, failed_metas = detector.generate_detections_stream(
+            iter(images), detection_threshold=0.0, metadata_available=True)
+
+        # each batch holds images of one size, and all but the last batch of each size are full
+        shapes = FakeSession.batch_shapes
+        self.assertEqual(sum(shape[0] for shape in shapes), 23)
+        for size in [(804, 600), (1024, 570), (600, 804)]:
+            batch_lengths = [shape[0] for shape in shapes if (shape[2], shape[1]) == size]
+            self.assertEqual(batch_lengths[:-1], [4] * (len(batch_lengths) - 1))
+        self.assertEqual(len(detector.batch_timings), len(shapes))
+
+        # in the input order, each with its own detections
+        self.assertEqual([d['file'] for d in detections], ['IMG_{:04d}.JPG'.format(i) for i in range(23)])
+        for i_image, d in enumerate(detections):
+            self.assertEqual(d['meta'], 'meta{}'.format(i_image))
+            expected_conf = 10 * i_image / 1000.0
+            if expected_conf > 0:
+                self.assertAlmostEqual(d['max_detection_conf'], expected_conf, places=3)
+                self.assertEqual(d['detections'][0]['bbox'], [0.25, 0.1, 0.5, 0.4])
+        self.assertEqual(failed_images, ['broken.JPG'])
+        self.assertEqual(failed_metas, ['meta_broken'])
+
+    def test_convert_detections(self):
+        boxes = np.array([[0.1, 0.0123456, 0.5, 0.75], [0.2, 0.2, 0.3, 0.3]], dtype=np.float32)
+        scores = np.array([0.98765, 0.05], dtype=np.float32)
+        classes = np.array([1.0, 2.0], dtype=np.float32)
+        detections, max_detection_conf = TFDetector.convert_detections(boxes, scores, classes,
+                                                                       detection_threshold=0.1)
+
+        # rounded to CONF_DIGITS and COORD_DIGITS decimal places
+        self.assertEqual(detections, [{'category': '1', 'conf': 0.988, 'bbox': [0.0123, 0.1, 0.7377, 0.4]}])
+        self.assertEqual(max_detection_conf, 0.988)
+        self.assertIsInstance(detections[0]['conf'], float)
+
+        self.assertEqual(TFDetector.convert_detections(boxes, scores, classes, detection_threshold=0.99),
+                         ([], 0.0))
+
+    def test_max_buffered(self):
+        items = [((i % 5,), i) for i in range(12)]
+        batches = list(TFDetector.iterate_batches_by_key(iter(items), 4, max_buffered=6))
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(12)))
+        # the first 7 items all have different keys but for 2 pairs, so the largest list goes out
+        self.assertEqual(batches[0], [0, 5])
+        for batch in batches:
+            self.assertEqual(len(set(i % 5 for i in batch)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,9 +19,29 @@ ACCEPTED_IMAGE_FILE_ENDINGS = ('.jpeg', '.jpg')
 # max number of images in a container to accept for processing
 MAX_NUMBER_IMAGES_ACCEPTED = 2 * 1000 * 1000  # accept up to 2 million images
 
-# how many images are processed by each call to the scoring API
+# how many images are processed by each call to the scoring API, until the throughput of the nodes has been
+# measured; after that, jobs are sized to take about TARGET_JOB_MINUTES (see job_scheduler.py)
 NUM_IMAGES_PER_JOB = 2000
 
+TARGET_JOB_MINUTES = 20
+MIN_IMAGES_PER_JOB = 200
+MAX_IMAGES_PER_JOB = 20000
+
+# number of nodes in the AML compute cluster, if it can't be found from the cluster's scale settings
+DEFAULT_NUM_NODES = 16
+
+# number of times the images of a failed or straggling job are submitted at most, as smaller jobs
+MAX_JOB_ATTEMPTS = 3
+
+# a job running this many times longer than predicted from the measured throughput is resubmitted as two jobs
+STRAGGLER_FACTOR = 3.0
+
+# number of job submissions or status checks sent to AML at a time
+MAX_CONCURRENT_AML_REQUESTS = 8
+
+# number of images whose sizes are looked up to estimate the mean size of a request's images
+NUM_IMAGES_TO_SAMPLE_FOR_SIZE = 20
+
 # update API task manager after submitting x jobs to AML Compute
 JOB_SUBMISSION_UPDATE_INTERVAL = 2
 
@@ -46,8 +66,6 @@ AML_CONFIG = {
 
     'param_detection_threshold': 0.3,  # megadetector v3 tends to have more very low confident detections and issues with NMS
 
-    'completed_status': ['Finished', 'Failed', 'Completed', 'Canceled'],
-
     # service principle for authenticating to AML
     'tenant-id': '',  # fill these out before building the container
     'application-id': ''
@@ -58,9 +76,6 @@ WHITELIST = []
 # version of the detector model in use
 SUPPORTED_MODEL_VERSIONS = sorted([k for k in AML_CONFIG['models']])
 
-# max number of blobs to list in the output blob container
-MAX_BLOBS_IN_OUTPUT_CONTAINER = 1000 * 1000
-
 # URLs to the 3 output files expires after this many days
 EXPIRATION_DAYS = 90
 
@@ -0,0 +1,422 @@
+"""
+Splits a request's images into jobs (shards), submits them and keeps track of them until they are
+all done.
+
+Job sizes come from the throughput that score.py measured and logged for previous jobs (images per
+second on one node, and megabytes of images downloaded per second by jobs that were limited by
+downloads), so that a job takes about target_job_seconds on a node whatever the size of the images;
+until a throughput has been measured, jobs have default_images_per_job images. There are always at
+least as many jobs as nodes.
+
+Submissions and status checks go to the backend on a pool of max_concurrent_requests threads. Jobs
+that fail, and stragglers (running for straggler_factor times longer than predicted, while no other
+job is waiting for a node), are canceled and their images are resubmitted as two jobs of half the
+size, up to max_attempts times; the replaced jobs are kept in self.jobs but marked as superseded.
+
+The backend is AMLCompute in orchestrator.py, or SimulatedBackend below, which runs jobs on
+simulated nodes so that the scheduling can be tested without AML. A backend has these methods:
+
+    submit_job(job_id, begin, end) -> run handle
+    get_job_status(run) -> status string, e.g. 'Queued', 'Running', 'Finished', 'Failed'
+    get_job_metrics(run) -> dict with 'num_images', 'scoring_seconds' and optionally
+        'download_megabytes' and 'session_run_seconds' for a finished job, or None
+    cancel_job(run)
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# statuses of AML pipeline runs that are done (AML returns both Finished and Completed), and of
+# SimulatedBackend's jobs
+FINISHED_STATUSES = ('Finished', 'Completed')
+FAILED_STATUSES = ('Failed',)
+CANCELED_STATUSES = ('Canceled',)
+RUNNING_STATUSES = ('Running',)
+
+# a job was limited by downloads if the detector was busy for less than this fraction of its scoring time
+DOWNLOAD_BOUND_FRACTION = 0.8
+
+
+# %% Throughput
+
+class ThroughputEstimate:
+    """
+    Running estimate of the throughput of one node, from the metrics of finished jobs; shared by
+    the schedulers of all requests, so that later requests are sharded using earlier measurements.
+    """
+
+    def __init__(self, images_per_second=None, megabytes_per_second=None, weight=0.3):
+        """
+        Args:
+            images_per_second, megabytes_per_second: initial estimates, None if unknown
+            weight: weight of each new measurement in the exponential moving averages
+        """
+        self.lock = threading.Lock()
+        self.images_per_second = images_per_second
+        self.megabytes_per_second = megabytes_per_second
+        self.weight = weight
+
+    def _average(self, current, new):
+        return new if current is None else (1 - self.weight) * current + self.weight * new
+
+    def update(self, num_images, seconds, megabytes=None, inference_seconds=None):
+        """
+        Records the metrics of a finished job.
+
+        The megabytes per second that a job achieved are only what the node can download if downloads
+        were what limited the job, i.e. the detector (busy for inference_seconds) often waited for
+        images; otherwise they only reflect how fast the detector consumed the images, and are not
+        recorded. For a job limited by downloads, the images per second are those of the detector
+        alone, num_images / inference_seconds.
+
+        Args:
+            num_images: number of images scored
+            seconds: time taken to download and score them
+            megabytes: size of the images downloaded, None if unknown
+            inference_seconds: time spent running the detector, None if unknown
+        """
+        if num_images <= 0 or seconds <= 0:
+            return
+        download_bound = inference_seconds is not None and 0 < inference_seconds < DOWNLOAD_BOUND_FRACTION * seconds
+        with self.lock:
+            if download_bound:
+                self.images_per_second = self._average(self.images_per_second, num_images / inference_seconds)
+                if megabytes is not None and megabytes > 0:
+                    self.megabytes_per_second = self._average(self.megabytes_per_second, megabytes / seconds)
+            else:
+                self.images_per_second = self._average(self.images_per_second, num_images / seconds)
+
+    def get_images_per_second(self, mean_image_megabytes=None):
+        """
+        Returns the estimated images per second for images of mean_image_megabytes: downloading
+        overlaps with inference, so whichever of the two is slower sets the pace. None if unknown.
+        """
+        with self.lock:
+            images_per_second = self.images_per_second
+            if mean_image_megabytes and self.megabytes_per_second:
+                download_images_per_second = self.megabytes_per_second / mean_image_megabytes
+                if images_per_second is None or download_images_per_second < images_per_second:
+                    images_per_second = download_images_per_second
+            return images_per_second
+
+
+# %% Scheduler
+
+class JobScheduler:
+    """
+    Shards, submits and monitors the jobs of one request; see the module docstring.
+    """
+
+    def __init__(self, backend, request_id, num_images, throughput, mean_image_megabytes=None,
+                 num_nodes=1, default_images_per_job=2000, target_job_seconds=20 * 60,
+                 min_images_per_job=100, max_images_per_job=20000, max_attempts=3,
+                 straggler_factor=3.0, max_concurrent_requests=8, time_fn=time.time):
+        """
+        Args:
+            backend: object with the methods listed in the module docstring
+            request_id: str, the request's ID
+            num_images: number of images in the request
+            throughput: ThroughputEstimate, updated as jobs finish
+            mean_image_megabytes: mean size of the request's images, None if unknown
+            num_nodes: number of nodes in the cluster
+            default_images_per_job: job size before any throughput has been measured
+            target_job_seconds: how long a job should take on a node
+            min_images_per_job, max_images_per_job: bounds on the job size
+            max_attempts: number of times the images of a job are submitted at most
+            straggler_factor: a job running this many times longer than predicted is a straggler
+            max_concurrent_requests: number of submissions or status checks in flight at a time
+            time_fn: returns the current time in seconds; the simulator's clock in tests
+        """
+        self.backend = backend
+        self.request_id = request_id
+        self.num_images = num_images
+        self.throughput = throughput
+        self.mean_image_megabytes = mean_image_megabytes
+        self.num_nodes = max(num_nodes, 1)
+        self.default_images_per_job = default_images_per_job
+        self.target_job_seconds = target_job_seconds
+        self.min_images_per_job = min_images_per_job
+        self.max_images_per_job = max_images_per_job
+        self.max_attempts = max_attempts
+        self.straggler_factor = straggler_factor
+        self.max_concurrent_requests = max_concurrent_requests
+        self.time_fn = time_fn
+
+        # job_id -> dict with fields begin, end, attempt, run, status, running_since, superseded
+        self.jobs = OrderedDict()
+        self.num_planned_jobs = 0
+
+    def get_job_id(self, job_index):
+        # new job IDs for resubmitted images continue after the planned ones; score.py finds the
+        # request ID from the part between 'request' and '_jobindex'
+        return 'request{}_jobindex{}_total{}'.format(self.request_id, job_index, self.num_planned_jobs)
+
+    def get_images_per_job(self):
+        images_per_second = self.throughput.get_images_per_second(self.mean_image_megabytes)
+        if images_per_second is None:
+            images_per_job = self.default_images_per_job
+        else:
+            images_per_job = int(images_per_second * self.target_job_seconds)
+        images_per_job = min(max(images_per_job, self.min_images_per_job), self.max_images_per_job)
+
+        # keep all nodes busy
+        return max(min(images_per_job, math.ceil(self.num_images / self.num_nodes)), 1)
+
+    def predict_seconds(self, num_images):
+        """Predicted running time of a job of num_images on one node, None if unknown."""
+        images_per_second = self.throughput.get_images_per_second(self.mean_image_megabytes)
+        if images_per_second is None:
+            return None
+        return num_images / images_per_second
+
+    def _add_job(self, begin, end, attempt):
+        job_id = self.get_job_id(len(self.jobs))
+        self.jobs[job_id] = {'begin': begin, 'end': end, 'attempt': attempt, 'run': None, 'status': None,
+                             'running_since': None, 'superseded': False}
+        return job_id
+
+    def plan_jobs(self):
+        """Splits the request's images into jobs of get_images_per_job() images; returns the job IDs."""
+        assert len(self.jobs) == 0, 'Jobs were already planned'
+        images_per_job = self.get_images_per_job()
+        self.num_planned_jobs = math.ceil(self.num_images / images_per_job)
+        print('JobScheduler, request {}, {} images in {} jobs of {} images'.format(
+            self.request_id, self.num_images, self.num_planned_jobs, images_per_job))
+
+        return [self._add_job(begin, min(begin + images_per_job, self.num_images), attempt=1)
+                for begin in range(0, self.num_images, images_per_job)]
+
+    def submit_jobs(self, job_ids=None, progress_callback=None):
+        """
+        Submits the jobs in job_ids (default: all that were not submitted yet) concurrently.
+
+        Args:
+            job_ids: list of job IDs
+            progress_callback: called with the number of jobs submitted so far, after each submission
+        """
+        if job_ids is None:
+            job_ids = [job_id for job_id, job in self.jobs.items() if job['run'] is None]
+
+        lock = threading.Lock()
+        num_submitted = [0]
+
+        def _submit(job_id):
+            job = self.jobs[job_id]
+            job['run'] = self.backend.submit_job(job_id, job['begin'], job['end'])
+            job['status'] = 'Queued'
+            print('Submitted job {}.'.format(job_id))
+            if progress_callback is not None:
+                with lock:
+                    num_submitted[0] += 1
+                    progress_callback(num_submitted[0])
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            # list() to raise the first exception, if any
+            list(executor.map(_submit, job_ids))
+
+    def get_active_jobs(self):
+        """Returns the jobs that were not superseded, as an OrderedDict job_id -> job."""
+        return OrderedDict((job_id, job) for job_id, job in self.jobs.items() if not job['superseded'])
+
+    def _resubmit(self, job_id, reason):
+        """Cancels a job and submits its images again as two jobs (one if it is already small)."""
+        job = self.jobs[job_id]
+        job['superseded'] = True
+        if job['status'] not in FINISHED_STATUSES + FAILED_STATUSES + CANCELED_STATUSES:
+            self.backend.cancel_job(job['run'])
+
+        begin, end = job['begin'], job['end']
+        if end - begin >= 2 * self.min_images_per_job:
+            middle = (begin + end) // 2
+            ranges = [(begin, middle), (middle, end)]
+        else:
+            ranges = [(begin, end)]
+        new_job_ids = [self._add_job(b, e, attempt=job['attempt'] + 1) for b, e in ranges]
+        print('JobScheduler, job {} ({}), resubmitting images {} to {} as {}'.format(
+            job_id, reason, begin, end, ', '.join(new_job_ids)))
+        return new_job_ids
+
+    def check_job_status(self):
+        """
+        Submits the active jobs whose submission failed in an earlier call, polls the status of the
+        active jobs, records the throughput of the jobs that finished since the last check, and
+        resubmits failed jobs and stragglers.
+
+        Returns:
+            all_jobs_finished: True if all active jobs are done (finished, failed or canceled)
+            status_tally: dict status -> number of active jobs with that status
+        """
+        active_jobs = self.get_active_jobs()
+
+        # e.g. resubmitted images, if submitting them raised in an earlier call
+        unsubmitted_ids = [job_id for job_id, job in active_jobs.items() if job['run'] is None]
+        if len(unsubmitted_ids) > 0:
+            print('JobScheduler, request {}, submitting {} jobs that were not submitted'.format(
+                self.request_id, len(unsubmitted_ids)))
+            self.submit_jobs(unsubmitted_ids)
+
+        pending_ids = [job_id for job_id, job in active_jobs.items() if job['run'] is not None and
+                       job['status'] not in FINISHED_STATUSES + FAILED_STATUSES + CANCELED_STATUSES]
+
+        def _poll(job_id):
+            return self.backend.get_job_status(self.jobs[job_id]['run'])
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            statuses = list(executor.map(_poll, pending_ids))
+
+        now = self.time_fn()
+        newly_finished = []
+        for job_id, status in zip(pending_ids, statuses):
+            job = self.jobs[job_id]
+            if status in RUNNING_STATUSES and job['running_since'] is None:
+                job['running_since'] = now
+            if status in FINISHED_STATUSES:
+                newly_finished.append(job_id)
+            job['status'] = status
+
+        for job_id in newly_finished:
+            metrics = self.backend.get_job_metrics(self.jobs[job_id]['run'])
+            if metrics is not None:
+                self.throughput.update(metrics['num_images'], metrics['scoring_seconds'],
+                                       metrics.get('download_megabytes'), metrics.get('session_run_seconds'))
+
+        to_resubmit = []
+        for job_id, job in active_jobs.items():
+            if job['status'] in FAILED_STATUSES and job['attempt'] < self.max_attempts:
+                to_resubmit.append((job_id, 'failed'))
+
+        # split stragglers only if their halves can start right away on idle nodes
+        nodes_busy = any(job['status'] not in RUNNING_STATUSES + FINISHED_STATUSES + FAILED_STATUSES +
+                         CANCELED_STATUSES for job in active_jobs.values())
+        if not nodes_busy:
+            for job_id, job in active_jobs.items():
+                predicted_seconds = self.predict_seconds(job['end'] - job['begin'])
+                if job['status'] in RUNNING_STATUSES and job['attempt'] < self.max_attempts and \
+                        predicted_seconds is not None and \
+                        now - job['running_since'] > self.straggler_factor * predicted_seconds:
+                    to_resubmit.append((job_id, 'straggler'))
+
+        new_job_ids = []
+        for job_id, reason in to_resubmit:
+            new_job_ids.extend(self._resubmit(job_id, reason))
+        if len(new_job_ids) > 0:
+            self.submit_jobs(new_job_ids)
+
+        all_jobs_finished = True
+        status_tally = defaultdict(int)
+        for job_id, job in self.get_active_jobs().items():
+            status_tally[job['status']] += 1
+            if job['status'] not in FINISHED_STATUSES + FAILED_STATUSES + CANCELED_STATUSES:
+                all_jobs_finished = False
+        return all_jobs_finished, status_tally
+
+
+# %% Simulator
+
+class SimulatedBackend:
+    """
+    Runs jobs on simulated nodes, on a simulated clock advanced by advance(); jobs wait in a queue
+    until a node is free, like on an AML cluster. A job of n images takes n / speed seconds on a node
+    of that speed, or longer if downloading its images at node_megabytes_per_second takes longer.
+    """
+
+    def __init__(self, node_images_per_second, image_megabytes=None, node_megabytes_per_second=None,
+                 failing_job_ids=None):
+        """
+        Args:
+            node_images_per_second: list of the speeds of the nodes, in images per second
+            image_megabytes: if given, reported as download_megabytes per image in the metrics
+            node_megabytes_per_second: download speed of every node; None for no limit
+            failing_job_ids: IDs of jobs that fail halfway through
+        """
+        self.now = 0.0
+        self.node_speeds = list(node_images_per_second)
+        self.node_megabytes_per_second = node_megabytes_per_second
+        self.node_runs = [None] * len(self.node_speeds)
+        self.queue = []
+        self.image_megabytes = image_megabytes
+        self.failing_job_ids = set(failing_job_ids or [])
+        self.lock = threading.Lock()
+        self.runs = OrderedDict()
+
+    def time(self):
+        return self.now
+
+    def _start_queued_jobs(self):
+        for i_node, run in enumerate(self.node_runs):
+            if run is None and len(self.queue) > 0:
+                run = self.queue.pop(0)
+                run['node'] = i_node
+                run['start'] = self.now
+                run['inference_seconds'] = run['num_images'] / self.node_speeds[i_node]
+                duration = run['inference_seconds']
+                if self.image_megabytes is not None and self.node_megabytes_per_second is not None:
+                    duration = max(duration, run['num_images'] * self.image_megabytes / self.node_megabytes_per_second)
+                if run['job_id'] in self.failing_job_ids:
+                    duration /= 2
+                run['end'] = self.now + duration
+                run['status'] = 'Running'
+                self.node_runs[i_node] = run
+
+    def _free_node(self, run):
+        self.node_runs[run['node']] = None
+        self._start_queued_jobs()
+
+    def advance(self, seconds):
+        """Runs the simulation forward by seconds."""
+        with self.lock:
+            target_time = self.now + seconds
+            while True:
+                running = [run for run in self.node_runs if run is not None]
+                if len(running) == 0:
+                    break
+                run = min(running, key=lambda r: r['end'])
+                if run['end'] > target_time:
+                    break
+                self.now = run['end']
+                run['status'] = 'Failed' if run['job_id'] in self.failing_job_ids else 'Finished'
+                self._free_node(run)
+            self.now = target_time
+
+    def run_until_done(self, scheduler, check_period_seconds):
+        """Checks the scheduler's jobs every check_period_seconds until all are done; returns the time."""
+        while True:
+            self.advance(check_period_seconds)
+            all_jobs_finished, _ = scheduler.check_job_status()
+            if all_jobs_finished:
+                return self.now
+
+    def submit_job(self, job_id, begin, end):
+        with self.lock:
+            run = {'job_id': job_id, 'num_images': end - begin, 'status': 'Queued', 'node': None,
+                   'start': None, 'end': None, 'inference_seconds': None}
+            self.runs[job_id] = run
+            self.queue.append(run)
+            self._start_queued_jobs()
+            return run
+
+    def get_job_status(self, run):
+        with self.lock:
+            return run['status']
+
+    def get_job_metrics(self, run):
+        with self.lock:
+            if run['status'] not in FINISHED_STATUSES:
+                return None
+            metrics = {'num_images': run['num_images'], 'scoring_seconds': run['end'] - run['start'],
+                       'session_run_seconds': run['inference_seconds']}
+            if self.image_megabytes is not None:
+                metrics['download_megabytes'] = run['num_images'] * self.image_megabytes
+            return metrics
+
+    def cancel_job(self, run):
+        with self.lock:
+            if run['status'] == 'Queued':
+                self.queue.remove(run)
+            elif run['status'] == 'Running':
+                self._free_node(run)
+            run['status'] = 'Canceled'
@@ -0,0 +1,176 @@
+"""
+Tests for JobScheduler on the simulated backend.
+"""
+
+import unittest
+from unittest import mock
+
+from job_scheduler import JobScheduler, SimulatedBackend, ThroughputEstimate
+
+
+class JobSchedulerTest(unittest.TestCase):
+
+    def get_scheduler(self, backend, num_images, throughput, **kwargs):
+        return JobScheduler(backend, 'abc', num_images, throughput, num_nodes=len(backend.node_speeds),
+                            target_job_seconds=600, time_fn=backend.time, **kwargs)
+
+    def assert_all_images_scored_once(self, scheduler):
+        ranges = sorted((job['begin'], job['end']) for job in scheduler.get_active_jobs().values())
+        self.assertTrue(all(job['status'] == 'Finished' for job in scheduler.get_active_jobs().values()))
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], scheduler.num_images)
+        for (_, end), (begin, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(end, begin)
+
+    def test_job_sizes(self):
+        backend = SimulatedBackend([10] * 4)
+
+        # from the images per second
+        scheduler = self.get_scheduler(backend, 100000, ThroughputEstimate(images_per_second=10))
+        self.assertEqual(scheduler.get_images_per_job(), 6000)
+        job_ids = scheduler.plan_jobs()
+        self.assertEqual(len(job_ids), 17)
+        self.assertEqual(scheduler.jobs[job_ids[-1]]['end'], 100000)
+        self.assertEqual(job_ids[0], 'requestabc_jobindex0_total17')
+
+        # large images that take longer to download than to score
+        throughput = ThroughputEstimate(images_per_second=10, megabytes_per_second=20)
+        scheduler = self.get_scheduler(backend, 100000, throughput, mean_image_megabytes=4)
+        self.assertEqual(scheduler.get_images_per_job(), 3000)
+
+        # nothing measured yet
+        self.assertEqual(self.get_scheduler(backend, 100000, ThroughputEstimate(),
+                                            default_images_per_job=2000).get_images_per_job(), 2000)
+
+        # at least one job per node
+        self.assertEqual(self.get_scheduler(backend, 1000, ThroughputEstimate(images_per_second=10))
+                         .get_images_per_job(), 250)
+
+    def test_learns_throughput(self):
+        backend = SimulatedBackend([5] * 4, image_megabytes=2)
+        throughput = ThroughputEstimate()
+        scheduler = self.get_scheduler(backend, 10000, throughput, default_images_per_job=1000)
+        scheduler.plan_jobs()
+        scheduler.submit_jobs()
+        backend.run_until_done(scheduler, check_period_seconds=60)
+
+        self.assert_all_images_scored_once(scheduler)
+        self.assertAlmostEqual(throughput.images_per_second, 5)
+
+        # the jobs were limited by the detector, so the 10 MB/s they downloaded is not a limit
+        self.assertIsNone(throughput.megabytes_per_second)
+
+        # the next request gets jobs of about target_job_seconds, even if its images are much larger
+        self.assertEqual(self.get_scheduler(backend, 100000, throughput).get_images_per_job(), 3000)
+        self.assertEqual(self.get_scheduler(backend, 100000, throughput, mean_image_megabytes=20)
+                         .get_images_per_job(), 3000)
+
+    def test_learns_download_throughput(self):
+        # downloading the images (4 MB at 10 MB/s) takes twice as long as scoring them
+        backend = SimulatedBackend([5] * 4, image_megabytes=4, node_megabytes_per_second=10)
+        throughput = ThroughputEstimate()
+        scheduler = self.get_scheduler(backend, 10000, throughput, default_images_per_job=1000)
+        scheduler.plan_jobs()
+        scheduler.submit_jobs()
+        backend.run_until_done(scheduler, check_period_seconds=60)
+
+        self.assert_all_images_scored_once(scheduler)
+        self.assertAlmostEqual(throughput.images_per_second, 5)
+        self.assertAlmostEqual(throughput.megabytes_per_second, 10)
+
+        # jobs of large images are sized by the download speed, and of small images by the detector's
+        self.assertEqual(self.get_scheduler(backend, 100000, throughput, mean_image_megabytes=4)
+                         .get_images_per_job(), 1500)
+        self.assertEqual(self.get_scheduler(backend, 100000, throughput, mean_image_megabytes=1)
+                         .get_images_per_job(), 3000)
+
+        # which is about target_job_seconds
+        scheduler = self.get_scheduler(backend, 6000, throughput, mean_image_megabytes=4)
+        scheduler.plan_jobs()
+        start = backend.time()
+        scheduler.submit_jobs()
+        self.assertAlmostEqual(backend.run_until_done(scheduler, check_period_seconds=60) - start, 600)
+
+    def test_failed_jobs(self):
+        backend = SimulatedBackend([10] * 4, failing_job_ids=['requestabc_jobindex2_total8',
+                                                              'requestabc_jobindex8_total8'])
+        scheduler = self.get_scheduler(backend, 8000, ThroughputEstimate(), default_images_per_job=1000)
+        scheduler.plan_jobs()
+        scheduler.submit_jobs()
+        backend.run_until_done(scheduler, check_period_seconds=60)
+
+        # job 2 failed, then the first half of its images failed again, and was split again
+        self.assert_all_images_scored_once(scheduler)
+        superseded = [job_id for job_id, job in scheduler.jobs.items() if job['superseded']]
+        self.assertEqual(superseded, ['requestabc_jobindex2_total8', 'requestabc_jobindex8_total8'])
+        self.assertEqual([job['attempt'] for job in scheduler.jobs.values()][-4:], [2, 2, 3, 3])
+
+    def test_failed_submission(self):
+        backend = SimulatedBackend([10] * 4, failing_job_ids=['requestabc_jobindex2_total8'])
+        scheduler = self.get_scheduler(backend, 8000, ThroughputEstimate(), default_images_per_job=1000)
+        scheduler.plan_jobs()
+        scheduler.submit_jobs()
+
+        submit_job = backend.submit_job
+        num_errors = [0]
+
+        def _submit_job(job_id, begin, end):
+            if job_id == 'requestabc_jobindex8_total8' and num_errors[0] == 0:
+                num_errors[0] += 1
+                raise RuntimeError('submission failed')
+            return submit_job(job_id, begin, end)
+
+        with mock.patch.object(backend, 'submit_job', _submit_job):
+            # job 2 fails, and submitting the first half of its images fails once
+            with self.assertRaises(RuntimeError):
+                while True:
+                    backend.advance(60)
+                    scheduler.check_job_status()
+            # (the other half may not have been submitted either, as the submissions left are
+            # canceled when one raises)
+            self.assertIsNone(scheduler.jobs['requestabc_jobindex8_total8']['run'])
+
+            # the next check submits them
+            backend.run_until_done(scheduler, check_period_seconds=60)
+
+        self.assertEqual(num_errors[0], 1)
+        self.assert_all_images_scored_once(scheduler)
+        self.assertEqual(len(scheduler.get_active_jobs()), 9)
+
+    def test_failed_jobs_max_attempts(self):
+        backend = SimulatedBackend([10] * 2, failing_job_ids=['requestabc_jobindex{}_total2'.format(i)
+                                                              for i in range(4)])
+        scheduler = self.get_scheduler(backend, 1000, ThroughputEstimate(), max_attempts=2)
+        scheduler.plan_jobs()
+        scheduler.submit_jobs()
+        backend.run_until_done(scheduler, check_period_seconds=60)
+
+        # jobs 0 and 1 are split into jobs 2-5, of which jobs 2 and 3 fail again and are given up on
+        statuses = [(job_id, job['status']) for job_id, job in scheduler.get_active_jobs().items()]
+        self.assertEqual(statuses, [('requestabc_jobindex2_total2', 'Failed'),
+                                    ('requestabc_jobindex3_total2', 'Failed'),
+                                    ('requestabc_jobindex4_total2', 'Finished'),
+                                    ('requestabc_jobindex5_total2', 'Finished')])
+
+    def test_stragglers(self):
+        def run(straggler_factor):
+            # one node is 20 times slower than the others
+            backend = SimulatedBackend([10, 10, 10, 0.5])
+            scheduler = self.get_scheduler(backend, 24000, ThroughputEstimate(images_per_second=10),
+                                           straggler_factor=straggler_factor)
+            scheduler.plan_jobs()
+            scheduler.submit_jobs()
+            elapsed = backend.run_until_done(scheduler, check_period_seconds=60)
+            self.assert_all_images_scored_once(scheduler)
+            return scheduler, elapsed
+
+        scheduler, elapsed = run(straggler_factor=2)
+        _, elapsed_without_resubmission = run(straggler_factor=1000)
+
+        # (jobs are submitted concurrently, so any one of them can land on the slow node)
+        self.assertEqual(sum(job['superseded'] for job in scheduler.jobs.values()), 1)
+        self.assertLess(elapsed, elapsed_without_resubmission / 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,8 @@
-import copy
-import io
 import os
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import json
+import random
 
 import azureml.core
 from azure.storage.blob import BlockBlobService, BlobPermissions
@@ -18,6 +17,7 @@ from azureml.pipeline.core.graph import PipelineParameter
 from azureml.pipeline.steps import PythonScriptStep
 
 import api_config
+from result_aggregation import BlobContainer, ResultAggregator
 from sas_blob_utils import SasBlob
 
 print('Version of AML: {}'.format(azureml.core.__version__))
@@ -75,6 +75,32 @@ def spot_check_blob_paths_exist(paths, container_sas, metadata_available):
     return path
 
 
+def estimate_mean_image_megabytes(paths, container_sas, metadata_available, num_samples):
+    ''' Estimate the mean size of the images in paths from the sizes of num_samples of them, for sizing jobs.
+
+    Args:
+        paths: A list of blob paths in the container
+        container_sas: Azure blob storage SAS token to a container where the paths are
+        metadata_available: paths will contain items that are [image_id, metadata] instead of just image_id
+        num_samples: number of blobs to look up
+    Returns:
+        The mean size in megabytes, or None if it could not be estimated
+    '''
+    if len(paths) == 0:
+        return None
+    try:
+        blob_service = SasBlob.get_service_from_uri(container_sas)
+        container_name = SasBlob.get_container_from_uri(container_sas)
+        sizes = []
+        for p in random.sample(paths, min(num_samples, len(paths))):
+            path = p[0] if metadata_available else p
+            sizes.append(blob_service.get_blob_properties(container_name, path).properties.content_length)
+        return sum(sizes) / len(sizes) / 1e6
+    except Exception as e:
+        print('estimate_mean_image_megabytes(), could not look up the image sizes: {}'.format(str(e)))
+        return None
+
+
 def validate_provided_image_paths(image_paths):
     ''' Given a list of image_paths (list length at least 1), validate them and determine if metadata is available.
 
@@ -133,10 +159,12 @@ class AMLCompute:
             internal_dir, output_dir = self._get_data_references(request_id, internal_datastore)
 
             compute_target = self.ws.compute_targets[aml_config['aml_compute_name']]
+            self.compute_target = compute_target
 
             dependencies = CondaDependencies.create(pip_packages=['tensorflow-gpu==1.9.0',
                                                                   'pillow',
                                                                   'numpy',
+                                                                  'requests',
                                                                   'azure',
                                                                   'azure-storage-blob==2.1.0',
                                                                   'azureml-defaults==1.0.41'])
@@ -223,47 +251,62 @@ class AMLCompute:
 
         return internal_dir, output_dir
 
-    def submit_jobs(self, list_jobs, api_task_manager, num_images):
+    def get_num_nodes(self):
+        """Maximum number of nodes of the compute cluster."""
+        try:
+            return self.compute_target.scale_settings.maximum_node_count
+        except Exception as e:
+            print('AMLCompute, get_num_nodes(), could not get the cluster size, using the default: {}'.format(str(e)))
+            return api_config.DEFAULT_NUM_NODES
+
+    # The next four methods are the backend used by job_scheduler.JobScheduler
+
+    def submit_job(self, job_id, begin, end):
+        """Submits a job scoring the images from begin (inclusive) to end (exclusive); returns its pipeline run."""
+        return Experiment(self.ws, job_id).submit(self.pipeline, pipeline_params={
+            'param_job_id': job_id,
+            'param_begin_index': begin,
+            'param_end_index': end,
+            'param_detection_threshold': self.aml_config['param_detection_threshold'],
+        })
+
+    def get_job_status(self, pipeline_run):
+        # common values returned include Running, Completed, and Failed - March 19 apparently Finished is the enumeration
+        return pipeline_run.get_status()
+
+    def get_job_metrics(self, pipeline_run):
+        """Returns the metrics that score.py logged for the job's images and timing, or None if there aren't any."""
+        # there is only one step in the pipeline
+        for step_run in pipeline_run.get_children():
+            metrics = step_run.get_metrics()
+            if 'num_images' in metrics and 'scoring_seconds' in metrics:
+                return {
+                    'num_images': metrics['num_images'],
+                    'scoring_seconds': metrics['scoring_seconds'],
+                    'download_megabytes': metrics.get('download_megabytes'),
+                    'session_run_seconds': metrics.get('session_run_seconds')
+                }
+        return None
+
+    def cancel_job(self, pipeline_run):
+        pipeline_run.cancel()
+
+    def submit_jobs(self, job_scheduler, api_task_manager, num_images):
+        """Submits the jobs planned by job_scheduler, several at a time; returns the jobs."""
         try:
             print('AMLCompute, submit_jobs() called.')
-            list_jobs_active = copy.deepcopy(list_jobs)
-
-            for i, (job_id, job) in enumerate(list_jobs.items()):
-                pipeline_run = Experiment(self.ws, job_id).submit(self.pipeline, pipeline_params={
-                    'param_job_id': job_id,
-                    'param_begin_index': job['begin'],
-                    'param_end_index': job['end'],
-                    'param_detection_threshold': self.aml_config['param_detection_threshold'],
-                })
-                list_jobs_active[job_id]['pipeline_run'] = pipeline_run
-
-                # various attempts at getting the child_run's ID
-                # child_run_id = None
-                # print('pipeline_run:', pipeline_run)
-                # for child_run in pipeline_run.get_children():
-                #     child_run_id = child_run.id  # we can do this because there's only one step in the pipeline - not working
-                #
-                # print('=' * 20)
-                # exp = Experiment(self.ws, job_id)
-                # run = Run(exp, pipeline_run.id)
-                # print('run:', run)
-                # for c in run.get_children():
-                #     print('found run.get_children:')
-                #     print(c.id)
-                #     child_run_id = c.id
-                # print('=' * 20)
-
-                # list_jobs_active[job_id]['step_run_id']  = child_run_id  # this is the ID we can identify the output folder with
-
-                print('Submitted job {}.'.format(job_id))
-
-                if i % api_config.JOB_SUBMISSION_UPDATE_INTERVAL == 0:
+
+            num_jobs = len(job_scheduler.jobs)
+
+            def _report_progress(num_submitted):
+                if num_submitted % api_config.JOB_SUBMISSION_UPDATE_INTERVAL == 0:
                     api_task_manager.UpdateTaskStatus(self.request_id, get_task_status('running',
-                                                                                  '{} images out of total {} submitted for processing.'.format(
-                                                                                      i * api_config.NUM_IMAGES_PER_JOB,
-                                                                                      num_images)))
+                        '{} jobs out of {} for {} images submitted for processing.'.format(
+                            num_submitted, num_jobs, num_images)))
+
+            job_scheduler.submit_jobs(progress_callback=_report_progress)
             print('AMLCompute, submit_jobs() finished.')
-            return list_jobs_active
+            return job_scheduler.get_active_jobs()
         except Exception as e:
             raise RuntimeError('Error in submitting jobs to AML Compute cluster: {}.'.format(str(e)))
 
@@ -271,9 +314,9 @@ class AMLCompute:
 # %% AML Monitor
 
 class AMLMonitor:
-    def __init__(self, request_id, list_jobs_submitted, request_name, request_submission_timestamp, model_version):
+    def __init__(self, request_id, job_scheduler, request_name, request_submission_timestamp, model_version):
         self.request_id = request_id
-        self.jobs_submitted = list_jobs_submitted
+        self.job_scheduler = job_scheduler  # job_scheduler.JobScheduler with the submitted jobs
         self.request_name = request_name  # None if not provided by the user
         self.request_submission_timestamp = request_submission_timestamp  # str
         self.model_version = model_version  # str
@@ -291,31 +334,18 @@ class AMLMonitor:
         self.internal_container = api_config.INTERNAL_CONTAINER
 
     def get_total_jobs(self):
-        return len(self.jobs_submitted)
+        return len(self.job_scheduler.get_active_jobs())
 
     def check_job_status(self):
+        """Polls the jobs (several at a time), resubmitting failed jobs and stragglers; see JobScheduler."""
         print('AMLMonitor, check_job_status() called.')
-        all_jobs_finished = True
-        status_tally = defaultdict(int)
-
-        for job_id, job in self.jobs_submitted.items():
-            pipeline_run = job['pipeline_run']
-            status = pipeline_run.get_status()  # common values returned include Running, Completed, and Failed - March 19 apparently Finished is the enumeration
+        all_jobs_finished, status_tally = self.job_scheduler.check_job_status()
 
-            print('request_id {}, job_id {}, status is {}'.format(self.request_id, job_id, status))
-            status_tally[status] += 1
-
-            if status not in api_config.AML_CONFIG['completed_status']:  # else all_job_finished will not be flipped
-                all_jobs_finished = False
+        for job_id, job in self.job_scheduler.get_active_jobs().items():
+            print('request_id {}, job_id {}, status is {}'.format(self.request_id, job_id, job['status']))
 
         return all_jobs_finished, status_tally
 
-    def _download_read_json(self, blob_path):
-        blob = self.internal_storage_service.get_blob_to_text(self.aml_output_container, blob_path)
-        stream = io.StringIO(blob.content)
-        result = json.load(stream)
-        return result
-
     def _generate_urls_for_outputs(self):
         try:
             request_id = self.request_id
@@ -345,69 +375,58 @@ class AMLMonitor:
                                'Please contact us to retrieve your results. ' +
                                'Error: {}'.format(str(e)))
 
+    def _get_output_prefixes(self):
+        """Returns the folders in the AML output container that this request's jobs wrote to, i.e.
+        azureml/<run ID of the pipeline step>/, or None if they can't all be found.
+        """
+        try:
+            prefixes = []
+            for job_id, job in self.job_scheduler.get_active_jobs().items():
+                step_runs = list(job['run'].get_children())
+                if len(step_runs) == 0:
+                    print('AMLMonitor, _get_output_prefixes(), no step run found for job {}'.format(job_id))
+                    return None
+                prefixes.extend(['azureml/{}/'.format(step_run.id) for step_run in step_runs])
+            return prefixes
+        except Exception as e:
+            print('AMLMonitor, _get_output_prefixes(), exception: {}'.format(str(e)))
+            return None
+
     def aggregate_results(self):
         print('AMLMonitor, aggregate_results() called')
 
-        # The more efficient method is to know the run_id which is the folder name that the result is written to.
-        # Since we can't reliably get the run_id after submitting the run, resort to listing all blobs in the output
-        # container and match by the request_id
-
-        # listing all (up to a large limit) because don't want to worry about generator next_marker
-        datastore_aml_container = copy.deepcopy(self.internal_datastore)
-        datastore_aml_container['container_name'] = self.aml_output_container
-        list_blobs = SasBlob.list_blobs_in_container(api_config.MAX_BLOBS_IN_OUTPUT_CONTAINER,
-                                                     datastore=datastore_aml_container,
-                                                     blob_suffix='.json')
-        all_detections = []
-        failures = []
-        num_aggregated = 0
-        for blob_path in list_blobs:
-            if blob_path.endswith('.json'):
-                # blob_path is azureml/run_id/output_requestID/out_file_name.json
-                out_file_name = blob_path.split('/')[-1]
-                # "request" is part of the AML job_id
-                if out_file_name.startswith('detections_request{}_'.format(self.request_id)):
-                    all_detections.extend(self._download_read_json(blob_path))
-                    num_aggregated += 1
-                    print('Number of results aggregated: ', num_aggregated)
-                elif out_file_name.startswith('failures_request{}_'.format(self.request_id)):
-                    failures.extend(self._download_read_json(blob_path))
-
-        print('aggregate_results(), length of all_detections: {}'.format(len(all_detections)))
-
-        detection_output_content = {
-            'info': {
-                'detector': 'megadetector_v{}'.format(self.model_version),
-                'detection_completion_time': get_utc_time(),
-                'format_version': api_config.OUTPUT_FORMAT_VERSION
-            },
-            'detection_categories': api_config.DETECTION_CATEGORIES,
-            'images': all_detections
-        }
-        # order the json output keys
-        detection_output_content = OrderedDict([
-                                                ('info', detection_output_content['info']),
-                                                ('detection_categories', detection_output_content['detection_categories']),
-                                                ('images', detection_output_content['images'])])
-
-        detection_output_str = json.dumps(detection_output_content, indent=1)
-
-        # upload aggregated results to output_store
-        self.internal_storage_service.create_blob_from_text(self.internal_container,
-                                                            '{}/{}_detections_{}_{}.json'.format(
-                                                                self.request_id, self.request_id,
-                                                                self.request_name, self.request_submission_timestamp),
-                                                            detection_output_str, max_connections=4)
-        print('aggregate_results(), detections uploaded')
-
-        print('aggregate_results(), number of failed images: {}'.format(len(failures)))
-        failures_str = json.dumps(failures, indent=1)
-        self.internal_storage_service.create_blob_from_text(self.internal_container,
-                                                            '{}/{}_failed_images_{}_{}.json'.format(
-                                                                self.request_id, self.request_id,
-                                                                self.request_name, self.request_submission_timestamp),
-                                                            failures_str)
-        print('aggregate_results(), failures uploaded')
+        output_container = BlobContainer(self.internal_storage_service, self.aml_output_container)
+        internal_container = BlobContainer(self.internal_storage_service, self.internal_container)
+        aggregator = ResultAggregator(self.request_id, output_container, internal_container)
+
+        # Only list the folders of this request's runs; if those can't be found, or turn out not to
+        # contain the outputs, resort to listing all blobs in the output container and match by the request_id
+        # Only the outputs of the active jobs are aggregated, not those of jobs that were resubmitted as other jobs
+        prefixes = self._get_output_prefixes()
+        job_ids = list(self.job_scheduler.get_active_jobs().keys())
+        detection_blobs, failure_blobs = aggregator.list_shards(prefixes, job_ids)
+        if prefixes is not None and len(detection_blobs) == 0:
+            print('AMLMonitor, aggregate_results(), no shards found in the runs\' folders')
+            detection_blobs, failure_blobs = aggregator.list_shards(job_ids=job_ids)
+
+        detection_output_info = OrderedDict([
+            ('detector', 'megadetector_v{}'.format(self.model_version)),
+            ('detection_completion_time', get_utc_time()),
+            ('format_version', api_config.OUTPUT_FORMAT_VERSION)
+        ])
+
+        # downloads the shards concurrently and streams them into the two output files, then uploads those
+        num_images, num_failures = aggregator.aggregate(
+            detection_blobs, failure_blobs,
+            detections_blob_name='{}/{}_detections_{}_{}.json'.format(
+                self.request_id, self.request_id, self.request_name, self.request_submission_timestamp),
+            failures_blob_name='{}/{}_failed_images_{}_{}.json'.format(
+                self.request_id, self.request_id, self.request_name, self.request_submission_timestamp),
+            info=detection_output_info,
+            detection_categories=api_config.DETECTION_CATEGORIES)
+
+        print('aggregate_results(), {} shards, {} images and {} failed images aggregated and uploaded'.format(
+            len(detection_blobs), num_images, num_failures))
 
         output_file_urls = self._generate_urls_for_outputs()
         return output_file_urls
@@ -0,0 +1,273 @@
+"""
+Combines the shard outputs that score.py writes to the AML output container (detections_<job_id>.json
+and failures_<job_id>.json for each job) into a request's detections and failed images files.
+
+Shards are downloaded on a pool of threads and appended to the output file one shard at a time, in
+job order, so the memory used doesn't grow with the size of the request: only the shards being
+downloaded or waiting to be written are held in memory. The output files are built on local disk
+and then uploaded.
+
+The containers are accessed through BlobContainer, or through LocalBlobContainer, which stands in
+for a blob container with a local folder (for testing, or for aggregating shards downloaded by hand).
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# number of threads listing and downloading shards
+NUM_DOWNLOAD_WORKERS = 16
+
+# maximum number of shards downloaded or being downloaded ahead of the one being written out
+MAX_SHARDS_IN_MEMORY = 32
+
+
+# %% Containers
+
+class BlobContainer:
+    """
+    The blob operations used by ResultAggregator, on a container of an Azure storage account.
+    """
+
+    def __init__(self, blob_service, container_name):
+        """
+        Args:
+            blob_service: azure.storage.blob.BlockBlobService for the storage account
+            container_name: name of the container
+        """
+        self.blob_service = blob_service
+        self.container_name = container_name
+
+    def list_blob_names(self, prefix=None):
+        """Yields the names of all blobs whose names start with prefix."""
+        marker = None
+        while True:
+            generator = self.blob_service.list_blobs(self.container_name, prefix=prefix, num_results=5000,
+                                                     marker=marker)
+            for blob in generator:
+                yield blob.name
+            marker = generator.next_marker
+            if not marker:
+                return
+
+    def get_blob_bytes(self, blob_name):
+        return self.blob_service.get_blob_to_bytes(self.container_name, blob_name).content
+
+    def upload_file(self, blob_name, file_path):
+        self.blob_service.create_blob_from_path(self.container_name, blob_name, file_path, max_connections=4)
+
+
+class LocalBlobContainer:
+    """
+    Stands in for a BlobContainer with a local folder; blob names are paths relative to root_dir,
+    with forward slashes.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def list_blob_names(self, prefix=None):
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for file_name in file_names:
+                blob_name = os.path.relpath(os.path.join(dir_path, file_name), self.root_dir).replace(os.sep, '/')
+                if prefix is None or blob_name.startswith(prefix):
+                    yield blob_name
+
+    def get_blob_bytes(self, blob_name):
+        with open(os.path.join(self.root_dir, blob_name), 'rb') as f:
+            return f.read()
+
+    def upload_file(self, blob_name, file_path):
+        blob_path = os.path.join(self.root_dir, blob_name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        shutil.copyfile(file_path, blob_path)
+
+
+# %% Streaming json output
+
+def _write_json_list(f, chunks, depth):
+    """
+    Writes the items in the lists in the iterable chunks as one json list that starts at nesting
+    level depth of a document, formatted as json.dump(..., indent=1) would. Returns the number of
+    items written.
+    """
+    encoder = json.JSONEncoder(indent=1)
+    indent = ' ' * depth
+    n_items = 0
+    f.write('[')
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        # encoding a whole chunk at once is much faster than item by item; strip its '[\n' and '\n]'
+        # and indent it to depth
+        f.write(',\n' if n_items > 0 else '\n')
+        f.write(indent + encoder.encode(chunk)[2:-2].replace('\n', '\n' + indent))
+        n_items += len(chunk)
+    if n_items > 0:
+        f.write('\n' + indent)
+    f.write(']')
+    return n_items
+
+
+def write_detection_output(f, info, detection_categories, image_chunks):
+    """
+    Writes a batch processing API output file to the open text file f, with the detection entries
+    taken from the iterable of lists image_chunks, one list at a time. The result is the same as
+    json.dump() with indent=1 of the whole output. Returns the number of images written.
+    """
+    # everything but the images, ending with '"images": []\n}'
+    header = json.dumps(OrderedDict([('info', info),
+                                     ('detection_categories', detection_categories),
+                                     ('images', [])]), indent=1)
+    assert header.endswith('[]\n}')
+    f.write(header[:-len('[]\n}')])
+    n_images = _write_json_list(f, image_chunks, depth=1)
+    f.write('\n}')
+    return n_images
+
+
+def write_json_list(f, chunks):
+    """
+    Writes the items in the lists in the iterable chunks to the open text file f as json.dump() with
+    indent=1 of one list would. Returns the number of items written.
+    """
+    return _write_json_list(f, chunks, depth=0)
+
+
+# %% Aggregation
+
+def get_job_index(blob_name):
+    """Returns the job index in the name of a shard output, e.g. 12 for .../detections_request<id>_jobindex12_total20.json"""
+    match = re.search(r'_jobindex(\d+)', blob_name.split('/')[-1])
+    return int(match.group(1)) if match else -1
+
+
+class ResultAggregator:
+    """
+    Combines the shard outputs of one request; see the module docstring.
+    """
+
+    def __init__(self, request_id, output_container, destination_container,
+                 num_workers=NUM_DOWNLOAD_WORKERS, max_shards_in_memory=MAX_SHARDS_IN_MEMORY):
+        """
+        Args:
+            request_id: str, the request's ID
+            output_container: BlobContainer (or LocalBlobContainer) that score.py writes the shards to
+            destination_container: BlobContainer (or LocalBlobContainer) to upload the combined files to
+            num_workers: number of threads listing and downloading shards
+            max_shards_in_memory: maximum number of shards downloaded ahead of the one being written
+        """
+        self.request_id = request_id
+        self.output_container = output_container
+        self.destination_container = destination_container
+        self.num_workers = num_workers
+        self.max_shards_in_memory = max(max_shards_in_memory, num_workers)
+
+    def list_shards(self, prefixes=None, job_ids=None):
+        """
+        Lists the shard outputs of this request under each of prefixes, e.g. the folders of the
+        request's AML runs, in parallel; the whole container is listed if prefixes is None. If
+        job_ids is given, only the outputs of those jobs are returned.
+
+        Returns:
+            detection_blobs, failure_blobs: lists of blob names, sorted by job index
+        """
+        if prefixes is None:
+            prefixes = [None]
+
+        # "request" is part of the AML job_id
+        detections_start = 'detections_request{}_'.format(self.request_id)
+        failures_start = 'failures_request{}_'.format(self.request_id)
+
+        if job_ids is not None:
+            job_ids = set(job_ids)
+
+        detection_blobs, failure_blobs = set(), set()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for blob_names in executor.map(lambda p: list(self.output_container.list_blob_names(p)), prefixes):
+                for blob_name in blob_names:
+                    # blob_name is azureml/run_id/output_requestID/out_file_name.json
+                    out_file_name = blob_name.split('/')[-1]
+                    if not out_file_name.endswith('.json'):
+                        continue
+                    if job_ids is not None and out_file_name.split('_', 1)[1][:-len('.json')] not in job_ids:
+                        continue
+                    if out_file_name.startswith(detections_start):
+                        detection_blobs.add(blob_name)
+                    elif out_file_name.startswith(failures_start):
+                        failure_blobs.add(blob_name)
+
+        def _sort_key(blob_name):
+            return get_job_index(blob_name), blob_name
+
+        return sorted(detection_blobs, key=_sort_key), sorted(failure_blobs, key=_sort_key)
+
+    def iterate_shards(self, blob_names):
+        """
+        Yields the json lists in blob_names, in order, downloading up to
+        max_shards_in_memory shards ahead on num_workers threads.
+        """
+        pending = deque()
+        blob_names = iter(blob_names)
+
+        def _download(blob_name):
+            return json.loads(self.output_container.get_blob_bytes(blob_name).decode('utf-8'))
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            while True:
+                while len(pending) < self.max_shards_in_memory:
+                    blob_name = next(blob_names, None)
+                    if blob_name is None:
+                        break
+                    pending.append((blob_name, executor.submit(_download, blob_name)))
+
+                if len(pending) == 0:
+                    break
+
+                blob_name, future = pending.popleft()
+                shard = future.result()
+                assert isinstance(shard, list), 'Shard output {} is not a list'.format(blob_name)
+                yield shard
+
+    def aggregate(self, detection_blobs, failure_blobs, detections_blob_name, failures_blob_name,
+                  info, detection_categories):
+        """
+        Writes the request's detections and failed images files from the shards in detection_blobs
+        and failure_blobs (see list_shards()) and uploads them to the destination container under
+        detections_blob_name and failures_blob_name.
+
+        Args:
+            detection_blobs, failure_blobs: names of the shard outputs in the output container
+            detections_blob_name, failures_blob_name: names of the blobs to upload to
+            info, detection_categories: the 'info' and 'detection_categories' fields of the output
+
+        Returns:
+            number of images, number of failed images
+        """
+        print('ResultAggregator, found {} detection and {} failure shards for request {}'.format(
+            len(detection_blobs), len(failure_blobs), self.request_id))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            detections_path = os.path.join(temp_dir, 'detections.json')
+            with open(detections_path, 'w') as f:
+                n_images = write_detection_output(f, info, detection_categories,
+                                                  self.iterate_shards(detection_blobs))
+            print('ResultAggregator, {} images aggregated'.format(n_images))
+
+            failures_path = os.path.join(temp_dir, 'failures.json')
+            with open(failures_path, 'w') as f:
+                n_failures = write_json_list(f, self.iterate_shards(failure_blobs))
+            print('ResultAggregator, {} failed images aggregated'.format(n_failures))
+
+            self.destination_container.upload_file(detections_blob_name, detections_path)
+            self.destination_container.upload_file(failures_blob_name, failures_path)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        return n_images, n_failures
@@ -0,0 +1,129 @@
+"""
+Tests for ResultAggregator, with local folders standing in for the AML output container and the
+internal container.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+from result_aggregation import LocalBlobContainer, ResultAggregator
+
+
+class CountingBlobContainer(LocalBlobContainer):
+    """
+    Counts the shards downloaded.
+    """
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.lock = threading.Lock()
+        self.n_downloaded = 0
+
+    def get_blob_bytes(self, blob_name):
+        with self.lock:
+            self.n_downloaded += 1
+        return super().get_blob_bytes(blob_name)
+
+
+class ResultAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.temp_dir, 'aml-out')
+        self.internal_dir = os.path.join(self.temp_dir, 'async-api')
+
+        self.detections = []
+        self.failures = []
+        for job_index in range(25):
+            for request_id in ['abc', 'abcd']:
+                shard_dir = os.path.join(self.output_dir, 'azureml', 'run_{}_{}'.format(request_id, job_index),
+                                         'output_{}'.format(request_id))
+                os.makedirs(shard_dir)
+                # job IDs as in runserver.py
+                job_id = 'request{}_jobindex{}_total25'.format(request_id, job_index)
+                detections = [{'file': '{}/IMG_{:04d}.JPG'.format(job_id, i), 'max_detection_conf': 0.5,
+                               'detections': [{'category': '1', 'conf': 0.5, 'bbox': [0.1, 0.2, 0.3, 0.4]}]
+                               if i % 2 else []} for i in range(7)]
+                failures = ['{}/IMG_{:04d}.JPG'.format(job_id, i) for i in range(job_index % 3)]
+                with open(os.path.join(shard_dir, 'detections_{}.json'.format(job_id)), 'w') as f:
+                    json.dump(detections, f, indent=1)
+                with open(os.path.join(shard_dir, 'failures_{}.json'.format(job_id)), 'w') as f:
+                    json.dump(failures, f, indent=1)
+                if request_id == 'abc':
+                    self.detections.extend(detections)
+                    self.failures.extend(failures)
+
+        self.info = OrderedDict([('detector', 'megadetector_v3'), ('detection_completion_time', '2019-05-19 08:57:43'),
+                                 ('format_version', '1.0')])
+        self.detection_categories = {'1': 'animal', '2': 'person'}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def aggregate(self, aggregator, prefixes=None):
+        detection_blobs, failure_blobs = aggregator.list_shards(prefixes)
+        n_images, n_failures = aggregator.aggregate(detection_blobs, failure_blobs,
+                                                    'abc/abc_detections.json', 'abc/abc_failed_images.json',
+                                                    self.info, self.detection_categories)
+        with open(os.path.join(self.internal_dir, 'abc', 'abc_detections.json')) as f:
+            detections_text = f.read()
+        with open(os.path.join(self.internal_dir, 'abc', 'abc_failed_images.json')) as f:
+            failures_text = f.read()
+        return detection_blobs, n_images, n_failures, detections_text, failures_text
+
+    def test_aggregate(self):
+        output_container = CountingBlobContainer(self.output_dir)
+        aggregator = ResultAggregator('abc', output_container, LocalBlobContainer(self.internal_dir),
+                                      num_workers=3, max_shards_in_memory=4)
+        detection_blobs, n_images, n_failures, detections_text, failures_text = self.aggregate(aggregator)
+
+        # in job order, not in the order of the names
+        self.assertEqual(len(detection_blobs), 25)
+        self.assertTrue(detection_blobs[2].endswith('/detections_requestabc_jobindex2_total25.json'))
+        self.assertTrue(detection_blobs[10].endswith('/detections_requestabc_jobindex10_total25.json'))
+
+        # the same as dumping the whole output at once
+        self.assertEqual(n_images, 25 * 7)
+        self.assertEqual(detections_text, json.dumps(OrderedDict([
+            ('info', self.info), ('detection_categories', self.detection_categories),
+            ('images', self.detections)]), indent=1))
+        self.assertEqual(n_failures, len(self.failures))
+        self.assertEqual(failures_text, json.dumps(self.failures, indent=1))
+        self.assertEqual(output_container.n_downloaded, 50)
+
+    def test_prefixes(self):
+        aggregator = ResultAggregator('abc', LocalBlobContainer(self.output_dir),
+                                      LocalBlobContainer(self.internal_dir))
+        prefixes = ['azureml/run_abc_{}/'.format(job_index) for job_index in [3, 1]]
+        detection_blobs, n_images, _, detections_text, failures_text = self.aggregate(aggregator, prefixes)
+        self.assertEqual(len(detection_blobs), 2)
+        self.assertEqual([d['file'] for d in json.loads(detections_text)['images']][::7],
+                         ['requestabc_jobindex1_total25/IMG_0000.JPG', 'requestabc_jobindex3_total25/IMG_0000.JPG'])
+        self.assertEqual(json.loads(failures_text), ['requestabc_jobindex1_total25/IMG_0000.JPG'])
+
+    def test_job_ids(self):
+        aggregator = ResultAggregator('abc', LocalBlobContainer(self.output_dir),
+                                      LocalBlobContainer(self.internal_dir))
+        detection_blobs, failure_blobs = aggregator.list_shards(
+            job_ids=['requestabc_jobindex{}_total25'.format(job_index) for job_index in [12, 4]])
+        self.assertEqual([blob_name.split('/')[-1] for blob_name in detection_blobs],
+                         ['detections_requestabc_jobindex4_total25.json', 'detections_requestabc_jobindex12_total25.json'])
+        self.assertEqual(len(failure_blobs), 2)
+
+    def test_no_shards(self):
+        aggregator = ResultAggregator('xyz', LocalBlobContainer(self.output_dir),
+                                      LocalBlobContainer(self.internal_dir))
+        _, n_images, n_failures, detections_text, failures_text = self.aggregate(aggregator)
+        self.assertEqual((n_images, n_failures), (0, 0))
+        self.assertEqual(detections_text, json.dumps(OrderedDict([
+            ('info', self.info), ('detection_categories', self.detection_categories), ('images', [])]), indent=1))
+        self.assertEqual(failures_text, '[]')
+
+
+if __name__ == '__main__':
+    unittest.main()
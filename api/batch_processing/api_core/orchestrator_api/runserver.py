@@ -3,7 +3,6 @@
 # ai4e_api_tools has been added to the PYTHONPATH, so we can reference those
 # libraries directly.
 import json
-import math
 import os
 import time
 from datetime import datetime
@@ -19,6 +18,7 @@ from flask_restful import Api
 from task_management.api_task import ApiTaskManager
 
 import api_config
+import job_scheduler
 import orchestrator
 from orchestrator import get_task_status
 from sas_blob_utils import SasBlob  # file in this directory, not the ai4eutil repo one
@@ -56,6 +56,10 @@ internal_datastore = {
 }
 print('Internal storage container {} in account {} is set up.'.format(internal_container, storage_account_name))
 
+# Throughput of one AML node, measured from the jobs of past requests in this process and used to size
+# the jobs of new requests
+node_throughput = job_scheduler.ThroughputEstimate()
+
 
 @app.route('/', methods=['GET'])
 def health_check():
@@ -269,16 +273,25 @@ def _request_detections(**kwargs):
                                               internal_datastore=internal_datastore, model_name=model_name)
         print('AMLCompute resource connected successfully.')
 
-        num_images_per_job = api_config.NUM_IMAGES_PER_JOB
-        num_jobs = math.ceil(num_images / num_images_per_job)
-
-        list_jobs = {}
-        for job_index in range(num_jobs):
-            begin, end = job_index * num_images_per_job, (job_index + 1) * num_images_per_job
-            job_id = 'request{}_jobindex{}_total{}'.format(request_id, job_index, num_jobs)
-            list_jobs[job_id] = {'begin': begin, 'end': end}
-
-        list_jobs_submitted = aml_compute.submit_jobs(list_jobs, api_task_manager, num_images)
+        # size the jobs from the measured throughput and the size of the images
+        mean_image_megabytes = None
+        if not use_url:
+            mean_image_megabytes = orchestrator.estimate_mean_image_megabytes(
+                image_paths, input_container_sas, metadata_available, api_config.NUM_IMAGES_TO_SAMPLE_FOR_SIZE)
+
+        scheduler = job_scheduler.JobScheduler(aml_compute, request_id, num_images, node_throughput,
+                                               mean_image_megabytes=mean_image_megabytes,
+                                               num_nodes=aml_compute.get_num_nodes(),
+                                               default_images_per_job=api_config.NUM_IMAGES_PER_JOB,
+                                               target_job_seconds=api_config.TARGET_JOB_MINUTES * 60,
+                                               min_images_per_job=api_config.MIN_IMAGES_PER_JOB,
+                                               max_images_per_job=api_config.MAX_IMAGES_PER_JOB,
+                                               max_attempts=api_config.MAX_JOB_ATTEMPTS,
+                                               straggler_factor=api_config.STRAGGLER_FACTOR,
+                                               max_concurrent_requests=api_config.MAX_CONCURRENT_AML_REQUESTS)
+        scheduler.plan_jobs()
+
+        aml_compute.submit_jobs(scheduler, api_task_manager, num_images)
         api_task_manager.UpdateTaskStatus(request_id,
                                           get_task_status('running',
                                                           'All {} images submitted to cluster for processing.'.format(
@@ -293,7 +306,7 @@ def _request_detections(**kwargs):
         return  # do not initiate _monitor_detections_request
 
     try:
-        aml_monitor = orchestrator.AMLMonitor(request_id=request_id, list_jobs_submitted=list_jobs_submitted,
+        aml_monitor = orchestrator.AMLMonitor(request_id=request_id, job_scheduler=scheduler,
                                               request_name=request_name,
                                               request_submission_timestamp=request_submission_timestamp,
                                               model_version=model_version)
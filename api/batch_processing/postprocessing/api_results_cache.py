@@ -0,0 +1,317 @@
+#
+# api_results_cache.py
+#
+# Opt-in sidecar cache of parsed batch processing API output files.
+#
+# Parsing a multi-GB API output .json takes minutes, and every postprocessing step parses
+# the same file again. The first time a file is loaded with the cache enabled, its contents
+# are also written in a columnar binary form to a folder next to it ([file].parsed), as .npy
+# arrays that are memory-mapped when loaded. Later loads use the sidecar as long as the size,
+# modification time and sha256 of the .json still match the ones recorded in it.
+#
+# The sidecar reproduces the parsed .json exactly, including key order and ints vs. floats.
+# Detections are stored as columns (category, conf, bbox); image entries or detections with
+# other fields (e.g. classifications) are stored as json strings instead.
+#
+
+#%% Constants and imports
+
+import gc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+SIDECAR_SUFFIX = '.parsed'
+SIDECAR_FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = 'manifest.json'
+
+# Separates the strings in the string blobs; strings containing it are not stored in blobs
+STRING_SEPARATOR = '\0'
+
+DETECTION_KEYS = ['category', 'conf', 'bbox']
+
+# Image fields stored as columns; other fields are stored as json
+COLUMNAR_IMAGE_KEYS = ['file', 'max_detection_conf', 'detections']
+
+
+#%% Support functions
+
+def get_sidecar_dir(api_output_path):
+    return api_output_path + SIDECAR_SUFFIX
+
+
+def get_source_key(api_output_path, chunk_size=16 * 1024 * 1024):
+    """
+    Returns the size, modification time and sha256 of api_output_path.
+    """
+
+    h = hashlib.sha256()
+    with open(api_output_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    st = os.stat(api_output_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': h.hexdigest()}
+
+
+def _is_number(v):
+    return type(v) is float or type(v) is int
+
+
+def _is_columnar_detection(d):
+    return type(d) is dict and list(d.keys()) == DETECTION_KEYS and type(d['category']) is str and \
+        STRING_SEPARATOR not in d['category'] and _is_number(d['conf']) and \
+        type(d['bbox']) is list and len(d['bbox']) == 4 and all(_is_number(v) for v in d['bbox'])
+
+
+def _is_columnar_image(image):
+    if type(image) is not dict or type(image.get('file')) is not str or STRING_SEPARATOR in image['file']:
+        return False
+    if 'max_detection_conf' in image and not _is_number(image['max_detection_conf']):
+        return False
+    if 'detections' in image and not (type(image['detections']) is list and
+                                      all(_is_columnar_detection(d) for d in image['detections'])):
+        return False
+    return True
+
+
+def _encode_strings(strings):
+    return np.frombuffer(STRING_SEPARATOR.join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode_strings(blob, n):
+    if n == 0:
+        return []
+    return bytes(blob).decode('utf-8').split(STRING_SEPARATOR)
+
+
+def _restore_ints(values, is_int):
+    """Converts the elements of the (nested) list values where is_int is True back to int."""
+    if values and type(values[0]) is list:
+        for i, j in zip(*np.nonzero(is_int)):
+            values[i][j] = int(values[i][j])
+    else:
+        for i in np.flatnonzero(is_int):
+            values[i] = int(values[i])
+    return values
+
+
+#%% Writing
+
+def write_sidecar(api_output_path, data, source_key=None):
+    """
+    Writes the parsed contents *data* of api_output_path to its sidecar folder, replacing
+    an existing one.
+    """
+
+    if source_key is None:
+        source_key = get_source_key(api_output_path)
+
+    images = data['images']
+    is_columnar = np.fromiter((_is_columnar_image(image) for image in images), dtype=bool, count=len(images))
+    columnar_images = [image for image, b in zip(images, is_columnar) if b]
+    raw_images = [image for image, b in zip(images, is_columnar) if not b]
+
+    # Key orders of the columnar images, and their fields that aren't stored as columns
+    layouts, layout_to_index = [], {}
+    layout_index = np.zeros(len(columnar_images), dtype=np.int32)
+    extras = []
+    for i_image, image in enumerate(columnar_images):
+        layout = tuple(image.keys())
+        if layout not in layout_to_index:
+            layout_to_index[layout] = len(layouts)
+            layouts.append(list(layout))
+        layout_index[i_image] = layout_to_index[layout]
+        extra = {k: v for k, v in image.items() if k not in COLUMNAR_IMAGE_KEYS}
+        extras.append(json.dumps(extra) if len(extra) > 0 else '')
+
+    max_detection_conf = [image.get('max_detection_conf', 0.0) for image in columnar_images]
+    n_detections_per_image = [len(image.get('detections', [])) for image in columnar_images]
+    detections = [d for image in columnar_images for d in image.get('detections', [])]
+
+    categories, category_to_index = [], {}
+    for d in detections:
+        if d['category'] not in category_to_index:
+            category_to_index[d['category']] = len(categories)
+            categories.append(d['category'])
+
+    conf = [d['conf'] for d in detections]
+    bbox = [v for d in detections for v in d['bbox']]
+
+    arrays = {
+        'image_is_columnar': is_columnar,
+        'layout_index': layout_index,
+        'file_blob': _encode_strings([image['file'] for image in columnar_images]),
+        'extra_blob': _encode_strings(extras),
+        'raw_image_blob': _encode_strings([json.dumps(image) for image in raw_images]),
+        'max_detection_conf': np.array(max_detection_conf, dtype=np.float64),
+        'max_detection_conf_is_int': np.array([type(v) is int for v in max_detection_conf], dtype=bool),
+        'detection_offsets': np.concatenate([[0], np.cumsum(n_detections_per_image, dtype=np.int64)]),
+        'category_index': np.array([category_to_index[d['category']] for d in detections], dtype=np.int32),
+        'conf': np.array(conf, dtype=np.float64),
+        'conf_is_int': np.array([type(v) is int for v in conf], dtype=bool),
+        'bbox': np.array(bbox, dtype=np.float64).reshape(-1, 4),
+        'bbox_is_int': np.array([type(v) is int for v in bbox], dtype=bool).reshape(-1, 4)
+    }
+
+    manifest = {
+        'format_version': SIDECAR_FORMAT_VERSION,
+        'source': source_key,
+        'n_images': len(images),
+        'n_columnar_images': len(columnar_images),
+        'n_detections': len(detections),
+        'categories': categories,
+        'layouts': layouts,
+        'keys': list(data.keys()),
+        'other_fields': {k: v for k, v in data.items() if k != 'images'}
+    }
+
+    # Write to a temporary folder first, so a partially written sidecar is never used
+    sidecar_dir = get_sidecar_dir(api_output_path)
+    temp_dir = tempfile.mkdtemp(prefix=os.path.basename(sidecar_dir) + '.',
+                                dir=os.path.dirname(os.path.abspath(sidecar_dir)))
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array)
+        with open(os.path.join(temp_dir, MANIFEST_FILE_NAME), 'w') as f:
+            json.dump(manifest, f)
+        if os.path.isdir(sidecar_dir):
+            shutil.rmtree(sidecar_dir)
+        os.rename(temp_dir, sidecar_dir)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+
+#%% Reading
+
+def read_manifest(api_output_path):
+    """
+    Returns the manifest of the sidecar of api_output_path, or None if there is no
+    sidecar or it doesn't match the current contents of api_output_path.
+    """
+
+    manifest_path = os.path.join(get_sidecar_dir(api_output_path), MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != SIDECAR_FORMAT_VERSION:
+        return None
+
+    # Check the cheap parts of the key before hashing the file
+    st = os.stat(api_output_path)
+    source = manifest['source']
+    if st.st_size != source['size'] or st.st_mtime_ns != source['mtime_ns']:
+        return None
+    if get_source_key(api_output_path)['sha256'] != source['sha256']:
+        return None
+    return manifest
+
+
+def read_sidecar(api_output_path, manifest=None):
+    """
+    Returns the parsed contents of api_output_path from its sidecar, or None if there is
+    no valid sidecar.
+    """
+
+    if manifest is None:
+        manifest = read_manifest(api_output_path)
+        if manifest is None:
+            return None
+
+    # Millions of dicts and lists are created below, none of them in reference cycles; 
+    # without this, most of the time would be spent in garbage collection passes
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _read_sidecar(api_output_path, manifest)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _read_sidecar(api_output_path, manifest):
+
+    sidecar_dir = get_sidecar_dir(api_output_path)
+
+    def _load(name):
+        return np.load(os.path.join(sidecar_dir, name + '.npy'), mmap_mode='r')
+
+    n_columnar_images = manifest['n_columnar_images']
+    n_detections = manifest['n_detections']
+
+    # All detections of the columnar images, in order
+    categories = manifest['categories']
+    category = [categories[i] for i in _load('category_index').tolist()]
+    conf = _restore_ints(_load('conf').tolist(), _load('conf_is_int'))
+    bbox = _restore_ints(_load('bbox').tolist(), _load('bbox_is_int'))
+    detections = [{'category': c, 'conf': p, 'bbox': b} for c, p, b in zip(category, conf, bbox)]
+    assert len(detections) == n_detections
+
+    files = _decode_strings(_load('file_blob'), n_columnar_images)
+    extras = _decode_strings(_load('extra_blob'), n_columnar_images)
+    max_detection_conf = _restore_ints(_load('max_detection_conf').tolist(), _load('max_detection_conf_is_int'))
+    detection_offsets = _load('detection_offsets').tolist()
+    layouts = manifest['layouts']
+    layout_index = _load('layout_index').tolist()
+
+    columnar_images = []
+    for i_image in range(n_columnar_images):
+        layout = layouts[layout_index[i_image]]
+        if layout == COLUMNAR_IMAGE_KEYS:
+            columnar_images.append({
+                'file': files[i_image],
+                'max_detection_conf': max_detection_conf[i_image],
+                'detections': detections[detection_offsets[i_image]:detection_offsets[i_image + 1]]})
+            continue
+        values = json.loads(extras[i_image]) if len(extras[i_image]) > 0 else {}
+        values['file'] = files[i_image]
+        values['max_detection_conf'] = max_detection_conf[i_image]
+        values['detections'] = detections[detection_offsets[i_image]:detection_offsets[i_image + 1]]
+        columnar_images.append({k: values[k] for k in layout})
+
+    n_raw_images = manifest['n_images'] - n_columnar_images
+    raw_images = [json.loads(s) for s in _decode_strings(_load('raw_image_blob'), n_raw_images)]
+
+    # Merge the columnar and other images back into their original order
+    image_is_columnar = _load('image_is_columnar')
+    if n_raw_images == 0:
+        images = columnar_images
+    else:
+        images = [None] * manifest['n_images']
+        for i_image, image in zip(np.flatnonzero(image_is_columnar).tolist(), columnar_images):
+            images[i_image] = image
+        for i_image, image in zip(np.flatnonzero(~np.asarray(image_is_columnar)).tolist(), raw_images):
+            images[i_image] = image
+
+    return {k: (images if k == 'images' else manifest['other_fields'][k]) for k in manifest['keys']}
+
+
+def load_with_sidecar(api_output_path, load_json):
+    """
+    Returns the parsed contents of api_output_path, from its sidecar if there is a valid one;
+    otherwise parses it with load_json(api_output_path) and writes the sidecar.
+    """
+
+    data = read_sidecar(api_output_path)
+    if data is not None:
+        print('Loaded parsed results from {}'.format(get_sidecar_dir(api_output_path)))
+        return data
+
+    source_key = get_source_key(api_output_path)
+    data = load_json(api_output_path)
+
+    # Don't write a sidecar if the file changed while it was being read
+    st = os.stat(api_output_path)
+    if st.st_size != source_key['size'] or st.st_mtime_ns != source_key['mtime_ns']:
+        return data
+    try:
+        write_sidecar(api_output_path, data, source_key)
+        print('Wrote parsed results to {}'.format(get_sidecar_dir(api_output_path)))
+    except OSError as e:
+        print('Warning: could not write parsed results to {}: {}'.format(get_sidecar_dir(api_output_path), e))
+    return data
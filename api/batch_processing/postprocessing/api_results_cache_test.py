@@ -0,0 +1,103 @@
+"""
+Tests for api_results_cache: the sidecar has to reproduce the parsed .json exactly, and must
+not be used once the .json has changed.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from api.batch_processing.postprocessing import api_results_cache
+from api.batch_processing.postprocessing.load_api_results import load_api_results, load_api_results_json
+
+
+def make_api_output():
+    images = []
+    for i_image in range(50):
+        detections = [{'category': str(1 + (i_image + i_detection) % 3), 'conf': 0.5 + 0.007 * i_image,
+                       'bbox': [0, 0.1 * i_detection, 0.25, 1]}
+                      for i_detection in range(i_image % 4)]
+        images.append({'file': 'site{}/IMG_{:04d}.JPG'.format(i_image % 3, i_image),
+                       'max_detection_conf': max([d['conf'] for d in detections], default=0),
+                       'detections': detections})
+
+    # Entries that aren't (only) stored as columns
+    images[3]['failure'] = None
+    images[4] = {'file': 'site1/IMG_0004.JPG', 'failure': 'Failed to load image'}
+    images[5]['detections'][0]['classifications'] = [['3', 0.9], ['7', 0.05]]
+    images[6] = {'detections': images[6]['detections'], 'file': 'site0/été/IMG_0006.JPG',
+                 'max_detection_conf': images[6]['max_detection_conf'], 'meta': {'frame': 2}}
+
+    return {'info': {'format_version': '1.0', 'detector': 'md_v4.1.0.pb'},
+            'detection_categories': {'1': 'animal', '2': 'person', '3': 'vehicle'},
+            'images': images,
+            'classification_categories': {'3': 'deer', '7': 'elk'}}
+
+
+class ApiResultsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.api_output_path = os.path.join(self.temp_dir, 'results.json')
+        self.write_api_output(make_api_output())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_api_output(self, data):
+        with open(self.api_output_path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+    def test_sidecar_reproduces_json(self):
+        with open(self.api_output_path) as f:
+            expected = json.load(f)
+
+        self.assertIsNone(api_results_cache.read_sidecar(self.api_output_path))
+        self.assertEqual(json.dumps(load_api_results_json(self.api_output_path, use_cache=True)),
+                         json.dumps(expected))
+        self.assertTrue(os.path.isdir(api_results_cache.get_sidecar_dir(self.api_output_path)))
+
+        data = api_results_cache.read_sidecar(self.api_output_path)
+        self.assertEqual(json.dumps(data), json.dumps(expected))
+        self.assertEqual(data, expected)
+
+        detection_results, other_fields = load_api_results(self.api_output_path, use_cache=True)
+        expected_results, expected_other_fields = load_api_results(self.api_output_path)
+        self.assertTrue(detection_results.equals(expected_results))
+        self.assertEqual(other_fields, expected_other_fields)
+
+    def test_sidecar_is_invalidated(self):
+        load_api_results_json(self.api_output_path, use_cache=True)
+        self.assertIsNotNone(api_results_cache.read_sidecar(self.api_output_path))
+
+        # Same size and modification time, different contents
+        st = os.stat(self.api_output_path)
+        with open(self.api_output_path, 'r+') as f:
+            s = f.read()
+            f.seek(0)
+            f.write(s.replace('IMG_0001', 'IMG_0009'))
+        os.utime(self.api_output_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertIsNone(api_results_cache.read_sidecar(self.api_output_path))
+
+        data = load_api_results_json(self.api_output_path, use_cache=True)
+        self.assertEqual(data['images'][1]['file'], 'site1/IMG_0009.JPG')
+        self.assertEqual(api_results_cache.read_sidecar(self.api_output_path), data)
+
+        # Different size
+        data['images'] = data['images'][:10]
+        self.write_api_output(data)
+        self.assertIsNone(api_results_cache.read_sidecar(self.api_output_path))
+        self.assertEqual(len(load_api_results_json(self.api_output_path, use_cache=True)['images']), 10)
+
+    def test_empty_images(self):
+        data = make_api_output()
+        data['images'] = []
+        self.write_api_output(data)
+        load_api_results_json(self.api_output_path, use_cache=True)
+        self.assertEqual(api_results_cache.read_sidecar(self.api_output_path), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
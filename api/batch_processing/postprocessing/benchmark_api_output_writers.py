@@ -0,0 +1,161 @@
+########
+#
+# benchmark_api_output_writers.py
+#
+# Compares wall time and peak memory of writing a synthetic API output file with the
+# previous in-memory writers and with the streaming writers:
+#
+# - "results": json.dump of the whole output dict (what run_tf_detector_batch's
+#   write_results_to_file used to do) vs. ct_utils.write_json_streaming
+#
+# - "table": DataFrame.to_json -> json.loads -> json.dump (what load_api_results'
+#   write_api_results used to do) vs. the current write_api_results
+#
+# Each measurement runs in a fresh process; "peak RSS increase" is how much the
+# process' peak resident set size grew while writing, on top of the input data.
+# Uses the resource module, so only runs on Linux/macOS.
+#
+# Command-line use:
+#
+# python benchmark_api_output_writers.py --n_images 1000000 --output_dir /tmp
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+import pandas as pd
+
+from api.batch_processing.postprocessing.load_api_results import write_api_results
+from ct_utils import write_json_streaming
+
+
+#%% Synthetic data
+
+def make_synthetic_results(n_images, seed=0):
+    """
+    Creates a list of n_images result entries in the API output format, with 0-3
+    detections per image and an occasional failure.
+    """
+
+    rng = random.Random(seed)
+    results = []
+    for i_image in range(n_images):
+        fn = 'camera_{}/IMG_{:07d}.JPG'.format(i_image % 100, i_image)
+        if i_image % 1000 == 0:
+            results.append({'file': fn, 'failure': 'Failure image access'})
+            continue
+        detections = []
+        for _ in range(rng.randint(0, 3)):
+            detections.append({
+                'category': rng.choice(['1', '2', '4']),
+                'conf': round(rng.random(), 3),
+                'bbox': [round(rng.random(), 4) for _ in range(4)]
+            })
+        max_detection_conf = max([d['conf'] for d in detections], default=0.0)
+        results.append({'file': fn, 'max_detection_conf': max_detection_conf, 'detections': detections})
+    return results
+
+
+#%% Writers
+
+other_fields = {
+    'info': {'detection_completion_time': '2020-01-01 00:00:00', 'format_version': '1.0'},
+    'detection_categories': {'1': 'animal', '2': 'person', '4': 'vehicle'}
+}
+
+
+def write_results_before(results, output_file):
+    final_output = dict(other_fields)
+    final_output['images'] = results
+    with open(output_file, 'w') as f:
+        json.dump(final_output, f, indent=1)
+
+
+def write_results_after(results, output_file):
+    final_output = dict(other_fields)
+    final_output['images'] = iter(results)
+    write_json_streaming(output_file, final_output, streamed_key='images', indent=1)
+
+
+def write_table_before(detection_results_table, output_file):
+    fields = dict(other_fields)
+    images = detection_results_table.to_json(orient='records', double_precision=3)
+    images = json.loads(images)
+    fields['images'] = images
+    with open(output_file, 'w') as f:
+        json.dump(fields, f, indent=1)
+
+
+def write_table_after(detection_results_table, output_file):
+    write_api_results(detection_results_table, dict(other_fields), output_file)
+
+
+writers = {
+    ('results', 'before'): write_results_before,
+    ('results', 'after'): write_results_after,
+    ('table', 'before'): write_table_before,
+    ('table', 'after'): write_table_after
+}
+
+
+#%% Benchmark driver
+
+def peak_rss_mb():
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_one(writer_name, version, n_images, output_file, queue):
+
+    data = make_synthetic_results(n_images)
+    if writer_name == 'table':
+        data = pd.DataFrame(data)
+    peak_before = peak_rss_mb()
+
+    start_time = time.time()
+    writers[(writer_name, version)](data, output_file)
+    elapsed = time.time() - start_time
+
+    queue.put((elapsed, peak_rss_mb() - peak_before))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare the in-memory and streaming writers for API output files')
+    parser.add_argument('--n_images', type=int, default=200000,
+                        help='Number of synthetic images in the output file')
+    parser.add_argument('--output_dir', default='.',
+                        help='Folder to write the (temporary) output files to')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+
+    for writer_name, version in writers:
+        output_file = os.path.join(args.output_dir, 'benchmark_{}_{}.json'.format(writer_name, version))
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_one, args=(writer_name, version, args.n_images, output_file, queue))
+        p.start()
+        elapsed, peak_increase = queue.get()
+        p.join()
+
+        print('{:<8} {:<7} {:8.2f} s, peak RSS increase {:8.1f} MB, file size {:8.1f} MB'.format(
+            writer_name, version, elapsed, peak_increase, os.path.getsize(output_file) / (1024 * 1024)))
+        os.remove(output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+########
+#
+# benchmark_rendering.py
+#
+# Compares the wall time of rendering preview images in postprocess_batch_results
+# sequentially, on a pool of threads and on a pool of processes.
+#
+# Writes a set of synthetic camera trap images and a matching API output file to
+# output_dir, then runs process_batch_results once per mode, each into its own
+# (initially empty) folder, so no renders are reused between runs.
+#
+# Command-line use:
+#
+# python benchmark_rendering.py --n_images 1000 --n_workers 8 --output_dir /tmp/render_benchmark
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import time
+
+import numpy as np
+from PIL import Image
+
+from api.batch_processing.postprocessing.postprocess_batch_results import PostProcessingOptions, \
+    process_batch_results
+
+MODES = ['sequential', 'threads', 'processes']
+
+
+#%% Support functions
+
+def write_synthetic_images(image_dir, n_images, image_width, image_height, seed=0):
+    """
+    Writes n_images JPEGs to image_dir, and returns an API output dict for them with
+    0-3 detections per image.
+    """
+
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+
+    # Smooth gradients plus noise, so the images compress (and decode) roughly like
+    # photos rather than like flat colors or pure noise
+    y, x = np.mgrid[0:image_height, 0:image_width]
+    base = np.stack([(x * 255 // image_width), (y * 255 // image_height),
+                     ((x + y) * 255 // (image_width + image_height))], axis=-1).astype(np.int16)
+
+    images = []
+    for i_image in range(n_images):
+        file = 'cam{}/IMG_{:05d}.JPG'.format(i_image % 10, i_image)
+        image_path = os.path.join(image_dir, file)
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        if not os.path.isfile(image_path):
+            noise = rng.integers(-20, 20, size=(image_height // 4, image_width // 4, 1), dtype=np.int16)
+            noise = noise.repeat(4, axis=0).repeat(4, axis=1)
+            pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+            Image.fromarray(pixels).save(image_path, quality=90)
+
+        detections = []
+        for _ in range(random.randint(0, 3)):
+            w, h = random.uniform(0.05, 0.4), random.uniform(0.05, 0.4)
+            detections.append({'category': random.choice(['1', '2', '3']),
+                               'conf': round(random.random(), 3),
+                               'bbox': [round(random.uniform(0, 1 - w), 4), round(random.uniform(0, 1 - h), 4),
+                                        round(w, 4), round(h, 4)]})
+        images.append({'file': file, 'max_detection_conf': max([d['conf'] for d in detections], default=0.0),
+                       'detections': detections})
+
+    return {'info': {'format_version': '1.0'},
+            'detection_categories': {'1': 'animal', '2': 'person', '3': 'vehicle'},
+            'images': images}
+
+
+def run_benchmark(mode, api_output_file, image_dir, output_dir, n_workers):
+    """
+    Renders all images in api_output_file to output_dir, returns the elapsed time in seconds.
+    """
+
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+
+    options = PostProcessingOptions()
+    options.api_output_file = api_output_file
+    options.image_base_dir = image_dir
+    options.output_dir = output_dir
+    options.num_images_to_sample = -1
+    options.confidence_threshold = 0.5
+    options.parallelize_rendering = (mode != 'sequential')
+    options.parallelize_rendering_with_threads = (mode == 'threads')
+    options.parallelize_rendering_n_cores = n_workers
+
+    start_time = time.time()
+    process_batch_results(options)
+    return time.time() - start_time
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare sequential, thread-pool and process-pool rendering in postprocess_batch_results')
+    parser.add_argument('--output_dir', type=str, default='render_benchmark',
+                        help='Folder for the synthetic images and the rendered output')
+    parser.add_argument('--n_images', type=int, default=500)
+    parser.add_argument('--image_width', type=int, default=4000)
+    parser.add_argument('--image_height', type=int, default=3000)
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of threads or processes')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES)
+    args = parser.parse_args()
+
+    image_dir = os.path.join(args.output_dir, 'images')
+    print('Writing {} synthetic images to {}'.format(args.n_images, image_dir))
+    api_output = write_synthetic_images(image_dir, args.n_images, args.image_width, args.image_height)
+    api_output_file = os.path.join(args.output_dir, 'api_output.json')
+    with open(api_output_file, 'w') as f:
+        json.dump(api_output, f)
+
+    elapsed = {}
+    for mode in args.modes:
+        elapsed[mode] = run_benchmark(mode, api_output_file, image_dir,
+                                      os.path.join(args.output_dir, 'preview_' + mode), args.n_workers)
+
+    print('\n{} images of {}x{}, {} workers ({} cores)'.format(
+        args.n_images, args.image_width, args.image_height, args.n_workers, multiprocessing.cpu_count()))
+    for mode in args.modes:
+        print('{:>12}: {:8.2f}s ({:.1f} ms per image)'.format(
+            mode, elapsed[mode], 1000 * elapsed[mode] / args.n_images))
+
+
+if __name__ == '__main__':
+    main()
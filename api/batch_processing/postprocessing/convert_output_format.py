@@ -17,20 +17,21 @@ import json
 import os
 from tqdm import tqdm
 
-from api.batch_processing.postprocessing.load_api_results import load_api_results_csv
+from api.batch_processing.postprocessing.load_api_results import load_api_results_csv, load_api_results_json
 from data_management.annotations import annotation_constants
 
 CONF_DIGITS = 3
 
 #%% Conversion functions
 
-def convert_json_to_csv(input_path,output_path=None,min_confidence=None,omit_bounding_boxes=False):
+def convert_json_to_csv(input_path,output_path=None,min_confidence=None,omit_bounding_boxes=False,
+                        use_results_cache=False):
     
     if output_path is None:
         output_path = os.path.splitext(input_path)[0]+'.csv'
         
     print('Loading json results from {}...'.format(input_path))
-    json_output = json.load(open(input_path))
+    json_output = load_api_results_json(input_path, use_cache=use_results_cache)
 
     rows = []
     
@@ -197,12 +198,14 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_path')
     parser.add_argument('output_path')
+    parser.add_argument('--use_results_cache', action='store_true',
+                        help='Load the input .json from its sidecar cache of parsed results, or create one (see api_results_cache.py)')
     args = parser.parse_args()
 
     if args.input_path.endswith('.csv') and args.output_path.endswith('.json'):
         convert_csv_to_json(args.input_path,args.output_path)
     elif args.input_path.endswith('.json') and args.output_path.endswith('.csv'):
-        convert_json_to_csv(args.input_path,args.output_path)
+        convert_json_to_csv(args.input_path,args.output_path,use_results_cache=args.use_results_cache)
     else:
         raise ValueError('Illegal format combination')            
 
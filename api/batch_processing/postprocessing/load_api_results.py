@@ -11,10 +11,21 @@
 
 import json
 import os
+import re
 from collections import defaultdict
 
+import numpy as np
 import pandas as pd
 
+from api.batch_processing.postprocessing import api_results_cache
+from ct_utils import write_json_streaming
+
+# orjson is optional, see load_json()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 headers = ['image_path', 'max_confidence', 'detections']
 
 
@@ -59,7 +70,92 @@ def api_results_groupby(api_output_path, gt_db_indexed, file_to_image_id, field=
 
 #%% Functions for loading the result as a Pandas DataFrame
 
-def load_api_results(api_output_path, normalize_paths=True, filename_replacements={}):
+def load_json(path, use_orjson=False):
+    """
+    Loads a json file, optionally with orjson, which parses API output files somewhat faster
+    but needs about twice the size of the file in additional memory while parsing.
+    """
+
+    if not use_orjson:
+        with open(path) as f:
+            return json.load(f)
+    assert orjson is not None, 'orjson is not installed'
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+# Matches paths that os.path.normpath might change on this platform: empty paths, '.' or '..'
+# components, repeated or trailing separators and, on Windows, '/' separators and drives
+_seps = re.escape(os.sep + (os.altsep or ''))
+_path_to_normalize_pattern = re.compile(
+    r'^$|(?:^|[{0}])\.{{1,2}}(?:[{0}]|$)|[{0}]{{2}}|[{0}]$'.format(_seps) +
+    (r'|{}|:'.format(re.escape(os.altsep)) if os.altsep else ''))
+
+
+def normalize_path_column(paths):
+    """
+    Applies os.path.normpath to a Series of paths; only the paths that normpath would change
+    are passed to it, which is most often none of them.
+    """
+
+    to_normalize = paths.str.contains(_path_to_normalize_pattern)
+    if not to_normalize.any():
+        return paths
+    paths = paths.copy()
+    paths[to_normalize] = paths[to_normalize].map(os.path.normpath)
+    return paths
+
+
+def get_detections_table(detection_results):
+    """
+    Flattens the 'detections' column of a table returned by load_api_results.
+
+    Returns:
+        a Pandas DataFrame with one row per detection and columns image_idx (the position
+        of the image in detection_results), category, conf, x, y, w and h
+    """
+
+    detections_column = detection_results['detections'].values
+    n_detections_per_image = np.fromiter(
+        (len(detections) if isinstance(detections, list) else 0 for detections in detections_column),
+        dtype=np.int64, count=len(detections_column))
+    n_detections = int(n_detections_per_image.sum())
+
+    def _detections():
+        for detections in detections_column:
+            if isinstance(detections, list):
+                yield from detections
+
+    bboxes = np.fromiter((v for d in _detections() for v in d['bbox']), dtype=np.float64,
+                         count=4 * n_detections).reshape(-1, 4)
+
+    return pd.DataFrame({
+        'image_idx': np.repeat(np.arange(len(detections_column)), n_detections_per_image),
+        'category': [d['category'] for d in _detections()],
+        'conf': np.fromiter((d['conf'] for d in _detections()), dtype=np.float64, count=n_detections),
+        'x': bboxes[:, 0], 'y': bboxes[:, 1], 'w': bboxes[:, 2], 'h': bboxes[:, 3]
+    })
+
+
+def load_api_results_json(api_output_path, use_orjson=False, use_cache=False):
+    """
+    Loads an API output .json file to a dict, like json.load.
+
+    Args:
+        api_output_path: path to the API output json file
+        use_orjson: whether to parse the file with orjson, see load_json()
+        use_cache: whether to load the file from its sidecar cache if it's still valid, and
+            otherwise to write one (see api_results_cache)
+    """
+
+    if use_cache:
+        return api_results_cache.load_with_sidecar(api_output_path,
+                                                   lambda path: load_json(path, use_orjson))
+    return load_json(api_output_path, use_orjson)
+
+
+def load_api_results(api_output_path, normalize_paths=True, filename_replacements={},
+                     return_detections_table=False, use_orjson=False, use_cache=False):
     """
     Loads the json formatted results from the batch processing API to a Pandas DataFrame, mainly useful for
     various postprocessing functions.
@@ -68,18 +164,22 @@ def load_api_results(api_output_path, normalize_paths=True, filename_replacement
         api_output_path: path to the API output json file
         normalize_paths: whether to apply os.path.normpath to the 'file' field in each image entry in the output file
         filename_replacements: replace some path tokens to match local paths to the original blob structure
+        return_detections_table: whether to also return a flattened table of detections, see 
+            get_detections_table()
+        use_orjson: whether to parse the file with orjson, see load_json()
+        use_cache: whether to use the sidecar cache of the file, see load_api_results_json()
 
     Returns:
         detection_results: a Pandas DataFrame with columns (file, max_detection_conf, detections)
             which correspond to the old column names (image_path, max_confidence, and detections). It may also include
             a 'meta' column.
         other_fields: a dict containing fields in the dict
+        detections_table: only if return_detections_table is True, a Pandas DataFrame with one row per detection
     """
     
     print('Loading API results from {}'.format(api_output_path))
 
-    with open(api_output_path) as f:
-        detection_results = json.load(f)
+    detection_results = load_api_results_json(api_output_path, use_orjson, use_cache)
 
     print('De-serializing API results from {}'.format(api_output_path))
 
@@ -93,54 +193,49 @@ def load_api_results(api_output_path, normalize_paths=True, filename_replacement
         if k != 'images':
             other_fields[k] = v
 
-    # Normalize paths to simplify comparisons later
-    if normalize_paths:
-        for image in detection_results['images']:
-            image['file'] = os.path.normpath(image['file'])
-
     # Pack the json output into a Pandas DataFrame
     detection_results = pd.DataFrame(detection_results['images'])
 
-    # Optionally replace some path tokens to match local paths to the original blob structure
-    # string_to_replace = list(options.detector_output_filename_replacements.keys())[0]
-    for string_to_replace in filename_replacements:
+    if len(detection_results) > 0:
 
-        replacement_string = filename_replacements[string_to_replace]
+        # Normalize paths to simplify comparisons later
+        if normalize_paths:
+            detection_results['file'] = normalize_path_column(detection_results['file'])
 
-        # TODO: hit some silly issues with vectorized str() and escaped characters, vectorize
-        # this later.
-        #
-        # detection_results['image_path'].str.replace(string_to_replace,replacement_string)
-        # i_row = 0
-        for i_row in range(0, len(detection_results)):
-            row = detection_results.iloc[i_row]
-            fn = row['file']
-            fn = fn.replace(string_to_replace, replacement_string)
-            detection_results.at[i_row, 'file'] = fn
+        # Optionally replace some path tokens to match local paths to the original blob structure
+        for string_to_replace, replacement_string in filename_replacements.items():
+            detection_results['file'] = detection_results['file'].str.replace(
+                string_to_replace, replacement_string, regex=False)
 
     print('Finished loading and de-serializing API results for {} images from {}'.format(len(detection_results),
                                                                                          api_output_path))
 
+    if return_detections_table:
+        return detection_results, other_fields, get_detections_table(detection_results)
     return detection_results, other_fields
 
 
-def write_api_results(detection_results_table, other_fields, out_path):
+def write_api_results(detection_results_table, other_fields, out_path, chunk_size=10000):
     """
     Writes a Pandas DataFrame back to a json that is compatible with the API output format.
+    
+    Rows are serialized chunk_size rows at a time and written one entry at a time, so the 
+    encoded output for the whole table is never held in memory.
     """
     
     print('Writing detection results to {}'.format(out_path))
 
-    fields = other_fields
+    def _images_to_write():
+        for i_start in range(0, len(detection_results_table), chunk_size):
+            chunk = detection_results_table.iloc[i_start:i_start + chunk_size]
+            # TODO: read double_precision from a config elsewhere
+            yield from json.loads(chunk.to_json(orient='records', double_precision=3))
 
-    # TODO: read double_precision from a config elsewhere
-    images = detection_results_table.to_json(orient='records',
-                                             double_precision=3)
-    images = json.loads(images)
-    fields['images'] = images
+    # 'images' is written last, after info and the category fields
+    fields = {k: v for k, v in other_fields.items() if k != 'images'}
+    fields['images'] = _images_to_write()
 
-    with open(out_path, 'w') as f:
-        json.dump(fields, f, indent=1)
+    write_json_streaming(out_path, fields, streamed_key='images', indent=1)
 
     print('Finished writing detection results to {}'.format(out_path))
 
@@ -0,0 +1,80 @@
+"""
+Tests for load_api_results: path normalization and replacements have to give the same file
+names as applying os.path.normpath and str.replace to every entry.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from api.batch_processing.postprocessing import load_api_results
+
+
+FILES = ['site1/cam1/IMG_0001.JPG', 'site1/./cam1/IMG_0002.JPG', 'site1//cam2/IMG_0003.JPG',
+         'site1/cam2/../cam3/IMG_0004.JPG', './site2/IMG.0005.JPG', 'site2/.hidden/IMG_0006.JPG',
+         'site2/..IMG_0007.JPG', 'site(3)/[a]+/IMG_0008.JPG', 'site(3)/[a]+/IMG_0009.JPG']
+
+
+class LoadApiResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        images = []
+        for i_image, file in enumerate(FILES):
+            detections = [{'category': str(1 + i_detection % 3), 'conf': 0.5 + 0.01 * i_image,
+                           'bbox': [0.1 * i_detection, 0.2, 0.3, 0.01 * i_image + 0.01]}
+                          for i_detection in range(i_image % 3)]
+            images.append({'file': file, 'max_detection_conf': max([d['conf'] for d in detections], default=0.0),
+                           'detections': detections})
+        images.append({'file': 'site4/IMG_0010.JPG', 'failure': 'Failed to load image'})
+
+        self.api_output_path = os.path.join(self.temp_dir, 'results.json')
+        with open(self.api_output_path, 'w') as f:
+            json.dump({'info': {'format_version': '1.0'}, 'detection_categories': {'1': 'animal'},
+                       'images': images}, f)
+        self.images = images
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_paths(self):
+        replacements = {'site(3)/[a]+': 'site3', 'cam': 'camera'}
+        expected = []
+        for image in self.images:
+            file = os.path.normpath(image['file'])
+            for string_to_replace, replacement_string in replacements.items():
+                file = file.replace(string_to_replace, replacement_string)
+            expected.append(file)
+
+        detection_results, other_fields = load_api_results.load_api_results(
+            self.api_output_path, filename_replacements=replacements)
+        self.assertEqual(detection_results['file'].tolist(), expected)
+        self.assertEqual(sorted(other_fields.keys()), ['detection_categories', 'info'])
+
+        detection_results, _ = load_api_results.load_api_results(self.api_output_path, normalize_paths=False)
+        self.assertEqual(detection_results['file'].tolist(), [image['file'] for image in self.images])
+
+    def test_detections_table(self):
+        detection_results, _, detections_table = load_api_results.load_api_results(
+            self.api_output_path, return_detections_table=True)
+
+        expected = pd.DataFrame([
+            {'image_idx': i_image, 'category': d['category'], 'conf': d['conf'],
+             'x': d['bbox'][0], 'y': d['bbox'][1], 'w': d['bbox'][2], 'h': d['bbox'][3]}
+            for i_image, image in enumerate(self.images) for d in image.get('detections', [])])
+        pd.testing.assert_frame_equal(detections_table, expected)
+
+    @unittest.skipIf(load_api_results.orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        expected, _ = load_api_results.load_api_results(self.api_output_path)
+        actual, _ = load_api_results.load_api_results(self.api_output_path, use_orjson=True)
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,12 +28,17 @@ from multiprocessing.pool import ThreadPool
 from enum import IntEnum
 import errno
 import uuid
+import hashlib
+import json
+import shutil
+import threading
+import multiprocessing
             
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.metrics import precision_recall_curve, confusion_matrix, average_precision_score
+from sklearn.metrics import precision_recall_curve, average_precision_score
 from tqdm import tqdm
 import humanfriendly
 import pandas as pd
@@ -125,6 +130,10 @@ class PostProcessingOptions:
     api_output_filename_replacements = {}
     ground_truth_filename_replacements = {}
 
+    # Load the API output from its sidecar cache of parsed results, or create one 
+    # (see api_results_cache.py)
+    use_results_cache = False
+
     # Allow bypassing API output loading when operating on previously-loaded results
     api_detection_results = None
     api_other_fields = None
@@ -139,10 +148,22 @@ class PostProcessingOptions:
     # Control rendering parallelization
     parallelize_rendering_n_cores = 100
     parallelize_rendering = False
+
+    # Render on a pool of threads, or on a pool of processes.  Decoding, resizing and 
+    # drawing labels mostly hold the GIL, so processes are faster for large numbers of 
+    # images.  Processes are limited to the number of cores.
+    parallelize_rendering_with_threads = True
+
+    # Number of images sent to a rendering process at a time
+    parallelize_rendering_chunk_size = 8
     
     # Determines whether missing images force an error
     allow_missing_images = False
 
+    # Re-render all images and rewrite all html pages, rather than reusing the outputs of
+    # a previous run in output_dir that are still valid (see RenderManifest)
+    force = False
+
 # ...PostProcessingOptions
 
     
@@ -274,6 +295,27 @@ def mark_detection_status(indexed_db, negative_classes=DEFAULT_NEGATIVE_CLASSES,
     return n_negative, n_positive, n_unknown, n_ambiguous
 
 # ...mark_detection_status()
+
+
+def get_ground_truth_status_table(indexed_db):
+    """
+    Returns a Pandas DataFrame indexed by the filenames in indexed_db, with the 
+    '_detection_status' and '_unambiguous_category' fields that mark_detection_status()
+    added to each image as columns detection_status and unambiguous_category (None for
+    images that don't have one).
+    
+    Looking up many filenames in this table (e.g. with index.get_indexer) is much faster
+    than going through filename_to_id and image_id_to_image for each of them.
+    """
+    
+    images = [indexed_db.image_id_to_image[image_id] for image_id in indexed_db.filename_to_id.values()]
+    return pd.DataFrame({
+        'detection_status': np.fromiter((im['_detection_status'] for im in images), dtype=np.int64, 
+                                        count=len(images)),
+        'unambiguous_category': [im.get('_unambiguous_category', None) for im in images]
+        }, index=pd.Index(list(indexed_db.filename_to_id.keys()), dtype=object))
+
+# ...get_ground_truth_status_table()
     
 
 def is_sas_url(s):
@@ -302,9 +344,162 @@ def relative_sas_url(folder_url,relative_path):
     return tokens[0] + relative_path + '?' + tokens[1]
 
 
+class RenderManifest:
+    """
+    Records which images and html pages in an output folder were rendered from which inputs,
+    so a later run into the same folder can reuse the ones whose inputs haven't changed.
+
+    Rendered images are keyed on the source image (path, and size and modification time 
+    for local files), the detections that are drawn on it and the rendering options; html 
+    pages are keyed on their contents.  The manifest is stored as render_manifest.json in 
+    the output folder.
+    """
+
+    FILE_NAME = 'render_manifest.json'
+
+    # Change this when rendering changes, to invalidate existing manifests
+    FORMAT_VERSION = 2
+
+    def __init__(self, output_dir, force=False):
+
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, RenderManifest.FILE_NAME)
+        self.lock = threading.Lock()
+
+        # Maps output files (e.g. 'detections/detections_a~b.jpg') to render keys
+        self.images = {}
+
+        # Maps html page names (e.g. 'detections') to content keys
+        self.pages = {}
+
+        if (not force) and os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                print('Warning: ignoring invalid render manifest {}'.format(self.path))
+                manifest = {}
+            if manifest.get('format_version') == RenderManifest.FORMAT_VERSION:
+                self.images = manifest['images']
+                self.pages = manifest['pages']
+
+        # Maps render keys back to output files, for images that moved to a different set
+        self.key_to_image = {key: file_name for file_name, key in self.images.items()}
+
+        self.n_reused = 0
+        self.n_copied = 0
+
+    def get_image_key(self, image_full_path, detections, detection_categories_map,
+                      classification_categories_map, options):
+        """
+        Returns the render key of an image, or None if the source image is a local file
+        that doesn't exist.
+        """
+
+        if is_sas_url(image_full_path):
+            # Don't depend on the SAS token
+            source = image_full_path.split('?')[0]
+        else:
+            try:
+                st = os.stat(image_full_path)
+            except OSError:
+                return None
+            source = [image_full_path, st.st_size, st.st_mtime_ns]
+
+        # Only the detections that are drawn matter, so changing the confidence threshold
+        # doesn't invalidate images that have no detections between the old and new threshold
+        drawn_detections = [d for d in detections if d['conf'] >= options.confidence_threshold]
+
+        key = [source, drawn_detections, detection_categories_map, classification_categories_map,
+               options.viz_target_width, options.line_thickness, options.box_expansion]
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def find_image(self, key, file_name):
+        """
+        If an image with render key *key* is available, returns the output file (relative 
+        to output_dir) to use for it, copying it to *file_name* if it was rendered for a 
+        different set; otherwise returns None.
+        """
+
+        if key is None:
+            return None
+
+        with self.lock:
+            if self.images.get(file_name) == key:
+                existing_file_name = file_name
+            else:
+                existing_file_name = self.key_to_image.get(key)
+            if existing_file_name is None:
+                return None
+
+        if not os.path.isfile(os.path.join(self.output_dir, existing_file_name)):
+            return None
+
+        # Images that moved from one set to another are copied, so each set's folder
+        # stays self-contained
+        if existing_file_name.split('/')[0] == file_name.split('/')[0]:
+            with self.lock:
+                self.n_reused += 1
+            return existing_file_name
+
+        try:
+            shutil.copyfile(os.path.join(self.output_dir, existing_file_name),
+                            os.path.join(self.output_dir, file_name))
+        except OSError:
+            # E.g. if the path is too long; the caller renders the image instead
+            return None
+        self.add_image(key, file_name)
+        with self.lock:
+            self.n_copied += 1
+        return file_name
+
+    def add_image(self, key, file_name):
+
+        if key is None:
+            return
+        with self.lock:
+            self.images[file_name] = key
+            self.key_to_image[key] = file_name
+
+    def is_page_current(self, page_name, key):
+
+        return self.pages.get(page_name) == key and \
+            os.path.isfile(os.path.join(self.output_dir, '{}.html'.format(page_name)))
+
+    def add_page(self, page_name, key):
+
+        self.pages[page_name] = key
+
+    def save(self):
+
+        manifest = {'format_version': RenderManifest.FORMAT_VERSION,
+                    'images': self.images,
+                    'pages': self.pages}
+
+        # Write to a temporary file first, so an interrupted write doesn't leave a
+        # truncated manifest
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temp_path, self.path)
+
+# ...class RenderManifest
+
+
+def get_image_full_path(image_base_dir, image_relative_path):
+    """
+    Returns the path or SAS URL of an image, given a base folder or SAS URL.
+    """
+    
+    if is_sas_url(image_base_dir):
+        return relative_sas_url(image_base_dir, image_relative_path)
+    else:
+        return os.path.join(image_base_dir, image_relative_path)
+
+
 def render_bounding_boxes(image_base_dir, image_relative_path, display_name, detections, res,
                           detection_categories_map=None, classification_categories_map=None,
-                          options=None):
+                          options=None, render_manifest=None):
         """
         Renders detection bounding boxes on a single image.  
         
@@ -316,6 +511,9 @@ def render_bounding_boxes(image_base_dir, image_relative_path, display_name, det
             
             [options.output_dir] / ['detections' or 'non-detections'] / [filename with slashes turned into tildes]
         
+        If render_manifest is supplied, an existing rendering of the same image with the same
+        detections and options is reused instead of rendering the image again.
+        
         Returns the html info struct for this image in the form that's used for 
         write_html_image_list.
         """
@@ -335,69 +533,212 @@ def render_bounding_boxes(image_base_dir, image_relative_path, display_name, det
             
             sample_name = res + '_' + path_utils.flatten_path(image_relative_path)        
             
+            # Use slashes regardless of os
+            file_name = '{}/{}'.format(res, sample_name)
+
         else:
             
-            if is_sas_url(image_base_dir):
-                image_full_path = relative_sas_url(image_base_dir, image_relative_path)
-            else:
-                image_full_path = os.path.join(image_base_dir, image_relative_path)
+            image_full_path = get_image_full_path(image_base_dir, image_relative_path)
             
-            # isfile() is slow when mounting remote directories; much faster to just try/except
-            # on the image open.
-            if False:
-                if not os.path.isfile(image_full_path):
-                    print('Warning: could not find image file {}'.format(image_full_path))
-                    return ''
-            
-            try:
-                image = vis_utils.open_image(image_full_path)
-            except:
-                print('Warning: could not open image file {}'.format(image_full_path))            
-                return ''
-            
-            if options.viz_target_width is not None:
-                image = vis_utils.resize_image(image, options.viz_target_width)
-    
-            vis_utils.render_detection_bounding_boxes(detections, image,
-                                                      label_map=detection_categories_map,
-                                                      classification_label_map=classification_categories_map,
-                                                      confidence_threshold=options.confidence_threshold,
-                                                      thickness=options.line_thickness,expansion=options.box_expansion)
-
             # Render images to a flat folder... we can use os.sep here because we've
             # already normalized paths
             sample_name = res + '_' + path_utils.flatten_path(image_relative_path)        
-            fullpath = os.path.join(options.output_dir, res, sample_name)
-            try:
-                image.save(fullpath)
-            except OSError as e:
-                # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so 
-                # we awkwardly check against a hard-coded limit
-                if (e.errno == errno.ENAMETOOLONG) or (len(fullpath) >= 259):
-                    extension = os.path.splitext(sample_name)[1]
-                    sample_name = res + '_' + str(uuid.uuid4()) + extension
-                    image.save(os.path.join(options.output_dir, res, sample_name))
-                else:
-                    raise
-                
-        # Use slashes regardless of os
-        file_name = '{}/{}'.format(res, sample_name)
 
-        return {
-            'filename': file_name,
-            'title': display_name,
-            'textStyle': 'font-family:verdana,arial,calibri;font-size:80%;text-align:left;margin-top:20;margin-bottom:5'
-        }
+            # Reuse a previous rendering of this image if there is one
+            render_key = None
+            file_name = None
+            if render_manifest is not None:
+                render_key = render_manifest.get_image_key(image_full_path, detections,
+                                                           detection_categories_map,
+                                                           classification_categories_map, options)
+                file_name = render_manifest.find_image(render_key, '{}/{}'.format(res, sample_name))
+
+            if file_name is None:
+
+                # isfile() is slow when mounting remote directories; much faster to just try/except
+                # on the image open.
+                if False:
+                    if not os.path.isfile(image_full_path):
+                        print('Warning: could not find image file {}'.format(image_full_path))
+                        return ''
+            
+                try:
+                    if options.viz_target_width is not None:
+                        image = vis_utils.load_resized_image(image_full_path, options.viz_target_width)
+                    else:
+                        image = vis_utils.load_image(image_full_path)
+                except:
+                    print('Warning: could not open image file {}'.format(image_full_path))            
+                    return ''
+    
+                vis_utils.render_detection_bounding_boxes(detections, image,
+                                                          label_map=detection_categories_map,
+                                                          classification_label_map=classification_categories_map,
+                                                          confidence_threshold=options.confidence_threshold,
+                                                          thickness=options.line_thickness,expansion=options.box_expansion)
+
+                fullpath = os.path.join(options.output_dir, res, sample_name)
+                try:
+                    image.save(fullpath)
+                except OSError as e:
+                    # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so 
+                    # we awkwardly check against a hard-coded limit
+                    if (e.errno == errno.ENAMETOOLONG) or (len(fullpath) >= 259):
+                        extension = os.path.splitext(sample_name)[1]
+                        sample_name = res + '_' + str(uuid.uuid4()) + extension
+                        image.save(os.path.join(options.output_dir, res, sample_name))
+                    else:
+                        raise
+
+                # Use slashes regardless of os
+                file_name = '{}/{}'.format(res, sample_name)
+
+                if render_manifest is not None:
+                    render_manifest.add_image(render_key, file_name)
+
+        return get_image_html_info(file_name, display_name)
 
 # ...render_bounding_boxes
+
+
+def get_image_html_info(file_name, display_name):
+    """
+    Returns the html info struct for a rendered image, in the form that's used for
+    write_html_image_list.
+    """
+    
+    return {
+        'filename': file_name,
+        'title': display_name,
+        'textStyle': 'font-family:verdana,arial,calibri;font-size:80%;text-align:left;margin-top:20;margin-bottom:5'
+    }
         
 
-def prepare_html_subpages(images_html, output_dir, options=None):
+# The arguments of render_bounding_boxes that are the same for every image, set in each
+# rendering worker process by init_rendering_worker
+_rendering_worker_args = None
+
+
+def init_rendering_worker(detection_categories_map, classification_categories_map, options):
+
+    global _rendering_worker_args
+    _rendering_worker_args = (detection_categories_map, classification_categories_map, options)
+
+
+def render_bounding_boxes_in_worker(render_task):
+    """
+    Renders one image in a rendering worker process, see render_images.
+    
+    Returns the html info struct from render_bounding_boxes.
+    """
+    
+    detection_categories_map, classification_categories_map, options = _rendering_worker_args
+    return render_bounding_boxes_for_task(render_task, detection_categories_map,
+                                          classification_categories_map, options)
+
+
+def render_bounding_boxes_for_task(render_task, detection_categories_map, classification_categories_map,
+                                   options, render_manifest=None):
+    """
+    Calls render_bounding_boxes for a render task, see render_images.
+    """
+    
+    image_relative_path, display_name, detections, res, confidence_threshold = render_task
+    if confidence_threshold != options.confidence_threshold:
+        options = copy.copy(options)
+        options.confidence_threshold = confidence_threshold
+    return render_bounding_boxes(options.image_base_dir, image_relative_path, display_name, detections, res,
+                                 detection_categories_map, classification_categories_map, options,
+                                 render_manifest)
+
+
+def render_images(render_tasks, detection_categories_map, classification_categories_map, options,
+                  render_manifest=None):
+    """
+    Renders a list of images with render_bounding_boxes, either sequentially or, if
+    options.parallelize_rendering is set, on a pool of threads or processes.
+    
+    Each render task is a list [image_relative_path, display_name, detections, res, 
+    confidence_threshold].
+    
+    Returns the html info struct for each task, or '' for images that couldn't be rendered.
+    """
+    
+    def _render(render_task):
+        return render_bounding_boxes_for_task(render_task, detection_categories_map,
+                                              classification_categories_map, options, render_manifest)
+    
+    if not options.parallelize_rendering:
+        return [_render(render_task) for render_task in tqdm(render_tasks)]
+    
+    n_workers = options.parallelize_rendering_n_cores
+    
+    if options.parallelize_rendering_with_threads:
+        if n_workers is None:
+            pool = ThreadPool()
+        else:
+            print('Rendering images with {} threads'.format(n_workers))
+            pool = ThreadPool(n_workers)
+        return list(tqdm(pool.imap(_render, render_tasks), total=len(render_tasks)))
+    
+    # Rendering in processes: previously rendered images are looked up here, so the 
+    # manifest stays in this process, and only the remaining images are sent to the
+    # workers, which return just the html info structs
+    rendered_image_html_infos = [None] * len(render_tasks)
+    render_keys = [None] * len(render_tasks)
+    i_tasks_to_render = []
+    for i_task, render_task in enumerate(render_tasks):
+        image_relative_path, _, detections, res, confidence_threshold = render_task
+        if render_manifest is not None and res not in options.rendering_bypass_sets:
+            rendering_options = copy.copy(options)
+            rendering_options.confidence_threshold = confidence_threshold
+            render_keys[i_task] = render_manifest.get_image_key(
+                get_image_full_path(options.image_base_dir, image_relative_path), detections,
+                detection_categories_map, classification_categories_map, rendering_options)
+            sample_name = res + '_' + path_utils.flatten_path(image_relative_path)
+            file_name = render_manifest.find_image(render_keys[i_task], '{}/{}'.format(res, sample_name))
+            if file_name is not None:
+                rendered_image_html_infos[i_task] = get_image_html_info(file_name, render_task[1])
+                continue
+        i_tasks_to_render.append(i_task)
+    
+    if len(i_tasks_to_render) == 0:
+        return rendered_image_html_infos
+    
+    # The workers don't need the API results that may be attached to options
+    worker_options = copy.copy(options)
+    worker_options.api_detection_results = None
+    worker_options.api_other_fields = None
+    
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, multiprocessing.cpu_count(), len(i_tasks_to_render)))
+    print('Rendering {} images with {} processes'.format(len(i_tasks_to_render), n_workers))
+    with multiprocessing.Pool(n_workers, initializer=init_rendering_worker,
+                              initargs=(detection_categories_map, classification_categories_map,
+                                        worker_options)) as pool:
+        results = pool.imap(render_bounding_boxes_in_worker, (render_tasks[i] for i in i_tasks_to_render),
+                            chunksize=options.parallelize_rendering_chunk_size)
+        for i_task, rendered_image_html_info in tqdm(zip(i_tasks_to_render, results),
+                                                      total=len(i_tasks_to_render)):
+            rendered_image_html_infos[i_task] = rendered_image_html_info
+            if render_manifest is not None and len(rendered_image_html_info) > 0:
+                render_manifest.add_image(render_keys[i_task], rendered_image_html_info['filename'])
+    
+    return rendered_image_html_infos
+
+# ...render_images
+
+
+def prepare_html_subpages(images_html, output_dir, options=None, render_manifest=None):
     """
     Write out a series of html image lists, e.g. the fp/tp/fn/tn pages.
 
     image_html is a dictionary mapping an html page name (e.g. "fp") to a list
     of image structs friendly to write_html_image_list
+
+    If render_manifest is supplied, pages whose contents haven't changed since they 
+    were last written are not written again.
     """
     if options is None:
             options = PostProcessingOptions()
@@ -416,13 +757,25 @@ def prepare_html_subpages(images_html, output_dir, options=None):
         images_html = images_html_sorted
 
     # Write the individual HTML files
+    n_pages_unchanged = 0
     for res, array in images_html.items():
+        html_options = {
+            'headerHtml': '<h1>{}</h1>'.format(res.upper())
+        }
+        if render_manifest is not None:
+            page_key = hashlib.sha256(json.dumps([array, html_options]).encode('utf-8')).hexdigest()
+            if render_manifest.is_page_current(res, page_key):
+                n_pages_unchanged += 1
+                continue
         write_html_image_list(
             filename=os.path.join(output_dir, '{}.html'.format(res)),
             images=array,
-            options={
-                'headerHtml': '<h1>{}</h1>'.format(res.upper())
-            })
+            options=html_options)
+        if render_manifest is not None:
+            render_manifest.add_page(res, page_key)
+
+    if n_pages_unchanged > 0:
+        print('{} of {} html pages are unchanged'.format(n_pages_unchanged, len(images_html)))
 
     return image_counts
 
@@ -444,6 +797,9 @@ def process_batch_results(options):
 
     os.makedirs(output_dir, exist_ok=True)
 
+    # Images and html pages from a previous run into this folder that can be reused
+    render_manifest = RenderManifest(output_dir, force=options.force)
+
 
     ##%% Load ground truth if available
 
@@ -468,7 +824,8 @@ def process_batch_results(options):
     if options.api_detection_results is None:
         detection_results, other_fields = load_api_results(options.api_output_file,
                                                  normalize_paths=True,
-                                                 filename_replacements=options.api_output_filename_replacements)
+                                                 filename_replacements=options.api_output_filename_replacements,
+                                                 use_cache=options.use_results_cache)
         ppresults.api_detection_results = detection_results
         ppresults.api_other_fields = other_fields
         
@@ -515,20 +872,16 @@ def process_batch_results(options):
 
     if ground_truth_indexed_db is not None:
 
-        b_match = [False] * len(detection_results)
+        ground_truth_status_table = get_ground_truth_status_table(ground_truth_indexed_db)
 
-        detector_files = detection_results['file'].tolist()
-
-        # fn = detector_files[0]; print(fn)
-        for i_fn, fn in enumerate(detector_files):
-
-            # assert fn in ground_truth_indexed_db.filename_to_id, 'Could not find ground truth for row {} ({})'.format(i_fn,fn)
-            if fn in ground_truth_indexed_db.filename_to_id:
-                b_match[i_fn] = True
+        # Row in ground_truth_status_table for each row in detection_results, -1 if there isn't one
+        gt_rows = ground_truth_status_table.index.get_indexer(detection_results['file'])
+        b_match = gt_rows >= 0
 
-        print('Confirmed filename matches to ground truth for {} of {} files'.format(sum(b_match), len(detector_files)))
+        print('Confirmed filename matches to ground truth for {} of {} files'.format(np.sum(b_match), len(b_match)))
 
         detection_results = detection_results[b_match]
+        gt_rows = gt_rows[b_match]
         detector_files = detection_results['file'].tolist()
 
         assert len(detector_files) > 0, 'No detection files available, possible ground truth path issue?'
@@ -574,20 +927,13 @@ def process_batch_results(options):
         p_detection = detection_results['max_detection_conf'].values
         n_detections = len(p_detection)
 
+        # Ground truth status of each image
+        gt_detection_status = ground_truth_status_table['detection_status'].values[gt_rows]
+        
         # numpy array of bools (0.0/1.0), and -1 as null value
-        gt_detections = np.zeros(n_detections, dtype=float)
-
-        for i_detection, fn in enumerate(detector_files):
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detection_status = image['_detection_status']
-
-            if detection_status == DetectionStatus.DS_NEGATIVE:
-                gt_detections[i_detection] = 0.0
-            elif detection_status == DetectionStatus.DS_POSITIVE:
-                gt_detections[i_detection] = 1.0
-            else:
-                gt_detections[i_detection] = -1.0
+        gt_detections = np.full(n_detections, -1.0)
+        gt_detections[gt_detection_status == DetectionStatus.DS_NEGATIVE] = 0.0
+        gt_detections[gt_detection_status == DetectionStatus.DS_POSITIVE] = 1.0
 
         # Don't include ambiguous/unknown ground truth in precision/recall analysis
         b_valid_ground_truth = gt_detections >= 0.0
@@ -624,10 +970,9 @@ def process_batch_results(options):
             precision_at_target_recall = precisions[i_target_recall]
         print('Precision at {:.1%} recall: {:.1%}'.format(target_recall, precision_at_target_recall))
 
-        cm = confusion_matrix(gt_detections_pr, np.array(p_detection_pr) > options.confidence_threshold)
-
-        # Flatten the confusion matrix
-        tn, fp, fn, tp = cm.ravel()
+        # Count (ground truth, prediction) pairs, in the order of the flattened confusion matrix
+        tn, fp, fn, tp = np.bincount(2 * gt_detections_pr.astype(int) + (p_detection_pr > options.confidence_threshold),
+                                     minlength=4)
 
         precision_at_confidence_threshold = tp / (tp + fp)
         recall_at_confidence_threshold = tp / (tp + fn)
@@ -641,73 +986,75 @@ def process_batch_results(options):
         
         classifier_accuracies = []
         
-        # Mapping of classnames to idx for the confusion matrix.
-        #
-        # The lambda is actually kind of a hack, because we use assume that
-        # the following code does not reassign classname_to_idx
-        classname_to_idx = collections.defaultdict(lambda: len(classname_to_idx))
+        # Mapping of classnames to idx for the confusion matrix, in the order in which
+        # they're first seen
+        classname_to_idx = {}
         
-        # Confusion matrix as defaultdict of defaultdict
+        # Ground truth and predicted class index of each entry in the confusion matrix 
         #
         # Rows / first index is ground truth, columns / second index is predicted category
-        classifier_cm = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+        cm_gt_class_idx = []
+        cm_pred_class_idx = []
+        
+        # Only positive images with an unambiguous class annotated can have a classification
+        # accuracy
+        gt_unambiguous_category = ground_truth_status_table['unambiguous_category'].values[gt_rows]
+        b_classifiable = (gt_detection_status == DetectionStatus.DS_POSITIVE) & \
+            pd.notnull(gt_unambiguous_category)
+        detections_column = detection_results['detections'].values
         
-        # iDetection = 0; fn = detector_files[iDetection]; print(fn)
         assert len(detector_files) == len(detection_results)
-        for iDetection,fn in enumerate(detector_files):
+        for iDetection in np.flatnonzero(b_classifiable):
             
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detections = detection_results['detections'].iloc[iDetection]
-            pred_class_ids = [det['classifications'][0][0] \
+            detections = detections_column[iDetection]
+            if not isinstance(detections, list):
+                continue
+            pred_classnames = [classification_categories_map[det['classifications'][0][0]] \
                 for det in detections if 'classifications' in det.keys()]
-            pred_classnames = [classification_categories_map[pd] for pd in pred_class_ids]
 
-            # If this image has classification predictions, and an unambiguous class
-            # annotated, and is a positive image...
-            if len(pred_classnames) > 0 \
-                    and '_unambiguous_category' in image.keys() \
-                    and image['_detection_status'] == DetectionStatus.DS_POSITIVE:
+            # If this image has classification predictions...
+            if len(pred_classnames) == 0:
+                continue
                         
-                # The unambiguous category, we make this a set for easier handling afterward
-                gt_categories = set([image['_unambiguous_category']])
-                pred_categories = set(pred_classnames)
-                
-                # Compute the accuracy as intersection of union,
-                # i.e. (# of categories in both prediciton and GT)
-                #      divided by (# of categories in either prediction or GT
-                #
-                # In case of only one GT category, the result will be 1.0, if
-                # prediction is one category and this category matches GT
-                #
-                # It is 1.0/(# of predicted top-1 categories), if the GT is
-                # one of the predicted top-1 categories.
-                #
-                # It is 0.0, if none of the predicted categories is correct
-                
-                classifier_accuracies.append(
-                    len(gt_categories & pred_categories)
-                    / len(gt_categories | pred_categories)
-                )
-                image['_classification_accuracy'] = classifier_accuracies[-1]
-                
-                # Distribute this accuracy across all predicted categories in the
-                # confusion matrix
-                assert len(gt_categories) == 1
-                gt_class_idx = classname_to_idx[list(gt_categories)[0]]
-                for pred_category in pred_categories:
-                    pred_class_idx = classname_to_idx[pred_category]
-                    classifier_cm[gt_class_idx][pred_class_idx] += 1
-
-        # ...for each file in the detection results
+            gt_category = gt_unambiguous_category[iDetection]
+            pred_categories = set(pred_classnames)
+            
+            # Compute the accuracy as intersection of union,
+            # i.e. (# of categories in both prediciton and GT)
+            #      divided by (# of categories in either prediction or GT
+            #
+            # In case of only one GT category, the result will be 1.0, if
+            # prediction is one category and this category matches GT
+            #
+            # It is 1.0/(# of predicted top-1 categories), if the GT is
+            # one of the predicted top-1 categories.
+            #
+            # It is 0.0, if none of the predicted categories is correct
+            
+            if gt_category in pred_categories:
+                classifier_accuracies.append(1.0 / len(pred_categories))
+            else:
+                classifier_accuracies.append(0.0)
+            image_id = ground_truth_indexed_db.filename_to_id[detector_files[iDetection]]
+            ground_truth_indexed_db.image_id_to_image[image_id]['_classification_accuracy'] = classifier_accuracies[-1]
+            
+            # Distribute this accuracy across all predicted categories in the
+            # confusion matrix
+            gt_class_idx = classname_to_idx.setdefault(gt_category, len(classname_to_idx))
+            for pred_category in pred_categories:
+                cm_gt_class_idx.append(gt_class_idx)
+                cm_pred_class_idx.append(classname_to_idx.setdefault(pred_category, len(classname_to_idx)))
+
+        # ...for each positive file in the detection results
         
         # If we have classification results
         if len(classifier_accuracies) > 0:
             
-            # Build confusion matrix as array from classifier_cm
-            all_class_ids = sorted(classname_to_idx.values())
-            classifier_cm_array = np.array(
-                [[classifier_cm[r_idx][c_idx] for c_idx in all_class_ids] for r_idx in all_class_ids], dtype=float)
+            # Build confusion matrix as array
+            n_classes = len(classname_to_idx)
+            classifier_cm_array = np.bincount(np.array(cm_gt_class_idx) * n_classes + np.array(cm_pred_class_idx),
+                                              minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+            classifier_cm_array = classifier_cm_array.astype(float)
             classifier_cm_array /= (classifier_cm_array.sum(axis=1, keepdims=True) + 1e-7)
 
             # Print some statistics
@@ -802,7 +1149,7 @@ def process_batch_results(options):
             # Filenames should already have been normalized to either '/' or '\'
             files_to_render.append([row['file'],row['max_detection_conf'],row['detections']])
             
-        def render_image_with_gt(file_info):
+        def get_render_task_with_gt(file_info):
 
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -851,39 +1198,26 @@ def process_batch_results(options):
                 res.upper(), str(gt_presence), gt_class_summary,
                 max_conf * 100, image_relative_path)
 
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                options)
-
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for gt_class in gt_classes:
-                    image_result.append(['class_{}'.format(gt_class),rendered_image_html_info])
+            render_task = [image_relative_path, display_name, detections, res, options.confidence_threshold]
+            result_sets = [res] + ['class_{}'.format(gt_class) for gt_class in gt_classes]
             
-            return image_result
+            return render_task, result_sets
             
-        # ...def render_image_with_gt(file_info)
+        # ...def get_render_task_with_gt(file_info)
+        
+        render_tasks = [get_render_task_with_gt(file_info) for file_info in files_to_render]
+        render_tasks = [render_task for render_task in render_tasks if render_task is not None]
         
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_with_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            # file_info = files_to_render[0]
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_with_gt(file_info))
+        rendered_image_html_infos = render_images([render_task for render_task, _ in render_tasks],
+                                                  detection_categories_map, classification_categories_map,
+                                                  options, render_manifest)
         elapsed = time.time() - start_time
         
+        for (_, result_sets), rendered_image_html_info in zip(render_tasks, rendered_image_html_infos):
+            if len(rendered_image_html_info) > 0:
+                rendering_results.append([[result_set, rendered_image_html_info] for result_set in result_sets])
+        
         # Map all the rendering results in the list rendering_results into the 
         # dictionary images_html
         image_rendered_count = 0
@@ -895,7 +1229,12 @@ def process_batch_results(options):
                 images_html[assignment[0]].append(assignment[1])
                 
         # Prepare the individual html image files
-        image_counts = prepare_html_subpages(images_html, output_dir)
+        image_counts = prepare_html_subpages(images_html, output_dir, render_manifest=render_manifest)
+        render_manifest.save()
+
+        if render_manifest.n_reused + render_manifest.n_copied > 0:
+            print('Reused {} previously rendered images ({} of them copied from other sets)'.format(
+                render_manifest.n_reused + render_manifest.n_copied, render_manifest.n_copied))
 
         print('{} images rendered (of {})'.format(image_rendered_count,image_count))
 
@@ -1068,8 +1407,8 @@ def process_batch_results(options):
                     positive_categories.add(d['category'])
             return sorted(positive_categories)
         
-        # Local function for parallelization
-        def render_image_no_gt(file_info):
+        # Decide which result set an image goes to, and how to render it
+        def get_render_task_no_gt(file_info):
             
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -1103,43 +1442,33 @@ def process_batch_results(options):
             display_name = '<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {:0.3f}'.format(
                 res, image_relative_path, max_conf)
 
-            rendering_options = copy.copy(options)
+            rendering_confidence_threshold = options.confidence_threshold
             if detection_status == DetectionStatus.DS_ALMOST:
-                rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                rendering_options)
+                rendering_confidence_threshold = options.almost_detection_confidence_threshold
+            render_task = [image_relative_path, display_name, detections, res, rendering_confidence_threshold]
             
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for det in detections:
-                    if 'classifications' in det:
-                        top1_class = classification_categories_map[det['classifications'][0][0]]
-                        image_result.append(['class_{}'.format(top1_class),rendered_image_html_info])
+            result_sets = [res]
+            for det in detections:
+                if 'classifications' in det:
+                    top1_class = classification_categories_map[det['classifications'][0][0]]
+                    result_sets.append('class_{}'.format(top1_class))
             
-            return image_result
+            return render_task, result_sets
+        
+        # ...def get_render_task_no_gt(file_info):
         
-        # ...def render_image_no_gt(file_info):
+        render_tasks = [get_render_task_no_gt(file_info) for file_info in files_to_render]
         
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_no_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_no_gt(file_info))            
+        rendered_image_html_infos = render_images([render_task for render_task, _ in render_tasks],
+                                                  detection_categories_map, classification_categories_map,
+                                                  options, render_manifest)
         elapsed = time.time() - start_time
         
+        for (_, result_sets), rendered_image_html_info in zip(render_tasks, rendered_image_html_infos):
+            if len(rendered_image_html_info) > 0:
+                rendering_results.append([[result_set, rendered_image_html_info] for result_set in result_sets])
+        
         # Map all the rendering results in the list rendering_results into the 
         # dictionary images_html
         image_rendered_count = 0
@@ -1153,7 +1482,12 @@ def process_batch_results(options):
                 images_html[assignment[0]].append(assignment[1])
                 
         # Prepare the individual html image files
-        image_counts = prepare_html_subpages(images_html, output_dir)
+        image_counts = prepare_html_subpages(images_html, output_dir, render_manifest=render_manifest)
+        render_manifest.save()
+
+        if render_manifest.n_reused + render_manifest.n_copied > 0:
+            print('Reused {} previously rendered images ({} of them copied from other sets)'.format(
+                render_manifest.n_reused + render_manifest.n_copied, render_manifest.n_copied))
         
         if image_rendered_count == 0:
             seconds_per_image = 0
@@ -1282,6 +1616,17 @@ def main():
                         help='Output image width',
                         default=default_options.viz_target_width)
     parser.add_argument('--random_output_sort', action='store_true', help='Sort output randomly (defaults to sorting by filename)')
+    parser.add_argument('--use_results_cache', action='store_true',
+                        help='Load the API output from its sidecar cache of parsed results, or create one (see api_results_cache.py)')
+    parser.add_argument('--parallelize_rendering', action='store_true',
+                        help='Render images in parallel')
+    parser.add_argument('--parallelize_rendering_n_cores', action='store', type=int,
+                        help='Number of threads or processes to render images with',
+                        default=default_options.parallelize_rendering_n_cores)
+    parser.add_argument('--parallelize_rendering_with_processes', action='store_true',
+                        help='Render images in processes rather than threads (with --parallelize_rendering)')
+    parser.add_argument('--force', action='store_true',
+                        help='Re-render all images and rewrite all html pages, rather than reusing the unchanged outputs of a previous run in output_dir')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -1289,6 +1634,7 @@ def main():
 
     args = parser.parse_args()
     args.sort_html_by_filename = not args.random_output_sort
+    args.parallelize_rendering_with_threads = not args.parallelize_rendering_with_processes
 
     options = PostProcessingOptions()
     args_to_object(args,options)
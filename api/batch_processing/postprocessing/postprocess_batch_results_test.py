@@ -0,0 +1,189 @@
+"""
+Tests for the render manifest in postprocess_batch_results: rerunning into the same output
+folder should only render the images whose rendering changed.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from api.batch_processing.postprocessing import postprocess_batch_results
+from api.batch_processing.postprocessing.postprocess_batch_results import PostProcessingOptions, \
+    RenderManifest
+
+
+class RenderManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.image_dir = os.path.join(self.temp_dir, 'images')
+        self.output_dir = os.path.join(self.temp_dir, 'preview')
+
+        images = []
+        for i_image in range(10):
+            file = 'cam{}/IMG_{:04d}.JPG'.format(i_image % 2, i_image)
+            os.makedirs(os.path.join(self.image_dir, os.path.dirname(file)), exist_ok=True)
+            Image.new('RGB', (64, 48), (10 * i_image, 0, 0)).save(os.path.join(self.image_dir, file))
+            conf = 0.05 + 0.1 * i_image
+            images.append({'file': file, 'max_detection_conf': conf,
+                           'detections': [{'category': '1', 'conf': conf, 'bbox': [0.1, 0.1, 0.5, 0.5]}]})
+
+        self.api_output_file = os.path.join(self.temp_dir, 'results.json')
+        with open(self.api_output_file, 'w') as f:
+            json.dump({'info': {'format_version': '1.0'}, 'detection_categories': {'1': 'animal'},
+                       'images': images}, f)
+
+        # Only count calls to the renderer; what it draws doesn't matter here
+        self.n_rendered = 0
+        self.render_detection_bounding_boxes = \
+            postprocess_batch_results.vis_utils.render_detection_bounding_boxes
+
+        def _render_detection_bounding_boxes(*args, **kwargs):
+            self.n_rendered += 1
+
+        postprocess_batch_results.vis_utils.render_detection_bounding_boxes = _render_detection_bounding_boxes
+
+    def tearDown(self):
+        postprocess_batch_results.vis_utils.render_detection_bounding_boxes = \
+            self.render_detection_bounding_boxes
+        shutil.rmtree(self.temp_dir)
+
+    def run_postprocessing(self, confidence_threshold, force=False, output_dir=None, **kwargs):
+        if output_dir is None:
+            output_dir = self.output_dir
+        options = PostProcessingOptions()
+        options.api_output_file = self.api_output_file
+        options.output_dir = output_dir
+        options.image_base_dir = self.image_dir
+        options.viz_target_width = None
+        options.num_images_to_sample = -1
+        options.confidence_threshold = confidence_threshold
+        options.force = force
+        for k, v in kwargs.items():
+            setattr(options, k, v)
+        self.n_rendered = 0
+        postprocess_batch_results.process_batch_results(options)
+
+        with open(os.path.join(output_dir, RenderManifest.FILE_NAME)) as f:
+            return json.load(f)
+
+    def test_rerun(self):
+        manifest = self.run_postprocessing(0.5)
+        self.assertEqual(self.n_rendered, 10)
+        self.assertEqual(len(manifest['images']), 10)
+        self.assertEqual(sorted(manifest['pages']), ['detections', 'non_detections'])
+
+        # Nothing changed
+        page_mtime = os.stat(os.path.join(self.output_dir, 'detections.html')).st_mtime_ns
+        self.run_postprocessing(0.5)
+        self.assertEqual(self.n_rendered, 0)
+        self.assertEqual(os.stat(os.path.join(self.output_dir, 'detections.html')).st_mtime_ns, page_mtime)
+
+        # Only the image with a confidence of 0.55 moves from detections to non-detections and
+        # loses its box; images below 0.5 are still rendered without boxes
+        manifest = self.run_postprocessing(0.6)
+        self.assertEqual(self.n_rendered, 1)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.output_dir, 'non_detections', 'non_detections_cam1~IMG_0005.JPG')))
+
+        # Back to the first threshold; the rendering from the first run is still there
+        self.run_postprocessing(0.5)
+        self.assertEqual(self.n_rendered, 0)
+
+        self.run_postprocessing(0.5, force=True)
+        self.assertEqual(self.n_rendered, 10)
+
+    def test_changed_image(self):
+        self.run_postprocessing(0.5)
+        image_path = os.path.join(self.image_dir, 'cam0', 'IMG_0002.JPG')
+        Image.new('RGB', (32, 32), (0, 255, 0)).save(image_path)
+        st = os.stat(image_path)
+        os.utime(image_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+        self.run_postprocessing(0.5)
+        self.assertEqual(self.n_rendered, 1)
+
+    def test_process_pool(self):
+        expected_manifest = self.run_postprocessing(0.5)
+
+        output_dir = os.path.join(self.temp_dir, 'preview_processes')
+        manifest = self.run_postprocessing(0.5, output_dir=output_dir, parallelize_rendering=True,
+                                           parallelize_rendering_n_cores=2,
+                                           parallelize_rendering_with_threads=False,
+                                           parallelize_rendering_chunk_size=3)
+        self.assertEqual(manifest, expected_manifest)
+        for file_name in manifest['images']:
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, file_name)))
+
+        # Rerunning finds all images in the manifest, so doesn't start any workers
+        page_mtime = os.stat(os.path.join(output_dir, 'detections.html')).st_mtime_ns
+        self.assertEqual(self.run_postprocessing(0.5, output_dir=output_dir, parallelize_rendering=True,
+                                                 parallelize_rendering_with_threads=False), manifest)
+        self.assertEqual(os.stat(os.path.join(output_dir, 'detections.html')).st_mtime_ns, page_mtime)
+
+
+class GroundTruthEvaluationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_evaluation(self):
+        # (ground truth category, max detection confidence, top-1 classes of the detections)
+        images = [('deer', 0.9, ['1']), ('deer', 0.95, ['1', '2']), ('elk', 0.8, ['1']),
+                  ('elk', 0.2, []), ('empty', 0.7, []), ('empty', 0.1, []), ('empty', 0.05, []),
+                  ('unknown', 0.9, ['2'])]
+        gt_images, annotations, api_images = [], [], []
+        for i_image, (category, conf, classes) in enumerate(images):
+            file = 'cam/IMG_{:04d}.JPG'.format(i_image)
+            gt_images.append({'id': str(i_image), 'file_name': file})
+            annotations.append({'id': 'a' + str(i_image), 'image_id': str(i_image), 'category_id': category})
+            detections = [{'category': '1', 'conf': conf, 'bbox': [0, 0, 0.5, 0.5],
+                           'classifications': [[c, 0.8]]} for c in classes]
+            if len(classes) == 0 and conf > 0.1:
+                detections = [{'category': '1', 'conf': conf, 'bbox': [0, 0, 0.5, 0.5]}]
+            api_images.append({'file': file, 'max_detection_conf': conf, 'detections': detections})
+
+        # An image without ground truth
+        api_images.append({'file': 'other/IMG_0000.JPG', 'max_detection_conf': 0.9, 'detections': []})
+
+        gt_file = os.path.join(self.temp_dir, 'gt.json')
+        with open(gt_file, 'w') as f:
+            json.dump({'info': {}, 'images': gt_images, 'annotations': annotations,
+                       'categories': [{'id': c, 'name': c} for c in ['deer', 'elk', 'empty', 'unknown']]}, f)
+        api_output_file = os.path.join(self.temp_dir, 'results.json')
+        with open(api_output_file, 'w') as f:
+            json.dump({'info': {}, 'detection_categories': {'1': 'animal'},
+                       'classification_categories': {'1': 'deer', '2': 'elk'}, 'images': api_images}, f)
+
+        options = PostProcessingOptions()
+        options.api_output_file = api_output_file
+        options.ground_truth_json_file = gt_file
+        options.output_dir = os.path.join(self.temp_dir, 'preview')
+        options.confidence_threshold = 0.5
+        options.num_images_to_sample = -1
+        options.rendering_bypass_sets = ['tp', 'tpc', 'tpi', 'fp', 'tn', 'fn', 'class_deer', 'class_elk',
+                                         'class_empty']
+        ppresults = postprocess_batch_results.process_batch_results(options)
+
+        # At 0.5, 3 of the 4 positives and 1 of the 3 negatives are detected; the image with
+        # an unknown label is ignored.  The deer images have classification accuracies of 1 and
+        # 0.5, the elk image has 0.
+        with open(ppresults.output_html_file) as f:
+            index_page = f.read()
+        self.assertIn('precision=75.0%, recall=75.0%', index_page)
+        self.assertIn('Classification accuracy: 50.00%', index_page)
+        self.assertEqual(len(ppresults.api_detection_results), 9)
+        self.assertIn('<a href="tpc.html">with all correct top-1 predictions (TPC)</a> (1)', index_page)
+        self.assertIn('<a href="tpi.html">with one or more incorrect top-1 prediction (TPI)</a> (2)', 
+                      index_page)
+
+
+if __name__ == '__main__':
+    unittest.main()
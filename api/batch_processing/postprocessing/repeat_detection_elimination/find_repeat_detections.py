@@ -52,7 +52,7 @@ if False:
 
     options.filterFileToLoad = ''
     options.filterFileToLoad = os.path.join(baseDir,
-                                            r'repeatDetections\filtering_2019.05.16.18.43.01\detectionIndex.json')
+                                            r'repeatDetections\filtering_2019.05.16.18.43.01\detectionIndex.npz')
 
     options.debugMaxDir = -1
     options.debugMaxRenderDir = -1
@@ -96,7 +96,7 @@ def main():
     parser.add_argument('--outputBase', action='store', type=str, default='',
                         help='HTML or filtering folder output dir')
     parser.add_argument('--filterFileToLoad', action='store', type=str, default='',  # checks for string length so default needs to be the empty string
-                        help='Path to detectionIndex.json, which should be inside a folder of images that are manually verified to _not_ contain valid animals')
+                        help='Path to detectionIndex.npz (or detectionIndex.json from earlier versions), which should be inside a folder of images that are manually verified to _not_ contain valid animals')
 
     parser.add_argument('--confidenceMax', action='store', type=float,
                         default=defaultOptions.confidenceMax,
@@ -135,6 +135,19 @@ def main():
                         dest='bParallelizeComparisons')
     parser.add_argument('--forceSerialRendering', action='store_false',
                         dest='bParallelizeRendering')
+    parser.add_argument('--comparisonBackend', action='store', type=str,
+                        choices=['processes', 'threads'],
+                        default=defaultOptions.comparisonBackend,
+                        help='Parallelize comparisons across processes or threads; default is {}'.format(defaultOptions.comparisonBackend))
+    parser.add_argument('--noLargestDirectoriesFirst', action='store_false',
+                        dest='bLargestDirectoriesFirst',
+                        help='Process directories in input order rather than starting with the directories with the most detections')
+    parser.add_argument('--noSpatialIndex', action='store_false',
+                        dest='bUseSpatialIndex',
+                        help='Compare each detection with every candidate location rather than only with nearby ones (slower, same results)')
+    parser.add_argument('--useResultsCache', action='store_true',
+                        dest='bUseResultsCache',
+                        help='Load the input file from its sidecar cache of parsed results, or create one')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -27,6 +27,9 @@ def remove_repeat_detections(inputFile,outputFile,filteringDir,options=None):
     if options is None:
         options = repeat_detections_core.RepeatDetectionOptions()
     options.filterFileToLoad = os.path.join(filteringDir,repeat_detections_core.DETECTION_INDEX_FILE_NAME)
+    # Filtering folders written by earlier versions only have the .json index
+    if not os.path.isfile(options.filterFileToLoad):
+        options.filterFileToLoad = os.path.join(filteringDir,repeat_detections_core.LEGACY_DETECTION_INDEX_FILE_NAME)
     options.bWriteFilteringFolder = False
     repeat_detections_core.find_repeat_detections(inputFile, outputFile, options)
 
@@ -8,12 +8,16 @@
 
 # %% Imports and environment
 
+import math
 import os
+import time
 import warnings
 from datetime import datetime
 from itertools import compress
+from multiprocessing import Pool
 
 import jsonpickle
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
@@ -31,7 +35,6 @@ import ct_utils
 
 # Imports I'm not using but use when I tinker with parallelization
 #
-# from multiprocessing import Pool
 # from multiprocessing.pool import ThreadPool
 # import multiprocessing
 # import joblib
@@ -44,7 +47,12 @@ warnings.filterwarnings('ignore', 'Metadata warning', UserWarning)
 
 #%% Constants
 
-DETECTION_INDEX_FILE_NAME = 'detectionIndex.json'
+# The detection index written to filtering folders, as a DetectionLocationStore
+DETECTION_INDEX_FILE_NAME = 'detectionIndex.npz'
+
+# The detection index in filtering folders written by earlier versions, as jsonpickle'd
+# lists of DetectionLocations; can still be loaded
+LEGACY_DETECTION_INDEX_FILE_NAME = 'detectionIndex.json'
 
 
 #%% Classes
@@ -86,8 +94,8 @@ class RepeatDetectionOptions:
 
     # Load detections from a filter file rather than finding them from the detector output
 
-    # .json file containing detections, should be called detectionIndex.json in the filtering_* folder 
-    # produced in the first pass
+    # file containing detections, should be called detectionIndex.npz (DETECTION_INDEX_FILE_NAME) in the 
+    # filtering_* folder produced in the first pass; the older detectionIndex.json files can also be loaded
     filterFileToLoad = ''
 
     # (optional) List of filenames remaining after deletion of identified 
@@ -104,6 +112,26 @@ class RepeatDetectionOptions:
     debugMaxRenderDetection = -1
     debugMaxRenderInstance = -1
     bParallelizeComparisons = True
+
+    # How to parallelize comparisons: 'processes' sends the boxes of each directory to a
+    # pool of nWorkers processes; 'threads' runs directories on joblib threads, which share
+    # the GIL, so it only helps while the main thread is waiting
+    comparisonBackend = 'processes'
+
+    # Start with the directories with the most detections, so that a single huge camera
+    # doesn't start last and keep one worker busy long after the others are done
+    bLargestDirectoriesFirst = True
+
+    # How many of the slowest directories to list after finding matches
+    nSlowestDirectoriesToPrint = 10
+
+    # Compare each detection only with the candidate locations whose boxes are near enough
+    # to possibly reach iouThreshold, found via a grid over box centers; the results are the
+    # same as comparing with every candidate
+    bUseSpatialIndex = True
+
+    # Size of the grid cells (in relative coordinates) for the spatial index
+    spatialIndexCellSize = 0.02
     bParallelizeRendering = True
 
     bPrintMissingImageWarnings = True
@@ -116,6 +144,10 @@ class RepeatDetectionOptions:
     # has changed relative to the structure the detector saw
     filenameReplacements = {}
 
+    # Load the input file from its sidecar cache of parsed results, or create one
+    # (see api_results_cache.py)
+    bUseResultsCache = False
+
     # How many folders up from the leaf nodes should we be going to aggregate images?
     nDirLevelsFromLeaf = 0
 
@@ -145,6 +177,14 @@ class RepeatDetectionResults:
     # objects for that directory that have been flagged as suspicious
     suspiciousDetections = None
 
+    # The same locations as a DetectionLocationStore
+    suspiciousDetectionStore = None
+
+    # An array of length nDirs, where each element is a dict with the time spent finding
+    # matches in that directory: dirName, nInstances (candidate detections), 
+    # extractSeconds (selecting candidates from the table) and matchSeconds
+    directoryTimings = None
+
     masterHtmlFile = None
 
     filterFile = None
@@ -197,6 +237,342 @@ class DetectionLocation:
         return detection
 
 
+class CandidateInstances:
+    """
+    The candidate detections of one directory (see get_candidate_instances) as parallel
+    arrays, rather than as one IndexedDetection per detection.
+    """
+
+    def __init__(self, filenames, fileIndex, iDetection, bbox, confidence, categories, categoryIndex):
+        """
+        Args:
+            filenames: list of the files these detections are on
+            fileIndex: int array, the index in filenames of each detection's file
+            iDetection: int array, the index of each detection in the detections of its file
+            bbox: [N x 4] float64 array of boxes (x_min, y_min, width, height)
+            confidence: float64 array
+            categories: list of the category IDs (str) of these detections
+            categoryIndex: int array, the index in categories of each detection's category
+        """
+        self.filenames = filenames
+        self.fileIndex = np.asarray(fileIndex, dtype=np.int32)
+        self.iDetection = np.asarray(iDetection, dtype=np.int32)
+        self.bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self.categories = categories
+        self.categoryIndex = np.asarray(categoryIndex, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.iDetection)
+
+    def get_instance(self, i):
+        return IndexedDetection(iDetection=int(self.iDetection[i]),
+                                filename=self.filenames[self.fileIndex[i]],
+                                bbox=self.bbox[i].tolist(),
+                                confidence=float(self.confidence[i]),
+                                category=self.categories[self.categoryIndex[i]])
+
+
+class DetectionLocationStore:
+    """
+    Detection locations of all directories, typically the suspicious ones, in columnar form:
+    instances are parallel arrays, and locations refer to ranges of instances, so that 
+    millions of instances don't need millions of Python objects. This is what is written to
+    the detection index of a filtering folder (DETECTION_INDEX_FILE_NAME) with save().
+
+    The instances of location i are rows locationInstanceStart[i]:locationInstanceStart[i+1]
+    of the instance arrays (an instance that matched several locations is stored once for
+    each), and the locations of directory d are dirLocationStart[d]:dirLocationStart[d+1].
+    """
+
+    # Arrays saved by save(); string tables are saved as unicode arrays, so loading doesn't
+    # need pickle
+    fieldNames = ['dirNames', 'filenames', 'categories',
+                  'instanceFileIndex', 'instanceDetectionIndex', 'instanceBbox',
+                  'instanceConfidence', 'instanceCategoryIndex',
+                  'locationBbox', 'locationInstanceStart', 'locationSampleImage',
+                  'dirLocationStart']
+
+    def __init__(self, **fields):
+        for fieldName in DetectionLocationStore.fieldNames:
+            setattr(self, fieldName, fields[fieldName])
+
+    @property
+    def nLocations(self):
+        return len(self.locationBbox)
+
+    @property
+    def nInstances(self):
+        return len(self.instanceFileIndex)
+
+    @classmethod
+    def from_matches(cls, dirNames, instancesByDirectory, matchesByDirectory, minOccurrences=0):
+        """
+        Builds a store from the output of match_detection_boxes for each directory, keeping
+        only locations with at least minOccurrences instances.
+
+        Args:
+            dirNames: list of directory names
+            instancesByDirectory: list of CandidateInstances, one per directory
+            matchesByDirectory: list of (locationSeeds, locationOffsets, locationMembers), one per directory
+        """
+
+        filenames, categories, categoryToIndex = [], [], {}
+        instanceFields = {'instanceFileIndex': [], 'instanceDetectionIndex': [], 'instanceBbox': [],
+                          'instanceConfidence': [], 'instanceCategoryIndex': []}
+        locationBbox, locationSizes, dirLocationCounts = [], [], []
+
+        for instances, (locationSeeds, locationOffsets, locationMembers) in zip(instancesByDirectory,
+                                                                               matchesByDirectory):
+
+            sizes = np.diff(locationOffsets)
+            keep = sizes >= minOccurrences
+            dirLocationCounts.append(int(keep.sum()))
+            if not keep.any():
+                continue
+
+            # Instance indices of the kept locations, location by location, i.e. the 
+            # concatenation of locationMembers[start:start+size] for each kept location
+            starts = locationOffsets[:-1][keep]
+            keptSizes = sizes[keep]
+            keptStarts = np.cumsum(keptSizes) - keptSizes
+            positionInLocation = np.arange(keptSizes.sum()) - np.repeat(keptStarts, keptSizes)
+            members = locationMembers[np.repeat(starts, keptSizes) + positionInLocation]
+
+            # Map this directory's string tables into the global ones
+            categoryMap = np.zeros(max(len(instances.categories), 1), dtype=np.int16)
+            for i, category in enumerate(instances.categories):
+                if category not in categoryToIndex:
+                    categoryToIndex[category] = len(categories)
+                    categories.append(category)
+                categoryMap[i] = categoryToIndex[category]
+
+            instanceFields['instanceFileIndex'].append(instances.fileIndex[members] + len(filenames))
+            instanceFields['instanceDetectionIndex'].append(instances.iDetection[members])
+            instanceFields['instanceBbox'].append(instances.bbox[members])
+            instanceFields['instanceConfidence'].append(instances.confidence[members])
+            instanceFields['instanceCategoryIndex'].append(categoryMap[instances.categoryIndex[members]])
+            filenames.extend(instances.filenames)
+
+            locationBbox.append(instances.bbox[locationSeeds[keep]])
+            locationSizes.append(keptSizes)
+
+        return cls._from_lists(dirNames, filenames, categories, instanceFields, locationBbox,
+                               locationSizes, dirLocationCounts, None)
+
+    @classmethod
+    def from_location_lists(cls, dirNames, locationLists):
+        """
+        Builds a store from a list of lists of DetectionLocations, one list per directory, e.g.
+        as loaded from a jsonpickle'd detection index.
+        """
+
+        filenames, filenameToIndex, categories, categoryToIndex = [], {}, [], {}
+        instanceFields = {'instanceFileIndex': [], 'instanceDetectionIndex': [], 'instanceBbox': [],
+                          'instanceConfidence': [], 'instanceCategoryIndex': []}
+        locationBbox, locationSizes, dirLocationCounts, sampleImages = [], [], [], []
+
+        for locations in locationLists:
+            dirLocationCounts.append(len(locations))
+            for location in locations:
+                locationBbox.append(np.array([location.bbox], dtype=np.float64).reshape(-1, 4))
+                locationSizes.append(np.array([len(location.instances)]))
+                sampleImages.append(location.sampleImageRelativeFileName)
+                for instance in location.instances:
+                    if instance.filename not in filenameToIndex:
+                        filenameToIndex[instance.filename] = len(filenames)
+                        filenames.append(instance.filename)
+                    if instance.category not in categoryToIndex:
+                        categoryToIndex[instance.category] = len(categories)
+                        categories.append(instance.category)
+                    instanceFields['instanceFileIndex'].append([filenameToIndex[instance.filename]])
+                    instanceFields['instanceDetectionIndex'].append([instance.iDetection])
+                    instanceFields['instanceBbox'].append(np.array([instance.bbox], dtype=np.float64).reshape(-1, 4))
+                    instanceFields['instanceConfidence'].append([instance.confidence])
+                    instanceFields['instanceCategoryIndex'].append([categoryToIndex[instance.category]])
+
+        return cls._from_lists(dirNames, filenames, categories, instanceFields, locationBbox,
+                               locationSizes, dirLocationCounts, sampleImages)
+
+    @classmethod
+    def _from_lists(cls, dirNames, filenames, categories, instanceFields, locationBbox,
+                    locationSizes, dirLocationCounts, sampleImages):
+
+        dtypes = {'instanceFileIndex': np.int32, 'instanceDetectionIndex': np.int32,
+                  'instanceBbox': np.float64, 'instanceConfidence': np.float64,
+                  'instanceCategoryIndex': np.int16}
+        fields = {}
+        for fieldName, dtype in dtypes.items():
+            if len(instanceFields[fieldName]) == 0:
+                fields[fieldName] = np.zeros((0, 4) if fieldName == 'instanceBbox' else 0, dtype=dtype)
+            else:
+                fields[fieldName] = np.concatenate(
+                    [np.asarray(a, dtype=dtype) for a in instanceFields[fieldName]])
+
+        locationBbox = np.concatenate(locationBbox) if len(locationBbox) > 0 else np.zeros((0, 4))
+        locationSizes = np.concatenate(locationSizes) if len(locationSizes) > 0 else np.zeros(0, dtype=np.int64)
+        if sampleImages is None:
+            sampleImages = [''] * len(locationBbox)
+
+        fields['dirNames'] = np.array(dirNames, dtype=str)
+        fields['filenames'] = np.array(filenames, dtype=str)
+        fields['categories'] = np.array(categories, dtype=str)
+        fields['locationBbox'] = locationBbox
+        fields['locationInstanceStart'] = np.concatenate([[0], np.cumsum(locationSizes)]).astype(np.int64)
+        fields['locationSampleImage'] = np.array(sampleImages, dtype=str)
+        fields['dirLocationStart'] = np.concatenate([[0], np.cumsum(dirLocationCounts)]).astype(np.int64)
+        return cls(**fields)
+
+    def to_location_lists(self):
+        """
+        Returns a list of lists of DetectionLocations, one list per directory.
+        """
+
+        # Convert the string tables and arrays once, rather than per instance
+        filenames = self.filenames.tolist()
+        categories = self.categories.tolist()
+        fileIndex = self.instanceFileIndex.tolist()
+        iDetection = self.instanceDetectionIndex.tolist()
+        bbox = self.instanceBbox.tolist()
+        confidence = self.instanceConfidence.tolist()
+        categoryIndex = self.instanceCategoryIndex.tolist()
+        locationBbox = self.locationBbox.tolist()
+        locationInstanceStart = self.locationInstanceStart.tolist()
+        sampleImages = self.locationSampleImage.tolist()
+
+        locationLists = []
+        for iDir, dirName in enumerate(self.dirNames.tolist()):
+            locations = []
+            for iLocation in range(self.dirLocationStart[iDir], self.dirLocationStart[iDir + 1]):
+                instances = []
+                for i in range(locationInstanceStart[iLocation], locationInstanceStart[iLocation + 1]):
+                    instances.append(IndexedDetection(iDetection=iDetection[i], filename=filenames[fileIndex[i]],
+                                                      bbox=bbox[i], confidence=confidence[i],
+                                                      category=categories[categoryIndex[i]]))
+                location = DetectionLocation(instances[0], {'bbox': locationBbox[iLocation]}, dirName)
+                location.instances = instances
+                location.sampleImageRelativeFileName = sampleImages[iLocation]
+                locations.append(location)
+            locationLists.append(locations)
+        return locationLists
+
+    def save(self, path):
+        """
+        Writes the store to the .npz file *path*.
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, **{fieldName: getattr(self, fieldName) for fieldName in DetectionLocationStore.fieldNames})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(**{fieldName: data[fieldName] for fieldName in DetectionLocationStore.fieldNames})
+
+
+def load_detection_index(detectionIndexFileName, dirNames):
+    """
+    Loads the suspicious detections from a filtering folder's detection index, either a
+    DetectionLocationStore (.npz) or, from filtering folders written by earlier versions, 
+    jsonpickle'd lists of DetectionLocations (.json).
+
+    Returns:
+        a list of lists of DetectionLocations, one list per directory in dirNames
+    """
+
+    if detectionIndexFileName.endswith('.npz'):
+        store = DetectionLocationStore.load(detectionIndexFileName)
+        assert store.dirNames.tolist() == list(dirNames), \
+            'The detection index was written for different directories than the input file has'
+        return store.to_location_lists()
+
+    with open(detectionIndexFileName, 'r') as f:
+        return jsonpickle.decode(f.read())
+
+
+class CandidateLocationIndex:
+    """
+    The boxes of the candidate locations found so far in one directory, indexed by a uniform
+    grid over their centers, to find all locations whose box could have an IoU of at least
+    iouThreshold with a given box without comparing with every location.
+
+    If IoU(a,b) >= t, the intersection of a and b is at least t times the area of each box,
+    so its width is at least t * max(w_a, w_b), which requires
+    |center_x(a) - center_x(b)| <= w_a * (1 - t) / t (and likewise for y). Only grid cells
+    within that distance of the query box's center need to be searched.
+    """
+
+    def __init__(self, iouThreshold, cellSize=0.02):
+        self.iouThreshold = iouThreshold
+        self.cellSize = cellSize
+        self.nLocations = 0
+
+        # [nLocations x 4] array of location boxes (x_min, y_min, width, height); only the
+        # first nLocations rows are valid, the rest is spare capacity
+        self.bboxes = np.zeros((64, 4))
+
+        # Maps (column, row) grid cells to the indices of the locations centered in them
+        self.grid = {}
+
+    def __len__(self):
+        return self.nLocations
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.cellSize), math.floor(y / self.cellSize))
+
+    def add(self, bbox):
+        """
+        Adds a location with box bbox, returning its index.
+        """
+
+        iLocation = self.nLocations
+        if iLocation == len(self.bboxes):
+            self.bboxes = np.concatenate([self.bboxes, np.zeros_like(self.bboxes)])
+        self.bboxes[iLocation] = bbox
+        self.nLocations += 1
+        cell = self._cell(bbox[0] + bbox[2] / 2, bbox[1] + bbox[3] / 2)
+        self.grid.setdefault(cell, []).append(iLocation)
+        return iLocation
+
+    def _candidate_indices(self, bbox):
+        """
+        Returns the sorted indices of the locations that could match bbox.
+        """
+
+        if self.iouThreshold <= 0:
+            return np.arange(self.nLocations)
+
+        # A little slack, so that floating-point error never excludes a true match
+        rx = bbox[2] * (1 - self.iouThreshold) / self.iouThreshold + 1e-6
+        ry = bbox[3] * (1 - self.iouThreshold) / self.iouThreshold + 1e-6
+        x, y = bbox[0] + bbox[2] / 2, bbox[1] + bbox[3] / 2
+        col_min, row_min = self._cell(x - rx, y - ry)
+        col_max, row_max = self._cell(x + rx, y + ry)
+
+        # If the search area spans more cells than there are locations, it's cheaper to
+        # compare with everything
+        if (col_max - col_min + 1) * (row_max - row_min + 1) > self.nLocations:
+            return np.arange(self.nLocations)
+
+        indices = []
+        for col in range(col_min, col_max + 1):
+            for row in range(row_min, row_max + 1):
+                indices.extend(self.grid.get((col, row), []))
+        indices.sort()
+        return np.array(indices, dtype=np.int64)
+
+    def find_matches(self, bbox):
+        """
+        Returns the indices of the locations whose box has an IoU of at least iouThreshold
+        with bbox, in increasing order.
+        """
+
+        indices = self._candidate_indices(bbox)
+        if len(indices) == 0:
+            return indices
+        iou = ct_utils.get_iou_batch(bbox, self.bboxes[indices])
+        return indices[iou >= self.iouThreshold]
+
+
 ##%% Helper functions
 
 def enumerate_images(dirName,outputFileName=None):
@@ -229,13 +605,15 @@ def render_bounding_box(detection, inputFileName, outputFileName, lineWidth):
 
 ##%% Look for matches (one directory) (function)
 
-def find_matches_in_directory(dirName, options, rowsByDirectory):
-    
-    if options.pbar is not None:
-        options.pbar.update()
+def get_candidate_instances(dirName, options, rowsByDirectory):
+    """
+    Returns the detections in directory dirName that could be repeat detections, i.e. that
+    pass the confidence, class and size criteria in options, as CandidateInstances in the
+    order of the input file.
+    """
 
-    # List of DetectionLocations
-    candidateDetections = []
+    filenames, fileIndex, iDetections, bboxes, confidences = [], [], [], [], []
+    categories, categoryToIndex, categoryIndex = [], {}, []
 
     rows = rowsByDirectory[dirName]
 
@@ -281,7 +659,6 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                     continue
 
             bbox = detection['bbox']
-            confidence = detection['conf']
             
             # Is this detection too big to be suspicious?
             w, h = bbox[2], bbox[3]
@@ -294,44 +671,206 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                 # print('Ignoring very large detection with area {}'.format(area))
                 continue
 
+            if len(filenames) == 0 or filenames[-1] != filename:
+                filenames.append(filename)
             category = detection['category']
-            
-            instance = IndexedDetection(iDetection=iDetection,
-                                        filename=row['file'], bbox=bbox, 
-                                        confidence=confidence, category=category)
+            if category not in categoryToIndex:
+                categoryToIndex[category] = len(categories)
+                categories.append(category)
 
-            bFoundSimilarDetection = False
+            fileIndex.append(len(filenames) - 1)
+            iDetections.append(iDetection)
+            bboxes.append(bbox)
+            confidences.append(confidence)
+            categoryIndex.append(categoryToIndex[category])
 
-            # For each detection in our candidate list
-            for iCandidate, candidate in enumerate(candidateDetections):
+        # ...for each detection
 
-                # Is this a match?                    
-                iou = ct_utils.get_iou(bbox, candidate.bbox)
+    # ...for each row
 
-                if iou >= options.iouThreshold:
-                    
-                    bFoundSimilarDetection = True
+    return CandidateInstances(filenames, fileIndex, iDetections, bboxes, confidences,
+                              categories, categoryIndex)
 
-                    # If so, add this example to the list for this detection
-                    candidate.instances.append(instance)
 
-                    # We *don't* break here; we allow this instance to possibly
-                    # match multiple candidates.  There isn't an obvious right or
-                    # wrong here.
+def match_detection_boxes(bboxes, iouThreshold, bUseSpatialIndex=True, cellSize=0.02):
+    """
+    Groups boxes into locations: each box is added to every location whose box has an IoU
+    of at least iouThreshold with it, or starts a new location if there is none. We allow a
+    box to match multiple locations; there isn't an obvious right or wrong here.
 
-            # ...for each detection on our candidate list
+    Only works on plain arrays, so it can run in another process.
 
-            # If we found no matches, add this to the candidate list
-            if not bFoundSimilarDetection:
-                candidate = DetectionLocation(instance, detection, dirName)
-                candidateDetections.append(candidate)
+    Args:
+        bboxes: [N x 4] array of boxes (x_min, y_min, width, height), in the order to process them
+        iouThreshold, bUseSpatialIndex, cellSize: as in RepeatDetectionOptions
 
-        # ...for each detection
+    Returns:
+        locationSeeds: array with, for each location, the index of the box that started it
+        locationOffsets, locationMembers: the indices of the boxes in location i (in increasing
+            order, starting with its seed) are locationMembers[locationOffsets[i]:locationOffsets[i+1]]
+    """
+
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+
+    # For each location, the list of box indices
+    locationMembers = []
+    if bUseSpatialIndex:
+        locationIndex = CandidateLocationIndex(iouThreshold, cellSize)
+
+    for iBox, bbox in enumerate(bboxes.tolist()):
+
+        if bUseSpatialIndex:
+            matches = locationIndex.find_matches(bbox)
+        else:
+            # For each location on our candidate list, is this a match?
+            matches = [iLocation for iLocation, members in enumerate(locationMembers)
+                       if ct_utils.get_iou(bbox, bboxes[members[0]].tolist()) >= iouThreshold]
+
+        for iLocation in matches:
+            locationMembers[iLocation].append(iBox)
+
+        # If we found no matches, this starts a new location
+        if len(matches) == 0:
+            locationMembers.append([iBox])
+            if bUseSpatialIndex:
+                locationIndex.add(bbox)
+
+    locationSeeds = np.array([members[0] for members in locationMembers], dtype=np.int64)
+    locationOffsets = np.zeros(len(locationMembers) + 1, dtype=np.int64)
+    locationOffsets[1:] = np.cumsum([len(members) for members in locationMembers])
+    locationMembers = np.array([iBox for members in locationMembers for iBox in members], dtype=np.int64)
+    return locationSeeds, locationOffsets, locationMembers
 
-    # ...for each row
 
+def locations_from_matches(dirName, instances, locationSeeds, locationOffsets, locationMembers):
+    """
+    Builds the list of DetectionLocations for one directory from the output of 
+    match_detection_boxes on the boxes of *instances* (CandidateInstances).
+    """
+
+    # One IndexedDetection per candidate detection, shared by the locations it matched
+    indexedDetections = [instances.get_instance(i) for i in range(len(instances))]
+
+    candidateDetections = []
+    for iLocation, iSeed in enumerate(locationSeeds):
+        seed = indexedDetections[iSeed]
+        location = DetectionLocation(seed, {'bbox': seed.bbox}, dirName)
+        members = locationMembers[locationOffsets[iLocation]:locationOffsets[iLocation + 1]]
+        location.instances = [indexedDetections[iBox] for iBox in members]
+        candidateDetections.append(location)
     return candidateDetections
 
+
+def find_matches_in_directory_compact(dirName, options, rowsByDirectory):
+    """
+    Finds the detection locations in directory dirName.
+
+    Returns:
+        the CandidateInstances of the directory, the output of match_detection_boxes on them
+        and a dict with the time spent (see RepeatDetectionResults.directoryTimings)
+    """
+    
+    if options.pbar is not None:
+        options.pbar.update()
+
+    startTime = time.time()
+    instances = get_candidate_instances(dirName, options, rowsByDirectory)
+    extractSeconds = time.time() - startTime
+
+    startTime = time.time()
+    matches = match_detection_boxes(instances.bbox, options.iouThreshold, 
+                                    options.bUseSpatialIndex, options.spatialIndexCellSize)
+    matchSeconds = time.time() - startTime
+
+    timing = {'dirName': dirName, 'nInstances': len(instances), 
+              'extractSeconds': extractSeconds, 'matchSeconds': matchSeconds}
+    return instances, matches, timing
+
+
+def find_matches_in_directory(dirName, options, rowsByDirectory):
+    """
+    Returns the list of DetectionLocations in directory dirName.
+    """
+    
+    instances, matches, _ = find_matches_in_directory_compact(dirName, options, rowsByDirectory)
+    return locations_from_matches(dirName, instances, *matches)
+
+
+def match_detection_boxes_in_worker(task):
+    """
+    Runs match_detection_boxes for one directory in a worker process.
+
+    Args:
+        task: tuple of (iDir, [N x 4] float64 array of boxes, iouThreshold, bUseSpatialIndex, cellSize)
+
+    Returns:
+        (iDir, (locationSeeds, locationOffsets, locationMembers), matchSeconds)
+    """
+
+    iDir, bboxes, iouThreshold, bUseSpatialIndex, cellSize = task
+    startTime = time.time()
+    matches = match_detection_boxes(bboxes, iouThreshold, bUseSpatialIndex, cellSize)
+    return iDir, matches, time.time() - startTime
+
+
+def find_matches_in_directories_with_process_pool(dirsToSearch, options, rowsByDirectory):
+    """
+    Finds the detection locations for each directory in dirsToSearch. Candidate detections
+    are selected in this process, and only their boxes are sent to a pool of 
+    options.nWorkers processes.
+
+    Returns:
+        lists of the CandidateInstances, the output of match_detection_boxes and the timing
+        dicts, one per directory
+    """
+
+    print('Selecting candidate detections...')
+    instancesByDirectory = []
+    extractSeconds = []
+    for dirName in tqdm(dirsToSearch):
+        startTime = time.time()
+        instancesByDirectory.append(get_candidate_instances(dirName, options, rowsByDirectory))
+        extractSeconds.append(time.time() - startTime)
+
+    dirOrder = list(range(len(dirsToSearch)))
+    if options.bLargestDirectoriesFirst:
+        dirOrder.sort(key=lambda iDir: len(instancesByDirectory[iDir]), reverse=True)
+
+    def _tasks():
+        for iDir in dirOrder:
+            yield (iDir, instancesByDirectory[iDir].bbox, options.iouThreshold, options.bUseSpatialIndex,
+                   options.spatialIndexCellSize)
+
+    matchesByDirectory = [None] * len(dirsToSearch)
+    timings = [None] * len(dirsToSearch)
+
+    print('Finding similar detections in {} processes...'.format(options.nWorkers))
+    with Pool(options.nWorkers) as pool:
+        for iDir, matches, matchSeconds in tqdm(pool.imap_unordered(match_detection_boxes_in_worker, _tasks()),
+                                                total=len(dirsToSearch)):
+            dirName = dirsToSearch[iDir]
+            matchesByDirectory[iDir] = matches
+            timings[iDir] = {'dirName': dirName, 'nInstances': len(instancesByDirectory[iDir]),
+                             'extractSeconds': extractSeconds[iDir], 'matchSeconds': matchSeconds}
+
+    return instancesByDirectory, matchesByDirectory, timings
+
+
+def print_directory_timings(timings, nToPrint=10):
+    """
+    Prints the total time spent finding matches and the nToPrint slowest directories.
+    """
+
+    totalExtract = sum(t['extractSeconds'] for t in timings)
+    totalMatch = sum(t['matchSeconds'] for t in timings)
+    print('Time spent finding matches: {:.1f}s selecting candidates, {:.1f}s matching '
+          '(summed over directories)'.format(totalExtract, totalMatch))
+
+    slowest = sorted(timings, key=lambda t: t['extractSeconds'] + t['matchSeconds'], reverse=True)
+    for t in slowest[0:nToPrint]:
+        print('  {}: {} candidate detections, {:.2f}s selecting, {:.2f}s matching'.format(
+            t['dirName'], t['nInstances'], t['extractSeconds'], t['matchSeconds']))
+
 # ...def find_matches_in_directory(dirName)
 
     
@@ -457,112 +996,91 @@ def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
 
 ##%% Update the detection table based on suspicious results, write .csv output
 
-def update_detection_table(RepeatDetectionResults, options, outputFilename=None):
-    
-    detectionResults = RepeatDetectionResults.detectionResults
-
-    # An array of length nDirs, where each element is a list of DetectionLocation 
-    # objects for that directory that have been flagged as suspicious
-    suspiciousDetectionsByDirectory = RepeatDetectionResults.suspiciousDetections
-
-    nBboxChanges = 0
-
-    print('Updating output table')
-
-    # For each directory
-    for iDir, directoryEvents in enumerate(suspiciousDetectionsByDirectory):
-
-        # For each suspicious detection group in this directory
-        for iDetectionEvent, detectionEvent in enumerate(directoryEvents):
-
-            locationBbox = detectionEvent.bbox
-
-            # For each instance of this suspicious detection
-            for iInstance, instance in enumerate(detectionEvent.instances):
+def get_detection_confidences(detectionResults):
+    """
+    Flattens the detections of all rows of detectionResults into one array of confidences.
 
-                instanceBbox = instance.bbox
+    Returns:
+        the confidences, a float64 array with one element per detection, and the number of 
+        detections in each row
+    """
 
-                # This should match the bbox for the detection event
-                iou = ct_utils.get_iou(instanceBbox, locationBbox)
-                
-                # The bbox for this instance should be almost the same as the bbox
-                # for this detection group, where "almost" is defined by the IOU
-                # threshold.
-                assert iou >= options.iouThreshold
-                # if iou < options.iouThreshold:
-                #    print('IOU warning: {},{}'.format(iou,options.iouThreshold))
-
-                assert instance.filename in RepeatDetectionResults.filenameToRow
-                iRow = RepeatDetectionResults.filenameToRow[instance.filename]
-                row = detectionResults.iloc[iRow]
-                rowDetections = row['detections']
-                detectionToModify = rowDetections[instance.iDetection]
-
-                # Make sure the bounding box matches
-                assert (instanceBbox[0:3] == detectionToModify['bbox'][0:3])
-
-                # Make the probability negative, if it hasn't been switched by
-                # another bounding box
-                if detectionToModify['conf'] >= 0:
-                    detectionToModify['conf'] = -1 * detectionToModify['conf']
-                    nBboxChanges += 1
-
-            # ...for each instance
+    detectionsColumn = detectionResults['detections'].values
+    nDetectionsPerRow = np.fromiter((len(detections) for detections in detectionsColumn), 
+                                    dtype=np.int64, count=len(detectionsColumn))
+    confidences = np.fromiter((detection['conf'] for detections in detectionsColumn for detection in detections),
+                              dtype=np.float64, count=int(nDetectionsPerRow.sum()))
+    return confidences, nDetectionsPerRow
 
-        # ...for each detection
 
-    # ...for each directory       
+def update_detection_table(RepeatDetectionResults, options, outputFilename=None):
+    
+    detectionResults = RepeatDetectionResults.detectionResults
+    detectionsColumn = detectionResults['detections'].values
 
-    # Update maximum probabilities
+    # The locations that have been flagged as suspicious, as a DetectionLocationStore
+    store = RepeatDetectionResults.suspiciousDetectionStore
+    if store is None:
+        store = DetectionLocationStore.from_location_lists([''] * len(RepeatDetectionResults.suspiciousDetections),
+                                                           RepeatDetectionResults.suspiciousDetections)
 
-    # For each row...
-    nProbChanges = 0
-    nProbChangesToNegative = 0
-    nProbChangesAcrossThreshold = 0
+    print('Updating output table')
 
-    for iRow, row in detectionResults.iterrows():
+    # The bbox for each instance should be almost the same as the bbox for its
+    # location, where "almost" is defined by the IOU threshold.
+    for iLocation in range(store.nLocations):
+        iStart, iEnd = store.locationInstanceStart[iLocation], store.locationInstanceStart[iLocation + 1]
+        iou = ct_utils.get_iou_batch(store.locationBbox[iLocation], store.instanceBbox[iStart:iEnd])
+        assert (iou >= options.iouThreshold).all()
+
+    # Find the (row, detection index) pair of each suspicious instance; an instance that 
+    # belongs to several locations is only changed once
+    filenameRows = np.array([RepeatDetectionResults.filenameToRow[filename] for filename in store.filenames.tolist()], 
+                            dtype=np.int64)
+    instanceRows = filenameRows[store.instanceFileIndex]
+    rowsAndDetections, iFirstInstance = np.unique(
+        np.stack([instanceRows, store.instanceDetectionIndex.astype(np.int64)], axis=1), axis=0, return_index=True)
 
-        detections = row['detections']
-        if len(detections) == 0:
-            continue
-
-        maxPOriginal = float(row['max_detection_conf'])
-        assert maxPOriginal >= 0
+    nBboxChanges = 0
+    for (iRow, iDetection), iInstance in zip(rowsAndDetections.tolist(), iFirstInstance.tolist()):
 
-        maxP = None
-        nNegative = 0
+        detectionToModify = detectionsColumn[iRow][iDetection]
 
-        for iDetection, detection in enumerate(detections):
-            p = detection['conf']
+        # Make sure the bounding box matches
+        assert (store.instanceBbox[iInstance][0:3].tolist() == detectionToModify['bbox'][0:3])
 
-            if p < 0:
-                nNegative += 1
+        # Make the probability negative, if it hasn't been switched before
+        if detectionToModify['conf'] >= 0:
+            detectionToModify['conf'] = -1 * detectionToModify['conf']
+            nBboxChanges += 1
 
-            if (maxP is None) or (p > maxP):
-                maxP = p
-        
-        if abs(maxP - maxPOriginal) > 1e-3:
+    # Update maximum probabilities, for all rows with detections
 
-            # We should only be making detections *less* likely
-            assert maxP < maxPOriginal
-            # row['max_confidence'] = str(maxP)
-            detectionResults.at[iRow, 'max_detection_conf'] = maxP
+    confidences, nDetectionsPerRow = get_detection_confidences(detectionResults)
+    hasDetections = nDetectionsPerRow > 0
+    rowStarts = (np.cumsum(nDetectionsPerRow) - nDetectionsPerRow)[hasDetections]
 
-            nProbChanges += 1
+    maxP = np.maximum.reduceat(confidences, rowStarts) if len(rowStarts) > 0 else np.zeros(0)
+    nNegative = np.add.reduceat((confidences < 0).astype(np.int64), rowStarts) if len(rowStarts) > 0 else np.zeros(0)
+    maxPOriginal = detectionResults['max_detection_conf'].to_numpy(dtype=np.float64)[hasDetections]
+    assert (maxPOriginal >= 0).all()
 
-            if maxP < 0:
-                nProbChangesToNegative += 1
+    changed = np.abs(maxP - maxPOriginal) > 1e-3
 
-            if maxPOriginal >= options.confidenceMin and maxP < options.confidenceMin:
-                nProbChangesAcrossThreshold += 1
+    # We should only be making detections *less* likely
+    assert (maxP[changed] < maxPOriginal[changed]).all()
 
-            # Negative probabilities should be the only reason maxP changed, so
-            # we should have found at least one negative value
-            assert nNegative > 0
+    # Negative probabilities should be the only reason maxP changed, so
+    # we should have found at least one negative value
+    assert (nNegative[changed] > 0).all()
 
-        # ...if there was a meaningful change to the max probability for this row
+    iChangedRows = np.flatnonzero(hasDetections)[changed]
+    detectionResults.iloc[iChangedRows, detectionResults.columns.get_loc('max_detection_conf')] = maxP[changed]
 
-    # ...for each row
+    nProbChanges = int(changed.sum())
+    nProbChangesToNegative = int((maxP[changed] < 0).sum())
+    nProbChangesAcrossThreshold = int(((maxPOriginal[changed] >= options.confidenceMin) &
+                                       (maxP[changed] < options.confidenceMin)).sum())
 
     # If we're also writing output...
     if outputFilename is not None and len(outputFilename) > 0:
@@ -599,7 +1117,8 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
     # Load file
 
     detectionResults, otherFields = load_api_results(inputFilename, normalize_paths=True,
-                                         filename_replacements=options.filenameReplacements)
+                                         filename_replacements=options.filenameReplacements,
+                                         use_cache=options.bUseResultsCache)
     toReturn.detectionResults = detectionResults
     toReturn.otherFields = otherFields
 
@@ -682,56 +1201,60 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
         # We're actually looking for matches...
         print('Finding similar detections...')
 
-        allCandidateDetections = [None] * len(dirsToSearch)
-
-        if not options.bParallelizeComparisons:
+        if not options.bParallelizeComparisons or options.nWorkers <= 1:
 
             options.pbar = None
+            results = []
             # iDir = 0; dirName = dirsToSearch[iDir]
             for iDir, dirName in enumerate(tqdm(dirsToSearch)):
-                allCandidateDetections[iDir] = find_matches_in_directory(dirName, options, rowsByDirectory)
+                results.append(find_matches_in_directory_compact(dirName, options, rowsByDirectory))
+            instancesByDirectory, matchesByDirectory, directoryTimings = \
+                [list(r) for r in zip(*results)] if len(results) > 0 else ([], [], [])
 
-        else:
-
-            options.pbar = tqdm(total=len(dirsToSearch))
-            allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='threads')(
-                delayed(find_matches_in_directory)(dirName, options, rowsByDirectory) for dirName in tqdm(dirsToSearch))
+        elif options.comparisonBackend == 'processes':
 
-        print('\nFinished looking for similar bounding boxes')
-
-        ##%% Find suspicious locations based on match results
+            options.pbar = None
+            instancesByDirectory, matchesByDirectory, directoryTimings = \
+                find_matches_in_directories_with_process_pool(dirsToSearch, options, rowsByDirectory)
 
-        print('Filtering out repeat detections...')
+        else:
 
-        nImagesWithSuspiciousDetections = 0
-        nSuspiciousDetections = 0
+            assert options.comparisonBackend == 'threads', \
+                'Unknown comparison backend {}'.format(options.comparisonBackend)
 
-        # For each directory
-        #
-        # iDir = 51
-        for iDir in range(len(dirsToSearch)):
+            # The number of rows is a proxy for the number of candidate detections
+            dirOrder = list(range(len(dirsToSearch)))
+            if options.bLargestDirectoriesFirst:
+                dirOrder.sort(key=lambda iDir: len(rowsByDirectory[dirsToSearch[iDir]]), reverse=True)
 
-            # A list of DetectionLocation objects
-            suspiciousDetectionsThisDir = []
+            options.pbar = tqdm(total=len(dirsToSearch))
+            results = Parallel(n_jobs=options.nWorkers, prefer='threads')(
+                delayed(find_matches_in_directory_compact)(dirsToSearch[iDir], options, rowsByDirectory) for iDir in dirOrder)
+            options.pbar = None
 
-            # A list of DetectionLocation objects
-            candidateDetectionsThisDir = allCandidateDetections[iDir]
+            instancesByDirectory = [None] * len(dirsToSearch)
+            matchesByDirectory = [None] * len(dirsToSearch)
+            directoryTimings = [None] * len(dirsToSearch)
+            for iDir, r in zip(dirOrder, results):
+                instancesByDirectory[iDir], matchesByDirectory[iDir], directoryTimings[iDir] = r
 
-            for iLocation, candidateLocation in enumerate(candidateDetectionsThisDir):
+        toReturn.directoryTimings = directoryTimings
+        print_directory_timings(directoryTimings, options.nSlowestDirectoriesToPrint)
 
-                # occurrenceList is a list of file/detection pairs
-                nOccurrences = len(candidateLocation.instances)
+        print('\nFinished looking for similar bounding boxes')
 
-                if nOccurrences < options.occurrenceThreshold:
-                    continue
+        ##%% Find suspicious locations based on match results
 
-                nImagesWithSuspiciousDetections += nOccurrences
-                nSuspiciousDetections += 1
+        print('Filtering out repeat detections...')
 
-                suspiciousDetectionsThisDir.append(candidateLocation)
-                # Find the images corresponding to this bounding box, render boxes
+        # Only locations with enough occurrences are turned into DetectionLocation objects
+        suspiciousDetectionStore = DetectionLocationStore.from_matches(
+            dirsToSearch, instancesByDirectory, matchesByDirectory, options.occurrenceThreshold)
+        del instancesByDirectory, matchesByDirectory
+        suspiciousDetections = suspiciousDetectionStore.to_location_lists()
 
-            suspiciousDetections[iDir] = suspiciousDetectionsThisDir
+        nSuspiciousDetections = suspiciousDetectionStore.nLocations
+        nImagesWithSuspiciousDetections = suspiciousDetectionStore.nInstances
 
         print(
             'Finished searching for repeat detections\nFound {} unique detections on {} images that are suspicious'.format(
@@ -743,8 +1266,7 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
 
         # Load the filtering file
         detectionIndexFileName = options.filterFileToLoad
-        sIn = open(detectionIndexFileName, 'r').read()
-        suspiciousDetections = jsonpickle.decode(sIn)
+        suspiciousDetections = load_detection_index(detectionIndexFileName, dirsToSearch)
         filteringBaseDir = os.path.dirname(options.filterFileToLoad)
         assert len(suspiciousDetections) == len(dirsToSearch)
 
@@ -811,6 +1333,9 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
     # ...if we are/aren't finding detections (vs. loading from file)
 
     toReturn.suspiciousDetections = suspiciousDetections
+    if len(options.filterFileToLoad) > 0:
+        suspiciousDetectionStore = DetectionLocationStore.from_location_lists(dirsToSearch, suspiciousDetections)
+    toReturn.suspiciousDetectionStore = suspiciousDetectionStore
 
     if options.bRenderHtml:
 
@@ -904,12 +1429,12 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
                 render_bounding_box(detection, inputFullPath, outputFullPath, 15)
                 detection.sampleImageRelativeFileName = outputRelativePath
 
-        # Write out the detection index
+        # Write out the detection index, now with the sample image names
         detectionIndexFileName = os.path.join(filteringDir, DETECTION_INDEX_FILE_NAME)
-        jsonpickle.set_encoder_options('json', sort_keys=True, indent=4)
-        s = jsonpickle.encode(suspiciousDetections)
-        with open(detectionIndexFileName, 'w') as f:
-            f.write(s)
+        suspiciousDetectionStore.locationSampleImage = np.array(
+            [detection.sampleImageRelativeFileName for detections in suspiciousDetections 
+             for detection in detections], dtype=str).reshape(-1)
+        suspiciousDetectionStore.save(detectionIndexFileName)
         toReturn.filterFile = detectionIndexFileName
 
         print('Done')
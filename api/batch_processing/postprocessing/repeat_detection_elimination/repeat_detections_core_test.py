@@ -0,0 +1,210 @@
+"""
+Regression tests for repeat_detections_core on synthetic folders: the spatial index and the
+process pool have to find exactly the matches of comparing with every candidate, and the
+columnar DetectionLocationStore has to hold the same locations as DetectionLocation lists.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import jsonpickle
+import numpy as np
+
+import pandas as pd
+
+from api.batch_processing.postprocessing.repeat_detection_elimination import repeat_detections_core
+
+
+def make_synthetic_directory(n_images=600, seed=0, dir_name='camera01'):
+    """
+    Rows in the format of load_api_results for one camera folder: a few fixed locations (e.g.
+    a branch) detected on most images with a small jitter, plus random boxes.
+    """
+
+    rng = random.Random(seed)
+
+    fixed_boxes = []
+    for _ in range(25):
+        w, h = rng.uniform(0.01, 0.3), rng.uniform(0.01, 0.3)
+        fixed_boxes.append([rng.uniform(0, 1 - w), rng.uniform(0, 1 - h), w, h])
+
+    rows = []
+    for i_image in range(n_images):
+        detections = []
+        for box in fixed_boxes:
+            if rng.random() < 0.3:
+                jittered = [round(box[0] + rng.gauss(0, 0.004), 4), round(box[1] + rng.gauss(0, 0.004), 4),
+                            round(box[2] * rng.uniform(0.97, 1.03), 4), round(box[3] * rng.uniform(0.97, 1.03), 4)]
+                detections.append({'category': '1', 'conf': round(rng.uniform(0.7, 1.0), 3),
+                                   'bbox': jittered})
+        for _ in range(rng.randint(0, 3)):
+            w, h = rng.uniform(0.005, 0.6), rng.uniform(0.005, 0.6)
+            detections.append({'category': rng.choice(['1', '2']),
+                               'conf': round(rng.uniform(0.7, 1.0), 3),
+                               'bbox': [round(rng.uniform(0, 1 - w), 4), round(rng.uniform(0, 1 - h), 4),
+                                        round(w, 4), round(h, 4)]})
+        max_detection_conf = max([d['conf'] for d in detections], default=0.0)
+        rows.append({'file': '{}/IMG_{:05d}.JPG'.format(dir_name, i_image),
+                     'max_detection_conf': max_detection_conf,
+                     'detections': detections})
+
+    return {dir_name: pd.DataFrame(rows)}
+
+
+def summarize_candidates(candidates):
+    return [(candidate.bbox, [(instance.filename, instance.iDetection) for instance in candidate.instances])
+            for candidate in candidates]
+
+
+class FindMatchesInDirectoryTest(unittest.TestCase):
+
+    def test_spatial_index_matches_exhaustive_search(self):
+        rows_by_directory = make_synthetic_directory()
+
+        for iou_threshold in [0.9, 0.6, 0.2]:
+            options = repeat_detections_core.RepeatDetectionOptions()
+            options.iouThreshold = iou_threshold
+            options.confidenceMin = 0.75
+
+            options.bUseSpatialIndex = False
+            expected = repeat_detections_core.find_matches_in_directory('camera01', options, rows_by_directory)
+
+            options.bUseSpatialIndex = True
+            actual = repeat_detections_core.find_matches_in_directory('camera01', options, rows_by_directory)
+
+            self.assertGreater(max(len(c.instances) for c in expected), 50)
+            self.assertEqual(summarize_candidates(expected), summarize_candidates(actual))
+
+
+    def test_process_pool_matches_serial(self):
+        rows_by_directory = {}
+        for i_dir, n_images in enumerate([50, 400, 0, 150]):
+            rows_by_directory.update(make_synthetic_directory(n_images, seed=i_dir,
+                                                              dir_name='camera{:02d}'.format(i_dir)))
+        dirs_to_search = list(rows_by_directory.keys())
+
+        options = repeat_detections_core.RepeatDetectionOptions()
+        options.nWorkers = 2
+
+        expected = [repeat_detections_core.find_matches_in_directory(dir_name, options, rows_by_directory)
+                    for dir_name in dirs_to_search]
+        instances, matches, timings = repeat_detections_core.find_matches_in_directories_with_process_pool(
+            dirs_to_search, options, rows_by_directory)
+        actual = [repeat_detections_core.locations_from_matches(dir_name, instances[i_dir], *matches[i_dir])
+                  for i_dir, dir_name in enumerate(dirs_to_search)]
+
+        self.assertEqual([summarize_candidates(c) for c in expected],
+                         [summarize_candidates(c) for c in actual])
+        self.assertEqual([t['dirName'] for t in timings], dirs_to_search)
+        self.assertEqual(timings[2]['nInstances'], 0)
+
+
+class DetectionLocationStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.rows_by_directory = {}
+        for i_dir, n_images in enumerate([300, 0, 100]):
+            self.rows_by_directory.update(make_synthetic_directory(n_images, seed=10 + i_dir,
+                                                                   dir_name='camera{:02d}'.format(i_dir)))
+        self.dirs_to_search = list(self.rows_by_directory.keys())
+        self.options = repeat_detections_core.RepeatDetectionOptions()
+        self.options.occurrenceThreshold = 20
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def find_suspicious_detections(self):
+        """Suspicious detections as DetectionLocation lists, filtered the way it was done before the store."""
+        suspicious_detections = []
+        for dir_name in self.dirs_to_search:
+            candidates = repeat_detections_core.find_matches_in_directory(dir_name, self.options,
+                                                                          self.rows_by_directory)
+            suspicious_detections.append([c for c in candidates
+                                          if len(c.instances) >= self.options.occurrenceThreshold])
+        return suspicious_detections
+
+    def assert_same_locations(self, expected, actual):
+        self.assertEqual([[(summarize_candidates([c]), c.sampleImageRelativeFileName, c.relativeDir)
+                           for c in locations] for locations in expected],
+                         [[(summarize_candidates([c]), c.sampleImageRelativeFileName, c.relativeDir)
+                           for c in locations] for locations in actual])
+        for locations_expected, locations_actual in zip(expected, actual):
+            for c_expected, c_actual in zip(locations_expected, locations_actual):
+                self.assertEqual([(i.bbox, i.confidence, i.category) for i in c_expected.instances],
+                                 [(i.bbox, i.confidence, i.category) for i in c_actual.instances])
+
+    def test_from_matches_equals_filtered_locations(self):
+        expected = self.find_suspicious_detections()
+        self.assertGreater(sum(len(locations) for locations in expected), 10)
+
+        results = [repeat_detections_core.find_matches_in_directory_compact(dir_name, self.options,
+                                                                            self.rows_by_directory)
+                   for dir_name in self.dirs_to_search]
+        store = repeat_detections_core.DetectionLocationStore.from_matches(
+            self.dirs_to_search, [r[0] for r in results], [r[1] for r in results],
+            self.options.occurrenceThreshold)
+
+        self.assertEqual(store.nLocations, sum(len(locations) for locations in expected))
+        self.assertEqual(store.nInstances, sum(len(c.instances) for locations in expected for c in locations))
+        self.assert_same_locations(expected, store.to_location_lists())
+
+    def test_save_and_load(self):
+        expected = self.find_suspicious_detections()
+        for i_location, location in enumerate(expected[0]):
+            location.sampleImageRelativeFileName = 'dir0000_det{:0>4d}.jpg'.format(i_location)
+
+        store = repeat_detections_core.DetectionLocationStore.from_location_lists(self.dirs_to_search, expected)
+        path = os.path.join(self.temp_dir, repeat_detections_core.DETECTION_INDEX_FILE_NAME)
+        store.save(path)
+
+        self.assert_same_locations(expected, repeat_detections_core.load_detection_index(path, self.dirs_to_search))
+
+    def test_load_legacy_index(self):
+        expected = self.find_suspicious_detections()
+        path = os.path.join(self.temp_dir, repeat_detections_core.LEGACY_DETECTION_INDEX_FILE_NAME)
+        with open(path, 'w') as f:
+            f.write(jsonpickle.encode(expected))
+
+        self.assert_same_locations(expected, repeat_detections_core.load_detection_index(path, self.dirs_to_search))
+
+
+class UpdateDetectionTableTest(unittest.TestCase):
+
+    def test_update_detection_table(self):
+        rows_by_directory = make_synthetic_directory(400, seed=3)
+        detection_results = rows_by_directory['camera01'].copy()
+        detection_results['detections'] = [[dict(d) for d in detections]
+                                           for detections in detection_results['detections']]
+        original_detections = [[dict(d) for d in detections] for detections in detection_results['detections']]
+
+        options = repeat_detections_core.RepeatDetectionOptions()
+        options.occurrenceThreshold = 20
+        options.iouThreshold = 0.6
+        locations = [c for c in repeat_detections_core.find_matches_in_directory('camera01', options, rows_by_directory)
+                     if len(c.instances) >= options.occurrenceThreshold]
+
+        results = repeat_detections_core.RepeatDetectionResults()
+        results.detectionResults = detection_results
+        results.filenameToRow = {filename: i_row for i_row, filename in enumerate(detection_results['file'])}
+        results.suspiciousDetections = [locations]
+        results.suspiciousDetectionStore = repeat_detections_core.DetectionLocationStore.from_location_lists(
+            ['camera01'], [locations])
+        repeat_detections_core.update_detection_table(results, options)
+
+        suspicious = {(results.filenameToRow[i.filename], i.iDetection) for c in locations for i in c.instances}
+        self.assertGreater(len(suspicious), 100)
+        for i_row, (row, detections) in enumerate(zip(detection_results.itertuples(), original_detections)):
+            expected_confidences = [-d['conf'] if (i_row, i_detection) in suspicious else d['conf']
+                                    for i_detection, d in enumerate(detections)]
+            self.assertEqual([d['conf'] for d in row.detections], expected_confidences)
+            if len(detections) > 0:
+                self.assertTrue(np.isclose(row.max_detection_conf, max(expected_confidences), atol=1e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -50,6 +50,7 @@ from functools import partial
         
 from tqdm import tqdm
 
+from api.batch_processing.postprocessing.load_api_results import load_api_results_json
 from ct_utils import args_to_object
 
 friendly_folder_names = {'animal':'animals','person':'people','vehicle':'vehicles'}
@@ -76,6 +77,10 @@ class SeparateDetectionsIntoFoldersOptions:
     base_input_folder = None
     base_output_folder = None
         
+    # Load results_file from its sidecar cache of parsed results, or create one 
+    # (see api_results_cache.py)
+    use_results_cache = False
+    
     # Dictionary mapping categories (plus 'multiple' and 'empty') to output folders
     category_name_to_folder = None
     category_id_to_category_name = None
@@ -166,7 +171,7 @@ def separate_detections_into_folders(options):
     os.makedirs(options.base_output_folder,exist_ok=True)    
     
     # Load detection results    
-    results = json.load(open(options.results_file))
+    results = load_api_results_json(options.results_file, use_cache=options.use_results_cache)
     detections = results['images']
     
     for d in detections:
@@ -259,6 +264,8 @@ def main():
                         help='Number of threads to use for parallel operation')
     parser.add_argument('--allow_existing_directory', action='store_true', 
                         help='Proceed even if the target directory exists and is not empty')
+    parser.add_argument('--use_results_cache', action='store_true', 
+                        help='Load the results file from its sidecar cache of parsed results, or create one')
     
     if len(sys.argv[1:])==0:
         parser.print_help()
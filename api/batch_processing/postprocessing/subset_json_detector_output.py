@@ -56,6 +56,7 @@ import os
 
 from tqdm import tqdm
 
+from api.batch_processing.postprocessing.load_api_results import load_api_results_json
 from ct_utils import args_to_object
 from data_management.annotations import annotation_constants
 
@@ -108,6 +109,10 @@ class SubsetJsonDetectorOutputOptions:
     
     debug_max_images = -1
     
+    # Load the input .json from its sidecar cache of parsed results, or create one
+    # (see api_results_cache.py)
+    use_results_cache = False
+    
     
 #%% Main function
 
@@ -340,8 +345,7 @@ def subset_json_detector_output(input_filename, output_filename, options, data=N
             
     if data is None:
         print('Reading json...', end='')
-        with open(input_filename) as f:
-            data = json.load(f)
+        data = load_api_results_json(input_filename, use_cache=options.use_results_cache)
         print(' ...done, read {} images'.format(len(data['images'])))
         if options.debug_max_images > 0:
             print('Trimming to {} images'.format(options.debug_max_images))
@@ -506,6 +510,7 @@ def main():
     parser.add_argument('--overwrite_json_files', action='store_true', help='Overwrite output files')
     parser.add_argument('--copy_jsons_to_folders', action='store_true', help='When using split_folders and make_folder_relative, copy jsons to their corresponding folders (relative to output_file)')
     parser.add_argument('--create_folders', action='store_true', help='When using copy_jsons_to_folders, create folders that don''t exist')    
+    parser.add_argument('--use_results_cache', action='store_true', help='Load the input .json from its sidecar cache of parsed results, or create one')
     
     if len(sys.argv[1:]) == 0:
         parser.print_help()
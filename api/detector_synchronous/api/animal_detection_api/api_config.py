@@ -7,10 +7,34 @@ IMAGE_CONTENT_TYPES = ['image/png', 'application/octet-stream', 'image/jpeg']
 
 GPU_BATCH_SIZE = 8
 
+# images from concurrent /detect requests are run together: a batch is started once it has
+# BATCHING_TARGET_BATCH_SIZE images or BATCHING_MAX_WAIT_IN_MS after its first request arrived;
+# set BATCHING_MAX_WAIT_IN_MS to 0 to only batch requests that are already waiting
+BATCHING_TARGET_BATCH_SIZE = GPU_BATCH_SIZE
+BATCHING_MAX_WAIT_IN_MS = 20
+
 MODEL_PATH = '/app/animal_detection_api/model/megadetector_v3_tf19.pb'
 
+# the model version used when a request does not specify one
 MODEL_VERSION = 'megadetector_v3_tf19'
 
+# all model versions that can be requested with the model_version parameter, e.g. to serve MDv4
+# next to MDv3, add an entry 'megadetector_v4_tf19': '/app/animal_detection_api/model/md_v4.pb'
+MODEL_PATHS = {
+    MODEL_VERSION: MODEL_PATH
+}
+
+# upper limit on the total size of the loaded models; the least recently used models are unloaded
+# to stay within it
+MODEL_MEMORY_BUDGET_IN_MB = 2 * 1024
+
+# results are cached by image content, model version and threshold bucket, so that images that
+# are uploaded again are not run through the detector; set RESULT_CACHE_PATH to None to keep the
+# cache in memory instead of in a SQLite file
+RESULT_CACHE_PATH = '/tmp/detection_result_cache.sqlite'
+RESULT_CACHE_MAX_SIZE_IN_MB = 512
+RESULT_CACHE_THRESHOLD_BUCKET_WIDTH = 0.05
+
 # Camera trap images are usually 4:3 width to height
 # The config of the model in use (model/pipeline.config) has min_dimension
 # 600 and max_dimension 1024 for the keep_aspect_ratio_resizer, which first resize an image so
@@ -0,0 +1,171 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatchScheduler:
+    """
+    Coalesces the images of concurrent /detect requests into shared inference batches.
+
+    Each request submits its images and waits for its own detections. A single worker thread
+    takes the oldest pending request and then keeps collecting requests for the same model
+    version until the batch has target_batch_size images or max_wait_ms have passed since the
+    first request was taken, runs one inference on all their images and hands each request its
+    part of the detections. Requests are never split across batches, so a batch can be smaller
+    than target_batch_size when the next request does not fit.
+    """
+
+    def __init__(self, model_registry, target_batch_size, max_wait_ms, num_latencies_kept=1000):
+        """
+        Args:
+            model_registry: ModelRegistry to get the detector for each model version from
+            target_batch_size: number of images at which a batch is run without further waiting
+            max_wait_ms: longest time the first request of a batch waits for others to join it
+            num_latencies_kept: number of most recent requests the latency metrics are computed over
+        """
+        self.model_registry = model_registry
+        self.target_batch_size = target_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+
+        self._requests = queue.Queue()
+        # requests taken from the queue that did not fit in the batch being collected
+        self._deferred = deque()
+
+        self._metrics_lock = threading.Lock()
+        self._num_batches = 0
+        self._num_requests = 0
+        self._num_images = 0
+        self._batch_size_counts = {}  # number of images in a batch -> number of such batches
+        self._queue_latencies = deque(maxlen=num_latencies_kept)
+        self._total_latencies = deque(maxlen=num_latencies_kept)
+
+        self._worker = threading.Thread(target=self._run, name='MicroBatchScheduler', daemon=True)
+        self._worker.start()
+
+    def generate_detections(self, images, model_version):
+        """
+        Returns the detections for images in the format of TFDetector.generate_detections_batch,
+        blocking until the batch they were added to has been run. Exceptions raised during
+        inference are re-raised here.
+        """
+        request = {
+            'images': images,
+            'model_version': model_version,
+            'submit_time': time.time(),
+            'future': Future()
+        }
+        self._requests.put(request)
+        return request['future'].result()
+
+    def _next_request(self, timeout=None):
+        """Returns the next request, deferred ones first, or None if there is none before the timeout."""
+        if len(self._deferred) > 0:
+            return self._deferred.popleft()
+        try:
+            return self._requests.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self, batch):
+        """
+        Takes the requests of the next batch into the empty list batch; returns their model version.
+        The requests are added to batch as they are taken, so that the caller can fail them if this raises.
+        """
+        batch.append(self._next_request())
+        model_version = batch[0]['model_version']
+        num_images = len(batch[0]['images'])
+        deadline = time.time() + self.max_wait_seconds
+
+        # requests that were looked at but belong in a later batch; they keep their place in line
+        skipped = []
+        try:
+            while num_images < self.target_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                request = self._next_request(timeout=remaining)
+                if request is None:
+                    break
+                if request['model_version'] != model_version or \
+                        num_images + len(request['images']) > self.target_batch_size:
+                    skipped.append(request)
+                    continue
+                batch.append(request)
+                num_images += len(request['images'])
+        finally:
+            self._deferred.extendleft(reversed(skipped))
+        return model_version
+
+    def _run(self):
+        # any exception fails the requests of the batch rather than the worker thread, which every
+        # later request would otherwise wait for forever
+        while True:
+            batch = []
+            try:
+                model_version = self._collect_batch(batch)
+                start_time = time.time()
+
+                images = [image for request in batch for image in request['images']]
+                detector = self.model_registry.get_detector(model_version)
+                detections = detector.generate_detections_batch(images)
+                assert len(detections) == len(images), \
+                    'The detector returned {} results for {} images'.format(len(detections), len(images))
+
+                end_time = time.time()
+                i_start = 0
+                for request in batch:
+                    i_end = i_start + len(request['images'])
+                    request['future'].set_result(detections[i_start:i_end])
+                    i_start = i_end
+
+                self._record_batch(batch, len(images), start_time, end_time)
+            except Exception as e:
+                print('MicroBatchScheduler, batch of {} requests failed: {}'.format(len(batch), str(e)))
+                for request in batch:
+                    if not request['future'].done():
+                        request['future'].set_exception(e)
+
+    def _record_batch(self, batch, num_images, start_time, end_time):
+        with self._metrics_lock:
+            self._num_batches += 1
+            self._num_requests += len(batch)
+            self._num_images += num_images
+            self._batch_size_counts[num_images] = self._batch_size_counts.get(num_images, 0) + 1
+            for request in batch:
+                self._queue_latencies.append(start_time - request['submit_time'])
+                self._total_latencies.append(end_time - request['submit_time'])
+
+    @staticmethod
+    def _summarize_latencies(latencies):
+        if len(latencies) == 0:
+            return None
+        latencies_ms = 1000 * np.array(latencies)
+        return {
+            'mean_ms': round(float(latencies_ms.mean()), 1),
+            'p50_ms': round(float(np.percentile(latencies_ms, 50)), 1),
+            'p95_ms': round(float(np.percentile(latencies_ms, 95)), 1),
+            'max_ms': round(float(latencies_ms.max()), 1)
+        }
+
+    def get_metrics(self):
+        """
+        Returns a json-serializable summary of the batches run so far. Latencies are over the most
+        recent requests: queue latency is the time a request waited for its batch to start, total
+        latency also includes inference.
+        """
+        with self._metrics_lock:
+            return {
+                'target_batch_size': self.target_batch_size,
+                'max_wait_ms': round(self.max_wait_seconds * 1000, 1),
+                'num_batches': self._num_batches,
+                'num_requests': self._num_requests,
+                'num_images': self._num_images,
+                'mean_batch_size': round(self._num_images / self._num_batches, 2) if self._num_batches else None,
+                'batch_size_counts': {str(k): v for k, v in sorted(self._batch_size_counts.items())},
+                'queue_latency': MicroBatchScheduler._summarize_latencies(self._queue_latencies),
+                'total_latency': MicroBatchScheduler._summarize_latencies(self._total_latencies)
+            }
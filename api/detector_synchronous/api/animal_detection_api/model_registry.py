@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class ModelRegistry:
+    """
+    Keeps detectors for several model versions in memory so that they can be served side by
+    side from one container.
+
+    Models are loaded the first time they are requested and stay warm afterwards. If loading a
+    model would take the total memory footprint of the loaded models over memory_budget_bytes,
+    the least recently used models are evicted first. The footprint of a model is approximated
+    by the size of its frozen graph, which is dominated by the weights.
+
+    An evicted detector is only dropped from the registry; requests that are still using it
+    keep a reference, and its session is closed when the last reference goes away.
+    """
+
+    def __init__(self, model_paths, memory_budget_bytes, detector_class):
+        """
+        Args:
+            model_paths: dict of model version to the path of its frozen graph (.pb)
+            memory_budget_bytes: upper limit on the total footprint of the loaded models; the most
+                recently requested model is always kept, even if it alone exceeds the budget
+            detector_class: called with the model path to load a model, e.g. TFDetector
+        """
+        self.model_paths = model_paths
+        self.memory_budget_bytes = memory_budget_bytes
+        self.detector_class = detector_class
+
+        # model version -> dict with the detector and its stats, least recently used first
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+        # one lock per model version, held while that model loads, so that concurrent requests
+        # for a model that is not loaded yet do not load it twice; requests for models that are
+        # already loaded do not wait for it
+        self._load_locks = {}
+
+    def is_available(self, model_version):
+        return model_version in self.model_paths
+
+    def get_detector(self, model_version):
+        """
+        Returns the detector for model_version, loading it first if necessary.
+        Raises KeyError if model_version is not one of the configured model versions.
+        """
+        if model_version not in self.model_paths:
+            raise KeyError('Model version {} is not available'.format(model_version))
+
+        with self._lock:
+            if model_version in self._loaded:
+                return self._use(model_version)
+            load_lock = self._load_locks.setdefault(model_version, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                # another request may have loaded it while we waited
+                if model_version in self._loaded:
+                    return self._use(model_version)
+
+            entry = self._load(model_version)
+
+            with self._lock:
+                self._loaded[model_version] = entry
+                return self._use(model_version)
+
+    def _use(self, model_version):
+        """Marks the model as most recently used and returns its detector; call with self._lock held."""
+        entry = self._loaded[model_version]
+        self._loaded.move_to_end(model_version)
+        entry['last_used'] = datetime.utcnow()
+        entry['num_requests'] += 1
+        return entry['detector']
+
+    def _load(self, model_version):
+        model_path = self.model_paths[model_version]
+        memory_bytes = os.path.getsize(model_path)
+
+        # make room before loading, so that the evicted graphs can be freed first
+        with self._lock:
+            while len(self._loaded) > 0 and self._total_memory_bytes() + memory_bytes > self.memory_budget_bytes:
+                evicted_version, _ = self._loaded.popitem(last=False)
+                print('ModelRegistry: evicted model {} to stay within the memory budget'.format(evicted_version))
+
+        print('ModelRegistry: loading model {} from {}'.format(model_version, model_path))
+        start_time = time.time()
+        detector = self.detector_class(model_path)
+        load_duration = time.time() - start_time
+        print('ModelRegistry: loaded model {} in {:.1f} seconds'.format(model_version, load_duration))
+
+        return {
+            'detector': detector,
+            'model_path': model_path,
+            'memory_bytes': memory_bytes,
+            'load_time': datetime.utcnow(),
+            'load_duration_seconds': load_duration,
+            'last_used': None,
+            'num_requests': 0
+        }
+
+    def _total_memory_bytes(self):
+        return sum(entry['memory_bytes'] for entry in self._loaded.values())
+
+    def get_status(self):
+        """
+        Returns a json-serializable description of the available and loaded models.
+        """
+        with self._lock:
+            loaded_models = []
+            for model_version, entry in self._loaded.items():
+                loaded_models.append({
+                    'model_version': model_version,
+                    'load_time': entry['load_time'].strftime('%Y-%m-%d %H:%M:%S'),
+                    'load_duration_seconds': round(entry['load_duration_seconds'], 2),
+                    'memory_mb': round(entry['memory_bytes'] / (1024 * 1024), 1),
+                    'last_used': entry['last_used'].strftime('%Y-%m-%d %H:%M:%S') if entry['last_used'] else None,
+                    'num_requests': entry['num_requests']
+                })
+
+            return {
+                'available_model_versions': sorted(self.model_paths.keys()),
+                'loaded_models': loaded_models,
+                'memory_budget_mb': round(self.memory_budget_bytes / (1024 * 1024), 1),
+                'memory_used_mb': round(self._total_memory_bytes() / (1024 * 1024), 1)
+            }
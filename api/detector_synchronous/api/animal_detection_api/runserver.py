@@ -6,12 +6,16 @@ import json
 from datetime import datetime
 from io import BytesIO
 
+import numpy as np
 from ai4e_app_insights_wrapper import AI4EAppInsights
 from ai4e_service import APIService
 from flask import Flask, Response, jsonify, abort
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
 import api_config
+from batch_scheduler import MicroBatchScheduler
+from detection_cache import DetectionCache, MemoryCacheBackend, SqliteCacheBackend, hash_image_bytes
+from model_registry import ModelRegistry
 from tf_detector import TFDetector
 
 print('Creating Application')
@@ -25,7 +29,26 @@ log = AI4EAppInsights()
 with app.app_context():
     ai4e_service = APIService(app, log)
 
-detector = TFDetector(api_config.MODEL_PATH)
+# detectors for all model versions in api_config.MODEL_PATHS, loaded on first use and kept warm
+model_registry = ModelRegistry(api_config.MODEL_PATHS,
+                               api_config.MODEL_MEMORY_BUDGET_IN_MB * 1024 * 1024,
+                               TFDetector)
+
+# load the default model at startup so that the first requests do not wait for it
+model_registry.get_detector(api_config.MODEL_VERSION)
+
+# runs the images of concurrent requests in shared batches
+batch_scheduler = MicroBatchScheduler(model_registry,
+                                      api_config.BATCHING_TARGET_BATCH_SIZE,
+                                      api_config.BATCHING_MAX_WAIT_IN_MS)
+
+# detections of images processed before, keyed by image content
+if api_config.RESULT_CACHE_PATH:
+    result_cache_backend = SqliteCacheBackend(api_config.RESULT_CACHE_PATH,
+                                              api_config.RESULT_CACHE_MAX_SIZE_IN_MB * 1024 * 1024)
+else:
+    result_cache_backend = MemoryCacheBackend(api_config.RESULT_CACHE_MAX_SIZE_IN_MB * 1024 * 1024)
+result_cache = DetectionCache(result_cache_backend, api_config.RESULT_CACHE_THRESHOLD_BUCKET_WIDTH)
 
 # function for processing the request data to the /detect endpoint. It loads data or files into a
 # dictionary for access in the API function. It is passed as a parameter to the API setup.
@@ -54,6 +77,11 @@ def _detect_process_request_data(request):
     else:
         detection_confidence = api_config.DEFAULT_DETECTION_CONFIDENCE
 
+    model_version = params.get('model_version', api_config.MODEL_VERSION)
+    if not model_registry.is_available(model_version):
+        abort(400, 'Model version {} is not available. Available model versions: {}'.format(
+            model_version, ', '.join(sorted(api_config.MODEL_PATHS.keys()))))
+
     # check that the number of images is acceptable for this synchronous API
     num_images = sum([1 if file.content_type in api_config.IMAGE_CONTENT_TYPES else 0 for file in files.values()])
     print('runserver, post_detect_sync, number of images received: ', num_images)
@@ -67,11 +95,13 @@ def _detect_process_request_data(request):
     # read input images and parameters
     try:
         print('runserver, post_detect_sync, reading input images...')
-        images, image_names = [], []
+        images, image_names, image_hashes = [], [], []
         for k, file in files.items():
             # file of type SpooledTemporaryFile has attributes content_type and a read() method
             if file.content_type in api_config.IMAGE_CONTENT_TYPES:
-                images.append(TFDetector.open_image(file))
+                image_bytes = file.read()
+                image_hashes.append(hash_image_bytes(image_bytes))
+                images.append(TFDetector.open_image(BytesIO(image_bytes)))
                 image_names.append(k)
     except Exception as e:
         log.log_exception('Error reading the images: ' + str(e))
@@ -80,11 +110,60 @@ def _detect_process_request_data(request):
     return {
         'render_boxes': render_boxes,
         'detection_confidence': detection_confidence,
+        'model_version': model_version,
         'images': images,
-        'image_names': image_names
+        'image_names': image_names,
+        'image_hashes': image_hashes
     }
 
 
+def _generate_detections_with_cache(images, image_hashes, model_version, detection_confidence):
+    """
+    Returns detections for images in the format of TFDetector.generate_detections_batch. Images
+    whose content is in the result cache are not run through the detector, and neither are
+    repeated images within the request; the detections of the others are added to the cache.
+    """
+    detections = [None] * len(images)
+
+    # image hash -> indices of the images with this content that are not cached
+    uncached = {}
+    for i, image_hash in enumerate(image_hashes):
+        if image_hash in uncached:
+            uncached[image_hash].append(i)
+            continue
+        cached = result_cache.get(image_hash, model_version, detection_confidence)
+        if cached is None:
+            uncached[image_hash] = [i]
+            continue
+        detections[i] = {
+            'box': np.array(cached['box'], dtype=np.float32).reshape(-1, 4),
+            'score': np.array(cached['score'], dtype=np.float32),
+            'category': np.array(cached['category'], dtype=np.float32),
+            # the detector renders on the resized image
+            'image': images[i].resize((api_config.MAX_DIM, api_config.MIN_DIM))
+        }
+
+    if len(uncached) == 0:
+        return detections
+
+    to_run = [indices[0] for indices in uncached.values()]
+    new_detections = batch_scheduler.generate_detections([images[i] for i in to_run], model_version)
+
+    # only the boxes above the lower edge of the threshold bucket are cached
+    cache_threshold = result_cache.bucket(detection_confidence)
+    for indices, d in zip(uncached.values(), new_detections):
+        keep = d['score'] > cache_threshold
+        result_cache.put(image_hashes[indices[0]], model_version, detection_confidence, {
+            'box': d['box'][keep].tolist(),
+            'score': d['score'][keep].tolist(),
+            'category': d['category'][keep].tolist()
+        })
+        detections[indices[0]] = d
+        for i in indices[1:]:
+            detections[i] = dict(d, image=d['image'].copy())
+    return detections
+
+
 def convert_numpy_floats(np_array):
     new = []
     for i in np_array:
@@ -101,16 +180,18 @@ def convert_numpy_floats(np_array):
 def detect_sync(*args, **kwargs):
     render_boxes = kwargs.get('render_boxes')
     detection_confidence = kwargs.get('detection_confidence')
+    model_version = kwargs.get('model_version')
 
     images = kwargs.get('images')
     image_names = kwargs.get('image_names')
+    image_hashes = kwargs.get('image_hashes')
 
     # consolidate the images into batches and perform detection on them
     try:
         print('runserver, post_detect_sync, batching and inferencing...')
         # detections is an array of dicts
         tic = datetime.now()
-        detections = detector.generate_detections_batch(images)
+        detections = _generate_detections_with_cache(images, image_hashes, model_version, detection_confidence)
         toc = datetime.now()
         inference_duration = toc - tic
         print('runserver, post_detect_sync, inference duration: {} seconds.'.format(inference_duration))
@@ -160,7 +241,8 @@ def detect_sync(*args, **kwargs):
                          'inference_duration': str(inference_duration),
                          'num_images': len(image_names),
                          'render_boxes': render_boxes,
-                         'detection_confidence': detection_confidence
+                         'detection_confidence': detection_confidence,
+                         'model_version': model_version
                      })
         return Response(m.to_string(), mimetype=m.content_type)
     except Exception as e:
@@ -169,13 +251,37 @@ def detect_sync(*args, **kwargs):
         abort(500, 'Error returning result or rendering the detection boxes: ' + str(e))
 
 
+@ai4e_service.api_sync_func(api_path='/batching_metrics',
+                            methods=['GET'],
+                            maximum_concurrent_requests=1000,
+                            trace_name='get:get_batching_metrics')
+def get_batching_metrics(*args, **kwargs):
+    try:
+        return json.dumps(batch_scheduler.get_metrics())
+    except Exception as e:
+        return 'Batching metrics unavailable. Error: {}'.format(str(e))
+
+
+@ai4e_service.api_sync_func(api_path='/result_cache_stats',
+                            methods=['GET'],
+                            maximum_concurrent_requests=1000,
+                            trace_name='get:get_result_cache_stats')
+def get_result_cache_stats(*args, **kwargs):
+    try:
+        return json.dumps(result_cache.get_stats())
+    except Exception as e:
+        return 'Result cache statistics unavailable. Error: {}'.format(str(e))
+
+
 @ai4e_service.api_sync_func(api_path='/model_version',
                             methods=['GET'],
                             maximum_concurrent_requests=1000,
                             trace_name='get:get_model_version')
 def get_model_version(*args, **kwargs):
     try:
-        return api_config.MODEL_VERSION
+        status = {'default_model_version': api_config.MODEL_VERSION}
+        status.update(model_registry.get_status())
+        return json.dumps(status)
     except Exception as e:
         return 'Model version unknown. Error: {}'.format(str(e))
 
@@ -22,7 +22,11 @@ class TFDetector:
 
     def __init__(self, checkpoint):
         self.detection_graph = self.load_model(checkpoint)
-        self.session = tf.Session(graph=self.detection_graph)
+
+        # allocate GPU memory as needed, so that sessions for several models can share the GPU
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        self.session = tf.Session(graph=self.detection_graph, config=config)
 
     def load_model(self, checkpoint):
         """Loads a detection model (i.e., create a graph) from a .pb file.
@@ -17,6 +17,15 @@ API_KEY as an environment variable and run:
 locust --host=http://example.com/camera-trap/
 
 and visit http://127.0.0.1:8089 in a browser (local testing)
+
+To measure the throughput gained by batching the images of concurrent requests, run the
+SingleImageUser scenario, where each user sends one image at a time, against the API with
+BATCHING_MAX_WAIT_IN_MS set to 0 and to its default in api_config.py, and compare the requests
+per second reached with the same number of users:
+
+locust --host=http://example.com/camera-trap/ SingleImageUser
+
+The batch sizes and latencies seen by the API are returned by its batching_metrics endpoint.
 """
 
 sample_input_dir = './sample_input/test_images'
@@ -94,7 +103,34 @@ class UserBehavior(TaskSet):
             UserBehavior.open_detection_results(response)
 
 
+class SingleImageBehavior(TaskSet):
+
+    @task(50)
+    def request_detection_one_image(self):
+        image_name, file_item = UserBehavior.get_test_image()
+        response = self.client.post('detect', name='detect:single_image',
+                                    params={'confidence': 0.8},
+                                    files={image_name: file_item},
+                                    headers=headers)
+        file_item[1].close()
+        if response.status_code != 200:
+            print('Request failed with status {}: {}'.format(response.status_code, response.text))
+
+    @task(1)
+    def check_batching_metrics(self):
+        response = self.client.get('batching_metrics', headers=headers, name='batching_metrics')
+        if response.status_code == 200:
+            print(response.text)
+
+
 class WebsiteUser(HttpLocust):
     task_set = UserBehavior
     min_wait = 1000  # only one task (request_detection, with model_version commented out), so this doesn't take effect.
     max_wait = 1000
+
+
+class SingleImageUser(HttpLocust):
+    task_set = SingleImageBehavior
+    # no wait between requests, so that the number of users is the number of concurrent requests
+    min_wait = 0
+    max_wait = 0
@@ -214,8 +214,9 @@ def classify_boxes(classification_graph, json_with_classes, image_dir, confidenc
                     cur_detection['classifications'] = list()
                     
                     # Add the *num_annotated_classes* top scoring classes
-                    for class_idx in np.argsort(-predictions)[:num_annotated_classes]:
-                        class_conf = ct_utils.truncate_float(predictions[class_idx].item())
+                    top_classes = np.argsort(-predictions)[:num_annotated_classes]
+                    top_confs = ct_utils.truncate_float_array(predictions[top_classes].tolist())
+                    for class_idx, class_conf in zip(top_classes, top_confs):
                         cur_detection['classifications'].append(['%i'%class_idx, class_conf])
 
                 # ...for each box
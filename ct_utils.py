@@ -15,15 +15,51 @@ import numpy as np
 
 def truncate_float_array(xs, precision=3):
     """
-    Vectorized version of truncate_float(...) 
+    Vectorized version of truncate_float(...); each element gets exactly the value
+    truncate_float would give it, including negative values.
 
     Args: 
-    x         (list of float) List of floats to truncate
-    precision (int)           The number of significant digits to preserve, should be 
-                              greater or equal 1
+    xs        (list or np.ndarray of float) Floats to truncate, of any shape (nested lists are fine)
+    precision (int)                         The number of significant digits to preserve, should be 
+                                            greater or equal 1
+
+    Returns:
+    An np.ndarray of float64 with the shape of xs if xs is an np.ndarray. Otherwise a (nested)
+    list, where values close to 0 are the int 0 like truncate_float returns, so the result
+    serializes to the same json as the scalar version.
     """
 
-    return [truncate_float(x, precision=precision) for x in xs]
+    assert precision > 0
+
+    x = np.asarray(xs, dtype=np.float64)
+    shape = x.shape
+    x = x.ravel()
+    is_zero = np.isclose(x, 0)
+    abs_x = np.where(is_zero, 1.0, np.abs(x))
+
+    log10_x = np.log10(abs_x)
+    exponent = np.floor(log10_x)
+
+    # np.log10 may differ from math.log10 in the last bit; where log10 is close to an integer
+    # that can change the floor, so use math.log10 for those values to match truncate_float
+    near_integer = (np.abs(log10_x - np.round(log10_x)) < 1e-9) & ~is_zero
+    if near_integer.any():
+        exponent[near_integer] = [math.floor(math.log10(v)) for v in abs_x[near_integer]]
+
+    # Determine the factor, which shifts the decimal point of x just behind the last
+    # significant digit; math.pow is used for the few distinct factors, as in truncate_float
+    factor_exponents, i_factor = np.unique(precision - 1 - exponent, return_inverse=True)
+    factors = np.array([math.pow(10, e) for e in factor_exponents])[i_factor.ravel()]
+
+    truncated = np.floor(x * factors) / factors
+    truncated[is_zero] = 0.0
+
+    if isinstance(xs, np.ndarray):
+        return truncated.reshape(shape)
+
+    truncated = truncated.astype(object)
+    truncated[is_zero] = 0
+    return truncated.reshape(shape).tolist()
 
 
 def truncate_float(x, precision=3):
@@ -89,6 +125,55 @@ def write_json(path, content, indent=1):
         json.dump(content, f, indent=indent)
 
 
+def write_json_streaming(path, content, streamed_key='images', indent=1):
+    """
+    Writes the dict *content* to *path* as json, encoding the value of *streamed_key*
+    one entry at a time, so it can be a generator and the encoded list is never held in
+    memory. Keys are written in the order of *content*.
+
+    If content[streamed_key] is a list, the output is byte-identical to
+    write_json(path, content, indent).
+
+    Args:
+        path:         (str)         output .json file
+        content:      (dict)        top-level fields; the value of streamed_key can be any iterable
+        streamed_key: (str)         key in content whose entries are written one at a time
+        indent:       (int or None) as in json.dump
+    """
+
+    if indent is None:
+        item_separator, newline = ', ', ''
+    else:
+        item_separator, newline = ',', '\n'
+    pad_1 = '' if indent is None else ' ' * indent
+    pad_2 = '' if indent is None else ' ' * (2 * indent)
+    encoder = json.JSONEncoder(indent=indent)
+
+    with open(path, 'w') as f:
+        if len(content) == 0:
+            f.write('{}')
+            return
+
+        f.write('{')
+        for i_key, (k, v) in enumerate(content.items()):
+            f.write((item_separator if i_key > 0 else '') + newline + pad_1 + json.dumps(k) + ': ')
+
+            if k != streamed_key:
+                f.write(encoder.encode(v).replace('\n', '\n' + pad_1))
+                continue
+
+            f.write('[')
+            n_entries = 0
+            for entry in v:
+                f.write((item_separator if n_entries > 0 else '') + newline + pad_2)
+                f.write(encoder.encode(entry).replace('\n', '\n' + pad_2))
+                n_entries += 1
+            if n_entries > 0:
+                f.write(newline + pad_1)
+            f.write(']')
+        f.write(newline + '}')
+
+
 image_extensions = ['.jpg', '.jpeg', '.gif', '.png']
 
 
@@ -190,3 +275,40 @@ def get_iou(bb1, bb2):
     assert iou >= 0.0
     assert iou <= 1.0
     return iou
+
+
+def get_iou_batch(bb1, bb2s):
+    """
+    Vectorized version of get_iou(...): the IoU of one bounding box with each of several
+    bounding boxes, computed with the same floating-point operations as get_iou, so that
+    comparisons against a threshold give the same answers.
+
+    Args:
+        bb1:  [x_min, y_min, width_of_box, height_of_box]
+        bb2s: array-like of shape [N, 4] of boxes in the same format
+
+    Returns:
+        np.ndarray of N floats in [0, 1]
+    """
+
+    bb2s = np.asarray(bb2s, dtype=np.float64).reshape(-1, 4)
+
+    x1_min, y1_min = bb1[0], bb1[1]
+    x1_max, y1_max = bb1[0] + bb1[2], bb1[1] + bb1[3]
+    x2_min, y2_min = bb2s[:, 0], bb2s[:, 1]
+    x2_max, y2_max = bb2s[:, 0] + bb2s[:, 2], bb2s[:, 1] + bb2s[:, 3]
+
+    x_left = np.maximum(x1_min, x2_min)
+    y_top = np.maximum(y1_min, y2_min)
+    x_right = np.minimum(x1_max, x2_max)
+    y_bottom = np.minimum(y1_max, y2_max)
+
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    bb1_area = (x1_max - x1_min) * (y1_max - y1_min)
+    bb2_area = (x2_max - x2_min) * (y2_max - y2_min)
+
+    no_overlap = (x_right < x_left) | (y_bottom < y_top)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersection_area / (bb1_area + bb2_area - intersection_area)
+    iou[no_overlap] = 0.0
+    return iou
@@ -0,0 +1,68 @@
+"""
+ct_utils_benchmark.py
+
+Microbenchmark comparing truncate_float_array(...) with calling truncate_float(...) on
+each value, for the sizes typical of detector output (a handful of values per detection)
+up to a whole batch of output tensors. Also checks that both give the same values.
+
+Sample invocation:
+
+python ct_utils_benchmark.py --n_repeats 20
+"""
+
+#%% Constants and imports
+
+import argparse
+import json
+import timeit
+
+import numpy as np
+
+from ct_utils import truncate_float, truncate_float_array
+
+
+#%% Benchmark
+
+def benchmark_truncate_float_array(sizes=(4, 100, 10000, 1000000), precision=4, n_repeats=10):
+    """
+    Prints the time per call of the scalar and vectorized truncation for lists of each
+    size in sizes.
+    """
+
+    rng = np.random.RandomState(0)
+
+    for size in sizes:
+        # Detector outputs are float32; include exact zeros and negative values
+        values = rng.rand(size).astype(np.float32).astype(np.float64)
+        values[::10] = 0.0
+        values[1::10] *= -1
+        values = values.tolist()
+
+        expected = [truncate_float(x, precision=precision) for x in values]
+        assert json.dumps(truncate_float_array(values, precision=precision)) == json.dumps(expected)
+
+        n = max(1, n_repeats * 10000 // size)
+        t_scalar = timeit.timeit(lambda: [truncate_float(x, precision=precision) for x in values],
+                                 number=n) / n
+        t_vectorized = timeit.timeit(lambda: truncate_float_array(values, precision=precision),
+                                     number=n) / n
+
+        print('{:>8} values: scalar {:10.3f} ms, vectorized {:10.3f} ms, speedup {:6.1f}x'.format(
+            size, t_scalar * 1000, t_vectorized * 1000, t_scalar / t_vectorized))
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare truncate_float_array with a loop over truncate_float')
+    parser.add_argument('--n_repeats', type=int, default=10,
+                        help='Scales the number of timed calls per list size')
+    args = parser.parse_args()
+
+    benchmark_truncate_float_array(n_repeats=args.n_repeats)
+
+
+if __name__ == '__main__':
+    main()
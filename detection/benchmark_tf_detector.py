@@ -0,0 +1,132 @@
+"""
+
+Benchmark the throughput (images/sec) of TFDetector.generate_detections_batch at several
+batch sizes. By default the GPU is hidden from TensorFlow so that the numbers reflect
+CPU inference; pass --use_gpu to benchmark on the GPU instead.
+
+Images are loaded into memory before timing starts, so only inference and post-processing
+of the output tensors are measured. Since only images of the same size can share a batch,
+use a folder of images from a single camera model to get meaningful numbers.
+
+Sample invocation:
+
+```
+python benchmark_tf_detector.py "d:\temp\models\megadetector_v3.pb" "d:\temp\test_images" --n_images 64
+```
+
+"""
+
+#%% Constants, imports, environment
+
+import argparse
+import os
+import sys
+import time
+
+if '--use_gpu' not in sys.argv:
+    # Needs to be set before TensorFlow is imported
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import humanfriendly
+
+from detection.run_tf_detector import ImagePathUtils, TFDetector
+import visualization.visualization_utils as viz_utils
+
+DEFAULT_BATCH_SIZES = [1, 4, 8, 16]
+
+
+#%% Main function
+
+def benchmark_batch_sizes(model_file, image_file_names, batch_sizes=DEFAULT_BATCH_SIZES,
+                          n_images=64, n_warmup_images=2):
+    """
+    Runs the detector over n_images images (cycling through image_file_names if there are
+    fewer) once per batch size and returns a dict mapping batch size to images/sec.
+    """
+
+    assert len(image_file_names) > 0, 'No images to benchmark on'
+
+    images = []
+    image_ids = []
+    for i_image in range(n_images):
+        im_file = image_file_names[i_image % len(image_file_names)]
+        images.append(viz_utils.load_image(im_file))
+        image_ids.append(im_file)
+
+    tf_detector = TFDetector(model_file)
+
+    # The first session calls include graph optimization and memory allocation
+    tf_detector.generate_detections_batch(images[:n_warmup_images], image_ids[:n_warmup_images])
+
+    images_per_second = {}
+    for batch_size in batch_sizes:
+        start_time = time.time()
+        results = tf_detector.generate_detections_batch(images, image_ids, batch_size=batch_size)
+        elapsed = time.time() - start_time
+
+        n_failures = sum(1 for r in results if 'failure' in r)
+        images_per_second[batch_size] = len(images) / elapsed
+        print('Batch size {:>3}: {:.2f} images/sec ({} for {} images, {} failures)'.format(
+            batch_size, images_per_second[batch_size], humanfriendly.format_timespan(elapsed),
+            len(images), n_failures))
+
+    return images_per_second
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark TFDetector inference throughput at several batch sizes'
+    )
+    parser.add_argument(
+        'detector_file',
+        help='Path to .pb TensorFlow detector model file'
+    )
+    parser.add_argument(
+        'image_dir',
+        help='Directory of images to benchmark on'
+    )
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='Recurse into image_dir'
+    )
+    parser.add_argument(
+        '--batch_sizes',
+        type=int,
+        nargs='+',
+        default=DEFAULT_BATCH_SIZES,
+        help='Batch sizes to benchmark; default is {}'.format(DEFAULT_BATCH_SIZES)
+    )
+    parser.add_argument(
+        '--n_images',
+        type=int,
+        default=64,
+        help='Number of images to run per batch size; images are repeated if the directory has fewer'
+    )
+    parser.add_argument(
+        '--use_gpu',
+        action='store_true',
+        help='Benchmark on the GPU if one is available (default is CPU only)'
+    )
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    assert os.path.exists(args.detector_file), 'detector_file specified does not exist'
+    assert args.n_images > 0, 'n_images needs to be > 0'
+
+    image_file_names = ImagePathUtils.find_images(args.image_dir, args.recursive)
+    print('Benchmarking on {} images from {} image files found'.format(args.n_images, len(image_file_names)))
+
+    benchmark_batch_sizes(args.detector_file, image_file_names,
+                          batch_sizes=args.batch_sizes, n_images=args.n_images)
+
+
+if __name__ == '__main__':
+    main()
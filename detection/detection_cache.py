@@ -0,0 +1,224 @@
+"""
+detection_cache.py
+
+Cache of detection results keyed by the content of the image, so that images that have been
+processed before (e.g. re-uploaded to the synchronous API or included again in a batch job)
+do not need to be run through the detector again.
+
+Entries are keyed by (sha256 of the image file, model version, threshold bucket). Results are
+cached at the lower edge of the threshold bucket, i.e. they contain all detections above it,
+and filtered down to the requested threshold by the caller, so that requests with similar
+thresholds share entries.
+
+Two local backends are available: SqliteCacheBackend, which persists entries in a SQLite
+database and can be shared by several processes, and MemoryCacheBackend. Both evict the least
+recently used entries when the total size of the cached values exceeds the size limit.
+
+A copy of this file is used by the synchronous API (api/detector_synchronous/api/
+animal_detection_api/detection_cache.py), as only that folder is copied into its container;
+please keep them in sync.
+"""
+
+#%% Constants and imports
+
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_MAX_SIZE_BYTES = 1024 * 1024 * 1024
+DEFAULT_THRESHOLD_BUCKET_WIDTH = 0.05
+
+
+#%% Support functions
+
+def hash_image_bytes(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def hash_image_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def threshold_bucket(threshold, bucket_width=DEFAULT_THRESHOLD_BUCKET_WIDTH):
+    """
+    Returns the lower edge of the bucket of width bucket_width that threshold falls in,
+    rounded so that it can be used in a cache key.
+    """
+
+    # the small tolerance keeps thresholds on a bucket edge (e.g. 0.15) in their own bucket
+    # despite floating-point error in the division
+    return round(math.floor(threshold / bucket_width + 1e-9) * bucket_width, 6)
+
+
+def filter_api_result(result, threshold):
+    """
+    Filters a result in the batch API output format, computed at a lower threshold, down to
+    the detections above threshold, recomputing max_detection_conf.
+
+    The confidences in the result are truncated to a few significant digits, so detections
+    are kept if their confidence is >= threshold; this matches running the detector at
+    threshold whenever threshold itself has no more significant digits than the confidences.
+    """
+
+    detections = [d for d in result['detections'] if d['conf'] >= threshold]
+    filtered = dict(result)
+    filtered['detections'] = detections
+    filtered['max_detection_conf'] = max([d['conf'] for d in detections], default=0)
+    return filtered
+
+
+#%% Backends
+
+class MemoryCacheBackend:
+    """Keeps the cached values in memory; the cache is lost when the process exits."""
+
+    def __init__(self, max_size_bytes=DEFAULT_CACHE_MAX_SIZE_BYTES):
+        self.max_size_bytes = max_size_bytes
+        self._entries = OrderedDict()  # key -> value, least recently used first
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.num_evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._size_bytes -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._size_bytes += len(value)
+            while self._size_bytes > self.max_size_bytes and len(self._entries) > 0:
+                _, evicted = self._entries.popitem(last=False)
+                self._size_bytes -= len(evicted)
+                self.num_evictions += 1
+
+    def get_size(self):
+        """Returns (number of entries, total size of the values in bytes)."""
+        with self._lock:
+            return len(self._entries), self._size_bytes
+
+
+class SqliteCacheBackend:
+    """
+    Keeps the cached values in a SQLite database, so that they survive restarts and can be
+    shared by processes on the same machine.
+    """
+
+    def __init__(self, db_path, max_size_bytes=DEFAULT_CACHE_MAX_SIZE_BYTES):
+        self.db_path = db_path
+        self.max_size_bytes = max_size_bytes
+        self.num_evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS results '
+                               '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+
+    def get(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                               (key, value, len(value), time.time()))
+
+            total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total_size <= self.max_size_bytes:
+                return
+
+            # evict the least recently used entries until the rest fits
+            to_evict = []
+            for evict_key, size in self._conn.execute(
+                    'SELECT key, size FROM results ORDER BY last_access'):
+                if total_size <= self.max_size_bytes:
+                    break
+                to_evict.append((evict_key,))
+                total_size -= size
+            self._conn.executemany('DELETE FROM results WHERE key = ?', to_evict)
+            self.num_evictions += len(to_evict)
+
+    def get_size(self):
+        """Returns (number of entries, total size of the values in bytes)."""
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+#%% Cache
+
+class DetectionCache:
+    """
+    Stores json-serializable detection results by image hash, model version and threshold
+    bucket, and counts hits and misses.
+    """
+
+    def __init__(self, backend, bucket_width=DEFAULT_THRESHOLD_BUCKET_WIDTH):
+        self.backend = backend
+        self.bucket_width = bucket_width
+        self._lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def bucket(self, threshold):
+        """Returns the threshold results for threshold are computed at when they are cached."""
+        return threshold_bucket(threshold, self.bucket_width)
+
+    def _key(self, image_hash, model_version, threshold):
+        return '{}:{}:{}'.format(image_hash, model_version, self.bucket(threshold))
+
+    def get(self, image_hash, model_version, threshold):
+        """
+        Returns the result cached for this image, model version and the bucket of threshold,
+        or None.
+        """
+        value = self.backend.get(self._key(image_hash, model_version, threshold))
+        with self._lock:
+            if value is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+        return json.loads(value)
+
+    def put(self, image_hash, model_version, threshold, result):
+        """
+        Caches result, which needs to have been computed at self.bucket(threshold).
+        """
+        self.backend.put(self._key(image_hash, model_version, threshold), json.dumps(result))
+
+    def get_stats(self):
+        num_entries, size_bytes = self.backend.get_size()
+        with self._lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                'num_hits': self.num_hits,
+                'num_misses': self.num_misses,
+                'hit_rate': round(self.num_hits / num_lookups, 4) if num_lookups else None,
+                'num_entries': num_entries,
+                'size_mb': round(size_bytes / (1024 * 1024), 2),
+                'max_size_mb': round(self.backend.max_size_bytes / (1024 * 1024), 2),
+                'num_evictions': self.backend.num_evictions
+            }
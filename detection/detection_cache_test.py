@@ -0,0 +1,155 @@
+"""
+Tests for detection.detection_cache and its use in run_tf_detector_batch, with a fake
+detector instead of a model file.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+from detection import run_tf_detector_batch
+from detection.detection_cache import (DetectionCache, MemoryCacheBackend, SqliteCacheBackend,
+                                       filter_api_result, threshold_bucket)
+from detection.run_tf_detector import TFDetector
+from detection.run_tf_detector_test import make_raw_outputs
+
+
+class CacheBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_lru_eviction(self, backend):
+        backend.put('a', 'x' * 40)
+        backend.put('b', 'x' * 40)
+        self.assertEqual(backend.get('a'), 'x' * 40)  # b is now the least recently used
+
+        backend.put('c', 'x' * 40)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), 'x' * 40)
+        self.assertEqual(backend.get('c'), 'x' * 40)
+        self.assertEqual(tuple(backend.get_size()), (2, 80))
+        self.assertEqual(backend.num_evictions, 1)
+
+    def test_memory_backend(self):
+        self.check_lru_eviction(MemoryCacheBackend(max_size_bytes=100))
+
+    def test_sqlite_backend(self):
+        db_path = os.path.join(self.temp_dir, 'cache.sqlite')
+        backend = SqliteCacheBackend(db_path, max_size_bytes=100)
+        self.check_lru_eviction(backend)
+        backend.close()
+
+        # entries persist across instances
+        backend = SqliteCacheBackend(db_path, max_size_bytes=100)
+        self.assertEqual(backend.get('c'), 'x' * 40)
+        backend.close()
+
+
+class ThresholdBucketTest(unittest.TestCase):
+
+    def test_threshold_bucket(self):
+        self.assertEqual(threshold_bucket(0.1), 0.1)
+        self.assertEqual(threshold_bucket(0.15), 0.15)
+        self.assertEqual(threshold_bucket(0.17), 0.15)
+        self.assertEqual(threshold_bucket(0.8), 0.8)
+        self.assertEqual(threshold_bucket(0.01), 0.0)
+
+    def test_filter_matches_detector_at_threshold(self):
+        b_box, b_score, b_class = make_raw_outputs(n_images=16)
+
+        for threshold in [0.1, 0.17, 0.5, 0.85]:
+            bucket = threshold_bucket(threshold)
+            expected = TFDetector._convert_raw_detections_batch(b_box, b_score, b_class, threshold)
+            actual = [filter_api_result(result, threshold) for result in
+                      TFDetector._convert_raw_detections_batch(b_box, b_score, b_class, bucket)]
+            self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+
+class FakeBatchDetector:
+    """Stands in for TFDetector in run_tf_detector_batch; the output depends on the mean pixel value."""
+
+    num_images_processed = 0
+
+    def __init__(self, model_file):
+        pass
+
+    def generate_detections_one_image(self, image, image_id, detection_threshold):
+        FakeBatchDetector.num_images_processed += 1
+        seed = int(np.asarray(image, np.float32).mean())
+        # the first image of make_raw_outputs() has no detections
+        b_box, b_score, b_class = make_raw_outputs(2, n_boxes=20, seed=seed)
+        result = TFDetector._convert_raw_detections_batch(b_box[1:], b_score[1:], b_class[1:],
+                                                          detection_threshold)[0]
+        result['file'] = image_id
+        return result
+
+
+class LoadAndRunDetectorBatchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        # images 0 and 3 have the same content
+        self.image_files = []
+        for i, color in enumerate([10, 60, 110, 10, 160]):
+            path = os.path.join(self.temp_dir, 'image_{}.png'.format(i))
+            Image.new('RGB', (32, 24), (color, color, color)).save(path)
+            self.image_files.append(path)
+
+        FakeBatchDetector.num_images_processed = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_detector(self, image_files, cache, threshold):
+        with mock.patch.object(run_tf_detector_batch, 'TFDetector', FakeBatchDetector):
+            results = run_tf_detector_batch.load_and_run_detector_batch(
+                'model.pb', image_files, confidence_threshold=threshold, n_loader_workers=0,
+                cache=cache)
+        return sorted(results, key=lambda r: r['file'])
+
+    def test_cache(self):
+        expected = self.run_detector(self.image_files, None, 0.17)
+        self.assertEqual(FakeBatchDetector.num_images_processed, 5)
+
+        cache = DetectionCache(MemoryCacheBackend())
+
+        # the duplicate is only processed once
+        FakeBatchDetector.num_images_processed = 0
+        results = self.run_detector(self.image_files, cache, 0.17)
+        self.assertEqual(FakeBatchDetector.num_images_processed, 4)
+        self.assertEqual(json.dumps(expected), json.dumps(results))
+
+        # everything is cached now, also for another threshold in the same bucket
+        FakeBatchDetector.num_images_processed = 0
+        results = self.run_detector(self.image_files, cache, 0.19)
+        self.assertEqual(FakeBatchDetector.num_images_processed, 0)
+        self.assertEqual(json.dumps(self.run_detector(self.image_files, None, 0.19)), json.dumps(results))
+        self.assertEqual(cache.get_stats()['num_hits'], 5)
+
+    def test_unhashable_image(self):
+        # run at 0.15, the lower edge of the bucket, image 1 has a detection below 0.19
+        expected = self.run_detector(self.image_files, None, 0.19)
+
+        # an image that can be loaded but not hashed is not cached, but still filtered to the threshold
+        cache = DetectionCache(MemoryCacheBackend())
+        with mock.patch.object(run_tf_detector_batch, 'hash_image_file_or_none',
+                               lambda im_file: None if im_file.endswith('_1.png') else
+                               run_tf_detector_batch.hash_image_file(im_file)):
+            results = self.run_detector(self.image_files, cache, 0.19)
+        self.assertEqual(json.dumps(expected), json.dumps(results))
+        self.assertEqual(cache.get_stats()['num_entries'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
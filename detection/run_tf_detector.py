@@ -46,12 +46,13 @@ import statistics
 import sys
 import time
 import warnings
+from collections import defaultdict
 
 import humanfriendly
 import numpy as np
 from tqdm import tqdm
 
-from ct_utils import truncate_float
+from ct_utils import truncate_float, truncate_float_array
 import visualization.visualization_utils as viz_utils
 
 # ignoring all "PIL cannot read EXIF metainfo for the images" warnings
@@ -113,8 +114,9 @@ class ImagePathUtils:
 class TFDetector:
     """
     A detector model loaded at the time of initialization. It is intended to be used with
-    the MegaDetector (TF). The inference batch size is set to 1; code needs to be modified
-    to support larger batch sizes, including resizing appropriately.
+    the MegaDetector (TF). generate_detections_one_image() runs inference with a batch size
+    of 1; generate_detections_batch() groups images of the same size and runs each group
+    through the graph in one session call.
     """
 
     # Number of decimal places to round to for confidence and bbox coordinates
@@ -122,9 +124,13 @@ class TFDetector:
     COORD_DIGITS = 4
 
     # MegaDetector was trained with batch size of 1, and the resizing function is a part
-    # of the inference graph
+    # of the inference graph, so only images of identical size can be stacked into one batch
     BATCH_SIZE = 1
 
+    # Default maximum number of same-sized images fed to one session.run() call
+    # in generate_detections_batch()
+    DEFAULT_INFERENCE_BATCH_SIZE = 8
+
     # An enumeration of failure reasons
     FAILURE_TF_INFER = 'Failure TF inference'
     FAILURE_IMAGE_OPEN = 'Failure image access'
@@ -203,10 +209,6 @@ class TFDetector:
         np_im = np.asarray(image, np.uint8)
         im_w_batch_dim = np.expand_dims(np_im, axis=0)
 
-        # need to change the above line to the following if supporting a batch size > 1 and resizing to the same size
-        # np_images = [np.asarray(image, np.uint8) for image in images]
-        # images_stacked = np.stack(np_images, axis=0) if len(images) > 1 else np.expand_dims(np_images[0], axis=0)
-
         # performs inference
         (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
             [self.box_tensor, self.score_tensor, self.class_tensor],
@@ -214,6 +216,99 @@ class TFDetector:
 
         return box_tensor_out, score_tensor_out, class_tensor_out
 
+    def _generate_detections_batch(self, images):
+        """Runs inference on a list of PIL images that all have the same size, in a single
+        session call."""
+        np_images = [np.asarray(image, np.uint8) for image in images]
+        images_stacked = np.stack(np_images, axis=0)
+
+        # performs inference
+        (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
+            [self.box_tensor, self.score_tensor, self.class_tensor],
+            feed_dict={self.image_tensor: images_stacked})
+
+        return box_tensor_out, score_tensor_out, class_tensor_out
+
+    @staticmethod
+    def _convert_raw_detections(boxes, scores, classes, detection_threshold):
+        """Converts the raw output tensors for one image into the `max_detection_conf` and
+        `detections` fields of the API output format, one box at a time.
+
+        This is the reference implementation for _convert_raw_detections_batch(), which is
+        what the detector uses."""
+        detections_cur_image = []  # will be empty for an image with no confident detections
+        max_detection_conf = 0.0
+        for b, s, c in zip(boxes, scores, classes):
+            if s > detection_threshold:
+                detection_entry = {
+                    'category': str(int(c)),  # use string type for the numerical class label, not int
+                    'conf': truncate_float(float(s),  # cast to float for json serialization
+                                           precision=TFDetector.CONF_DIGITS),
+                    'bbox': TFDetector.__convert_coords(b)
+                }
+                detections_cur_image.append(detection_entry)
+                if s > max_detection_conf:
+                    max_detection_conf = s
+
+        return {
+            'max_detection_conf': truncate_float(float(max_detection_conf),
+                                                 precision=TFDetector.CONF_DIGITS),
+            'detections': detections_cur_image
+        }
+
+    @staticmethod
+    def _convert_raw_detections_batch(b_box, b_score, b_class, detection_threshold):
+        """Vectorized version of _convert_raw_detections() for the output tensors of a whole batch.
+
+        Args:
+            b_box: array of shape [n_images, n_boxes, 4], boxes as [y1, x1, y2, x2]
+            b_score: array of shape [n_images, n_boxes]
+            b_class: array of shape [n_images, n_boxes]
+            detection_threshold: confidence above which to include the detection proposal
+
+        Returns: a list with one dict per image, containing the `max_detection_conf` and
+        `detections` fields exactly as _convert_raw_detections() would produce them
+        """
+        b_box, b_score, b_class = np.asarray(b_box), np.asarray(b_score), np.asarray(b_class)
+
+        # scores are compared to the threshold as float64, like float(s) would be
+        keep = b_score.astype(np.float64) > detection_threshold
+
+        # boolean indexing keeps the image-major, box-minor order of the loop over each image
+        boxes = b_box[keep]
+        # change from [y1, x1, y2, x2] to [x1, y1, width_box, height_box]; the width and height are
+        # computed in the dtype of the model output before being converted to Python floats
+        coords = np.stack([boxes[:, 1], boxes[:, 0],
+                           boxes[:, 3] - boxes[:, 1], boxes[:, 2] - boxes[:, 0]], axis=1)
+        coords = truncate_float_array(coords.astype(np.float64).ravel().tolist(),
+                                      precision=TFDetector.COORD_DIGITS)
+        confs = truncate_float_array(b_score[keep].astype(np.float64).tolist(),
+                                     precision=TFDetector.CONF_DIGITS)
+        categories = [str(c) for c in b_class[keep].astype(np.int64).tolist()]
+
+        max_confs = np.where(keep, b_score, 0).max(axis=1, initial=0)
+        max_confs = truncate_float_array(max_confs.astype(np.float64).tolist(),
+                                         precision=TFDetector.CONF_DIGITS)
+
+        results = []
+        i_detection = 0
+        for i_image, n_detections in enumerate(keep.sum(axis=1).tolist()):
+            detections_cur_image = []  # will be empty for an image with no confident detections
+            for i in range(i_detection, i_detection + n_detections):
+                detections_cur_image.append({
+                    'category': categories[i],
+                    'conf': confs[i],
+                    'bbox': coords[4 * i:4 * i + 4]
+                })
+            i_detection += n_detections
+
+            results.append({
+                'max_detection_conf': max_confs[i_image],
+                'detections': detections_cur_image
+            })
+
+        return results
+
     def generate_detections_one_image(self, image, image_id,
                                       detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD):
         """Apply the detector to an image.
@@ -236,26 +331,9 @@ class TFDetector:
         try:
             b_box, b_score, b_class = self._generate_detections_one_image(image)
 
-            # our batch size is 1; need to loop the batch dim if supporting batch size > 1
-            boxes, scores, classes = b_box[0], b_score[0], b_class[0]
-
-            detections_cur_image = []  # will be empty for an image with no confident detections
-            max_detection_conf = 0.0
-            for b, s, c in zip(boxes, scores, classes):
-                if s > detection_threshold:
-                    detection_entry = {
-                        'category': str(int(c)),  # use string type for the numerical class label, not int
-                        'conf': truncate_float(float(s),  # cast to float for json serialization
-                                               precision=TFDetector.CONF_DIGITS),
-                        'bbox': TFDetector.__convert_coords(b)
-                    }
-                    detections_cur_image.append(detection_entry)
-                    if s > max_detection_conf:
-                        max_detection_conf = s
-
-            result['max_detection_conf'] = truncate_float(float(max_detection_conf),
-                                                          precision=TFDetector.CONF_DIGITS)
-            result['detections'] = detections_cur_image
+            # our batch size is 1
+            result.update(TFDetector._convert_raw_detections_batch(b_box, b_score, b_class,
+                                                                   detection_threshold)[0])
 
         except Exception as e:
             result['failure'] = TFDetector.FAILURE_TF_INFER
@@ -263,6 +341,62 @@ class TFDetector:
 
         return result
 
+    def generate_detections_batch(self, images, image_ids,
+                                  detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                                  batch_size=DEFAULT_INFERENCE_BATCH_SIZE):
+        """Apply the detector to a list of images, running several images per session call.
+
+        The resizer is part of the inference graph, so images are grouped by their size and
+        each group is split into batches of at most batch_size images. Results are identical
+        to calling generate_detections_one_image() on each image.
+
+        Args:
+            images: list of PIL Image objects
+            image_ids: list of paths to identify the images, same length as images
+            detection_threshold: confidence above which to include the detection proposal
+            batch_size: maximum number of images to stack into one session call
+
+        Returns:
+        A list of dicts in the same order as images, each in the format returned by
+        generate_detections_one_image(). If a batch fails, every image in that batch gets a
+        `failure` field.
+        """
+        assert len(images) == len(image_ids), 'images and image_ids need to have the same length'
+        assert batch_size > 0, 'batch_size needs to be > 0'
+
+        indices_by_size = defaultdict(list)
+        for i_image, image in enumerate(images):
+            indices_by_size[image.size].append(i_image)
+
+        results = [None] * len(images)
+
+        for indices in indices_by_size.values():
+            for i_start in range(0, len(indices), batch_size):
+                batch_indices = indices[i_start:i_start + batch_size]
+                try:
+                    b_box, b_score, b_class = self._generate_detections_batch(
+                        [images[i_image] for i_image in batch_indices])
+
+                    batch_results = TFDetector._convert_raw_detections_batch(b_box, b_score, b_class,
+                                                                             detection_threshold)
+                    for i_image, batch_result in zip(batch_indices, batch_results):
+                        result = {
+                            'file': image_ids[i_image]
+                        }
+                        result.update(batch_result)
+                        results[i_image] = result
+
+                except Exception as e:
+                    print('TFDetector: a batch of {} images failed during inference: {}'.format(
+                        len(batch_indices), str(e)))
+                    for i_image in batch_indices:
+                        results[i_image] = {
+                            'file': image_ids[i_image],
+                            'failure': TFDetector.FAILURE_TF_INFER
+                        }
+
+        return results
+
 
 #%% Main function
 
@@ -16,12 +16,25 @@ are processed and final results file written to output_file,
 the temporary checkpoint file will be deleted. If you want to resume from a checkpoint,
 set the checkpoint file's path using --resume_from_checkpoint.
 
+With --cache_file, results are cached by image content and model in a SQLite file, so that
+images that have been processed before (also under another name or in another folder) are
+not run through the detector again; see detection/detection_cache.py.
+
+Checkpoint files are append-only .jsonl files with one result per line; only the results
+since the last checkpoint are written each time. --resume_from_checkpoint also accepts
+checkpoints in the older .json format ({"images": [...]}).
+
 The `threshold` you can provide as an argument is the confidence threshold above which detections
 will be included in the output file.
 
-Has preliminary multiprocessing support for CPUs only; if a GPU is available, it will
-use the GPU instead of CPUs, and the --ncores option will be ignored.  Checkpointing
-is not supported when using multiprocessing.
+When running in a single process, images are decoded on a pool of --loader_workers threads
+while the detector runs, with at most --prefetch_queue_size decoded images waiting in memory.
+
+Has multiprocessing support for CPUs only; if a GPU is available, it will
+use the GPU instead of CPUs, and the --ncores option will be ignored.  When using
+multiprocessing, each worker process loads the model once and results are collected
+as they complete, so checkpointing and resuming work the same way as in a single
+process, but the order of entries in the output file is not the order of the input.
 
 Sample invocation:
 
@@ -42,6 +55,8 @@ import copy
 import warnings
 import itertools
         
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 
@@ -50,6 +65,9 @@ from tqdm import tqdm
 # from multiprocessing.pool import ThreadPool as workerpool
 from multiprocessing.pool import Pool as workerpool
 
+from ct_utils import write_json_streaming
+from detection.detection_cache import (DetectionCache, SqliteCacheBackend, filter_api_result,
+                                       hash_image_file, DEFAULT_CACHE_MAX_SIZE_BYTES)
 from detection.run_tf_detector import ImagePathUtils, TFDetector
 import visualization.visualization_utils as viz_utils
 
@@ -62,8 +80,87 @@ print('TensorFlow version:', tf.__version__)
 print('tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
 
+#%% Support functions for prefetching images
+
+DEFAULT_LOADER_WORKERS = 4
+DEFAULT_PREFETCH_QUEUE_SIZE = 8
+
+
+def load_image_or_exception(im_file):
+    """
+    Loads an image, returning (image, None) on success and (None, exception) on failure,
+    so that failures can be reported by the consumer in input order.
+    """
+    
+    try:
+        return viz_utils.load_image(im_file), None
+    except Exception as e:
+        return None, e
+
+
+def prefetch_images(im_files, n_workers=DEFAULT_LOADER_WORKERS,
+                    queue_size=DEFAULT_PREFETCH_QUEUE_SIZE):
+    """
+    Generator that decodes images on a pool of n_workers threads while the caller consumes
+    them, keeping at most queue_size images loaded or in flight ahead of the consumer.
+    
+    Yields (im_file, image, exception) tuples in the order of im_files; image is None and
+    exception is set if the image could not be loaded. If n_workers is 0, images are loaded
+    on the calling thread.
+    """
+    
+    if n_workers <= 0:
+        for im_file in im_files:
+            image, e = load_image_or_exception(im_file)
+            yield im_file, image, e
+        return
+    
+    assert queue_size > 0, 'queue_size needs to be > 0'
+    
+    im_files_iter = iter(im_files)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for im_file in itertools.islice(im_files_iter, queue_size):
+            pending.append((im_file, executor.submit(load_image_or_exception, im_file)))
+        
+        while len(pending) > 0:
+            im_file, future = pending.popleft()
+            image, e = future.result()
+            
+            # Keep the queue full before handing this image to the consumer
+            for next_file in itertools.islice(im_files_iter, 1):
+                pending.append((next_file, executor.submit(load_image_or_exception, next_file)))
+            
+            yield im_file, image, e
+
+
 #%% Support functions for multiprocessing
 
+# The detector used by process_image_in_worker(); loaded once per worker process by init_worker()
+worker_tf_detector = None
+
+
+def init_worker(model_file):
+    """
+    Pool initializer: loads the detector once in each worker process.
+    """
+    
+    global worker_tf_detector
+    
+    start_time = time.time()
+    worker_tf_detector = TFDetector(model_file)
+    elapsed = time.time() - start_time
+    print('Loaded model (worker level) in {}'.format(humanfriendly.format_timespan(elapsed)))
+
+
+def process_image_in_worker(im_file, confidence_threshold):
+    """
+    Runs the detector loaded by init_worker() on one image.
+    """
+    
+    return process_image(im_file, worker_tf_detector, confidence_threshold)
+
+
 def process_images(im_files, tf_detector, confidence_threshold):
     
     if isinstance(tf_detector,str):
@@ -121,11 +218,156 @@ def chunks_by_number_of_chunks(l, n):
         yield l[i::n]
         
         
+#%% Result cache
+
+def hash_image_file_or_none(im_file):
+    try:
+        return hash_image_file(im_file)
+    except Exception:
+        return None
+
+
+def split_cached_images(im_files, cache, model_version, confidence_threshold, results,
+                        n_workers=DEFAULT_LOADER_WORKERS):
+    """
+    Looks up im_files in the result cache by their content. Results of cached images are
+    appended to results. Of several uncached files with the same content, only the first
+    needs to be run through the detector.
+    
+    Returns:
+        im_files_to_process: the files that need to be run through the detector
+        image_hashes: dict of file in im_files_to_process to its content hash
+        duplicates: dict of file in im_files_to_process to the other files with the same content
+    """
+    
+    print('Hashing {} images to look them up in the result cache'.format(len(im_files)))
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        hashes = list(tqdm(executor.map(hash_image_file_or_none, im_files), total=len(im_files)))
+    
+    im_files_to_process = []
+    image_hashes = {}
+    duplicates = {}
+    file_by_hash = {}
+    for im_file, image_hash in zip(im_files, hashes):
+        
+        # Unreadable files go to the detector, which will report them as failures
+        if image_hash is None:
+            im_files_to_process.append(im_file)
+            continue
+        
+        if image_hash in file_by_hash:
+            duplicates[file_by_hash[image_hash]].append(im_file)
+            continue
+        
+        cached = cache.get(image_hash, model_version, confidence_threshold)
+        if cached is not None:
+            cached['file'] = im_file
+            results.append(filter_api_result(cached, confidence_threshold))
+            continue
+        
+        file_by_hash[image_hash] = im_file
+        im_files_to_process.append(im_file)
+        image_hashes[im_file] = image_hash
+        duplicates[im_file] = []
+    
+    n_duplicates = sum(len(v) for v in duplicates.values())
+    n_cached = len(im_files) - len(im_files_to_process) - n_duplicates
+    print('{} images found in the result cache, {} duplicates of images to process'.format(
+        n_cached, n_duplicates))
+    return im_files_to_process, image_hashes, duplicates
+
+
+#%% Checkpointing
+
+def write_checkpoint(checkpoint_path, results):
+    """
+    Appends results to the .jsonl checkpoint at checkpoint_path, one result per line, and
+    makes sure they are on disk before returning.
+    """
+    
+    with open(checkpoint_path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def iterate_checkpoint(checkpoint_path):
+    """
+    Generator over the results in a .jsonl checkpoint. A truncated last line (e.g. if the
+    process was killed while writing a checkpoint) is skipped with a warning.
+    """
+    
+    with open(checkpoint_path) as f:
+        previous_line = None
+        for line in f:
+            if not line.strip():
+                continue
+            if previous_line is not None:
+                yield json.loads(previous_line)
+            previous_line = line
+        
+        if previous_line is not None:
+            try:
+                result = json.loads(previous_line)
+            except json.JSONDecodeError:
+                print('Warning: ignoring truncated last line in checkpoint {}'.format(checkpoint_path))
+                return
+            yield result
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Loads the list of results in a checkpoint, either in the .jsonl format written by
+    write_checkpoint() or in the older .json format ({"images": [...]}).
+    """
+    
+    with open(checkpoint_path) as f:
+        first_line = f.readline()
+        is_single_line = len(f.read().strip()) == 0
+    
+    # The first line of a .jsonl checkpoint is a single result
+    try:
+        first_entry = json.loads(first_line)
+    except json.JSONDecodeError:
+        first_entry = None
+    if isinstance(first_entry, dict) and 'file' in first_entry:
+        return list(iterate_checkpoint(checkpoint_path))
+    
+    # An empty checkpoint only exists in the .jsonl format
+    if len(first_line.strip()) == 0:
+        return []
+    
+    with open(checkpoint_path) as f:
+        try:
+            saved = json.load(f)
+        except json.JSONDecodeError:
+            # A .jsonl checkpoint whose only line was truncated while the first checkpoint was 
+            # being written; iterate_checkpoint() skips it with a warning
+            if is_single_line:
+                return list(iterate_checkpoint(checkpoint_path))
+            raise
+    assert 'images' in saved, \
+        'The file saved as checkpoint does not have the correct fields; cannot be restored'
+    return saved['images']
+
+
 #%% Main function
         
 def load_and_run_detector_batch(model_file, image_file_names, checkpoint_path=None,
                                 confidence_threshold=0, checkpoint_frequency=-1, 
-                                results=None, n_cores=0):
+                                results=None, n_cores=0,
+                                n_loader_workers=DEFAULT_LOADER_WORKERS,
+                                prefetch_queue_size=DEFAULT_PREFETCH_QUEUE_SIZE,
+                                cache=None, model_version=None):
+    """
+    Runs the detector on image_file_names, skipping those already in results; see the module
+    docstring for checkpointing and multiprocessing.
+    
+    If cache (a DetectionCache) is given, images whose content is in the cache for
+    model_version (by default the name of model_file) are not run through the detector, and
+    the results of the others are added to the cache.
+    """
     
     if results is None:
         results = []
@@ -135,74 +377,117 @@ def load_and_run_detector_batch(model_file, image_file_names, checkpoint_path=No
     if n_cores > 1 and tf.test.is_gpu_available():
         print('Warning: multiple cores requested, but a GPU is available; parallelization across GPUs is not currently supported, defaulting to one GPU')
     
+    # Will not add additional entries not in the starter checkpoint
+    im_files_to_process = [im_file for im_file in image_file_names if im_file not in already_processed]
+    n_bypassed = len(image_file_names) - len(im_files_to_process)
+    if n_bypassed > 0:
+        print('Bypassing {} images already in the checkpoint'.format(n_bypassed))
+    
+    # The detector is run at the lower edge of the cache's threshold bucket, so that the 
+    # cached results can be used with other thresholds in the same bucket
+    inference_threshold = confidence_threshold
+    image_hashes, duplicates = {}, {}
+    if cache is not None:
+        if model_version is None:
+            model_version = os.path.splitext(os.path.basename(model_file))[0]
+        inference_threshold = cache.bucket(confidence_threshold)
+        im_files_to_process, image_hashes, duplicates = split_cached_images(
+            im_files_to_process, cache, model_version, confidence_threshold, results,
+            n_workers=n_loader_workers)
+    
+    def _add_result(result):
+        if cache is not None:
+            # results were computed at inference_threshold, including those of images that could
+            # not be hashed and so are not cached
+            if 'failure' not in result:
+                if result['file'] in image_hashes:
+                    cached = {k: v for k, v in result.items() if k != 'file'}
+                    cache.put(image_hashes[result['file']], model_version, confidence_threshold, cached)
+                result = filter_api_result(result, confidence_threshold)
+            for duplicate_file in duplicates.get(result['file'], []):
+                duplicate_result = dict(result)
+                duplicate_result['file'] = duplicate_file
+                results.append(duplicate_result)
+        results.append(result)
+    
+    # Does not count those already processed
+    count = 0  
+    
+    # Number of entries in results already written to checkpoint_path
+    n_checkpointed = 0
+    
     # If we're not using multiprocessing...
     if n_cores <= 1 or tf.test.is_gpu_available():
+        
         # Load the detector
         start_time = time.time()
         tf_detector = TFDetector(model_file)
         elapsed = time.time() - start_time
         print('Loaded model in {}'.format(humanfriendly.format_timespan(elapsed)))    
-    else:
-        # If we're using multiprocessing, let the workers load the model, just store
-        # the model filename.
-        tf_detector = model_file
-
-    if n_cores <= 1 or tf.test.is_gpu_available():
-        
-        # Does not count those already processed
-        count = 0  
         
-        for im_file in tqdm(image_file_names):
-            
-            # Will not add additional entries not in the starter checkpoint
-            if im_file in already_processed:  
-                print('Bypassing image {}'.format(im_file))
-                continue
+        for im_file, image, e in tqdm(prefetch_images(im_files_to_process, n_workers=n_loader_workers,
+                                                      queue_size=prefetch_queue_size),
+                                      total=len(im_files_to_process)):
     
             count += 1
     
-            try:
-                image = viz_utils.load_image(im_file)
-            except Exception as e:
+            if image is None:
                 print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
                 result = {
                     'file': im_file,
                     'failure': TFDetector.FAILURE_IMAGE_OPEN
                 }
-                results.append(result)
+                _add_result(result)
                 continue
     
             try:
-                result = tf_detector.generate_detections_one_image(image, im_file, detection_threshold=confidence_threshold)
-                results.append(result)
+                result = tf_detector.generate_detections_one_image(image, im_file, detection_threshold=inference_threshold)
+                _add_result(result)
     
             except Exception as e:
                 print('An error occurred while running the detector on image {}. Exception: {}'.format(im_file, e))
                 result = {
                     'file': im_file,
-                    'failure': TFDetector.FAILURE_IMAGE_INFER
+                    'failure': TFDetector.FAILURE_TF_INFER
                 }
-                results.append(result)
+                _add_result(result)
                 continue
     
             # checkpoint
             if checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
                 print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
-                with open(checkpoint_path, 'w') as f:
-                    json.dump({'images': results}, f)
+                write_checkpoint(checkpoint_path, results[n_checkpointed:])
+                n_checkpointed = len(results)
     else:
         print('Creating pool with {} cores'.format(n_cores))
         
-        if len(already_processed) > 0:
-            print('Warning: when using multiprocessing, all images are reprocessed')
-            
-        pool = workerpool(n_cores)
+        # Each worker loads the detector once; images are handed out one at a time and results
+        # stream back as they complete, so that the parent process can write checkpoints
+        pool = workerpool(n_cores, initializer=init_worker, initargs=(model_file,))
         
-        image_batches = list(chunks_by_number_of_chunks(image_file_names,n_cores))
-        results = pool.map(partial(process_images, tf_detector=tf_detector, 
-                                    confidence_threshold=confidence_threshold), image_batches)
-
-        results = list(itertools.chain.from_iterable(results))
+        try:
+            for result in tqdm(pool.imap_unordered(partial(process_image_in_worker,
+                                                           confidence_threshold=inference_threshold),
+                                                   im_files_to_process),
+                               total=len(im_files_to_process)):
+                
+                count += 1
+                _add_result(result)
+                
+                # checkpoint
+                if checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
+                    print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
+                    write_checkpoint(checkpoint_path, results[n_checkpointed:])
+                    n_checkpointed = len(results)
+        except BaseException:
+            pool.terminate()
+            raise
+        
+        pool.close()
+        pool.join()
+    
+    if cache is not None:
+        print('Result cache: {}'.format(cache.get_stats()))
         
     # This was modified in place, but we also return it for backwards-compatibility.
     return results 
@@ -210,28 +495,30 @@ def load_and_run_detector_batch(model_file, image_file_names, checkpoint_path=No
 
 def write_results_to_file(results, output_file, relative_path_base=None):
     '''
-    Write the list of detection results in *results* to the .json file 
-    *output_file*, optionally making filenames relative to *relative_path_base*.
+    Write the detection results in *results* to the .json file *output_file*, 
+    optionally making filenames relative to *relative_path_base*.
+    
+    *results* can be a list or any iterable of results, such as iterate_checkpoint(...);
+    entries are encoded and written one at a time, so the output can be built from a 
+    checkpoint without loading all results into memory.
     '''
     
-    if relative_path_base is not None:
-        results_relative = []
+    def _results_to_write():
         for r in results:
-            r_relative = copy.copy(r)
-            r_relative['file'] = os.path.relpath(r_relative['file'], start=relative_path_base)
-            results_relative.append(r_relative)
-        results = results_relative
+            if relative_path_base is not None:
+                r = copy.copy(r)
+                r['file'] = os.path.relpath(r['file'], start=relative_path_base)
+            yield r
 
     final_output = {
-        'images': results,
-        'detection_categories': TFDetector.DEFAULT_DETECTOR_LABEL_MAP,
         'info': {
             'detection_completion_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
             'format_version': '1.0'
-        }
+        },
+        'detection_categories': TFDetector.DEFAULT_DETECTOR_LABEL_MAP,
+        'images': _results_to_write()
     }
-    with open(output_file, 'w') as f:
-        json.dump(final_output, f, indent=1)
+    write_json_streaming(output_file, final_output, streamed_key='images', indent=1)
     print('Output file saved at {}'.format(output_file))
 
     
@@ -274,12 +561,30 @@ def main():
         help='Write results to a temporary file every N images; default is -1, which disables this feature')
     parser.add_argument(
         '--resume_from_checkpoint',
-        help='Initiate from the specified checkpoint, which is in the same directory as the output_file specified')
+        help='Initiate from the specified checkpoint (.jsonl, or .json in the older format), which is in the same directory as the output_file specified')
     parser.add_argument(
         '--ncores',
         type=int,
         default=0,
-        help='Number of cores to use; only applies to CPU-based inference, does not support checkpointing when ncores > 1')
+        help='Number of cores to use; only applies to CPU-based inference')
+    parser.add_argument(
+        '--loader_workers',
+        type=int,
+        default=DEFAULT_LOADER_WORKERS,
+        help='Number of threads decoding images ahead of the detector when running in a single process; 0 loads images on the main thread. Default is {}'.format(DEFAULT_LOADER_WORKERS))
+    parser.add_argument(
+        '--prefetch_queue_size',
+        type=int,
+        default=DEFAULT_PREFETCH_QUEUE_SIZE,
+        help='Maximum number of decoded images waiting for the detector; default is {}'.format(DEFAULT_PREFETCH_QUEUE_SIZE))
+    parser.add_argument(
+        '--cache_file',
+        help='SQLite file of cached results; images whose content has been processed before with the same model are not run through the detector again. Created if it does not exist')
+    parser.add_argument(
+        '--cache_max_size_gb',
+        type=float,
+        default=DEFAULT_CACHE_MAX_SIZE_BYTES / (1024 ** 3),
+        help='Maximum size of the results in --cache_file; the least recently used results are evicted beyond it. Default is {}'.format(DEFAULT_CACHE_MAX_SIZE_BYTES / (1024 ** 3)))
     
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -292,6 +597,8 @@ def main():
     assert args.output_file.endswith('.json'), 'output_file specified needs to end with .json'
     if args.checkpoint_frequency != -1:
         assert args.checkpoint_frequency > 0, 'Checkpoint_frequency needs to be > 0 or == -1'
+    assert args.loader_workers >= 0, 'loader_workers needs to be >= 0'
+    assert args.prefetch_queue_size > 0, 'prefetch_queue_size needs to be > 0'
     if args.output_relative_filenames:
         assert os.path.isdir(args.image_file), 'Since output_relative_filenames is set, image_file needs to be a directory'
 
@@ -304,11 +611,7 @@ def main():
     # still full paths.
     if args.resume_from_checkpoint:
         assert os.path.exists(args.resume_from_checkpoint), 'File at resume_from_checkpoint specified does not exist'
-        with open(args.resume_from_checkpoint) as f:
-            saved = json.load(f)
-        assert 'images' in saved, \
-            'The file saved as checkpoint does not have the correct fields; cannot be restored'
-        results = saved['images']
+        results = load_checkpoint(args.resume_from_checkpoint)
         print('Restored {} entries from the checkpoint'.format(len(results)))
     else:
         results = []
@@ -340,13 +643,19 @@ def main():
     
     # Test that we can write to the output_file's dir if checkpointing requested
     if args.checkpoint_frequency != -1:
-        checkpoint_path = os.path.join(output_dir, 'checkpoint_{}.json'.format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
+        checkpoint_path = os.path.join(output_dir, 'checkpoint_{}.jsonl'.format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
         with open(checkpoint_path, 'w') as f:
-            json.dump({'images': []}, f)
+            pass
         print('The checkpoint file will be written to {}'.format(checkpoint_path))
     else:
         checkpoint_path = None
 
+    cache = None
+    if args.cache_file:
+        cache = DetectionCache(SqliteCacheBackend(args.cache_file,
+                                                  max_size_bytes=int(args.cache_max_size_gb * (1024 ** 3))))
+        print('Using the result cache at {}'.format(args.cache_file))
+
     start_time = time.time()
 
     results = load_and_run_detector_batch(model_file=args.detector_file,
@@ -355,7 +664,10 @@ def main():
                                           confidence_threshold=args.threshold,
                                           checkpoint_frequency=args.checkpoint_frequency,
                                           results=results,
-                                          n_cores=args.ncores)
+                                          n_cores=args.ncores,
+                                          n_loader_workers=args.loader_workers,
+                                          prefetch_queue_size=args.prefetch_queue_size,
+                                          cache=cache)
 
     elapsed = time.time() - start_time
     print('Finished inference in {}'.format(humanfriendly.format_timespan(elapsed)))
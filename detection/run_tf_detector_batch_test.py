@@ -0,0 +1,124 @@
+"""
+Tests for the .jsonl checkpoints of run_tf_detector_batch, and for resuming from them.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+from unittest import mock
+
+from detection import run_tf_detector_batch
+from detection.run_tf_detector_batch import iterate_checkpoint, load_checkpoint, write_checkpoint
+
+
+def make_result(i):
+    return {'file': 'IMG_{:04d}.JPG'.format(i), 'max_detection_conf': 0.5,
+            'detections': [{'category': '1', 'conf': 0.5, 'bbox': [0.1, 0.2, 0.3, 0.4]}]}
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.temp_dir, 'checkpoint.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_several_checkpoints(self):
+        results = [make_result(i) for i in range(10)]
+        write_checkpoint(self.checkpoint_path, results[:4])
+        write_checkpoint(self.checkpoint_path, [])
+        write_checkpoint(self.checkpoint_path, results[4:7])
+        write_checkpoint(self.checkpoint_path, results[7:])
+
+        self.assertEqual(list(iterate_checkpoint(self.checkpoint_path)), results)
+        self.assertEqual(load_checkpoint(self.checkpoint_path), results)
+
+        # each checkpoint appends to the file
+        write_checkpoint(self.checkpoint_path, [make_result(10)])
+        self.assertEqual(load_checkpoint(self.checkpoint_path), results + [make_result(10)])
+
+    def test_empty_checkpoint(self):
+        # main() creates the checkpoint file before the first checkpoint is written
+        open(self.checkpoint_path, 'w').close()
+        self.assertEqual(load_checkpoint(self.checkpoint_path), [])
+
+    def test_truncated_last_line(self):
+        results = [make_result(i) for i in range(5)]
+        write_checkpoint(self.checkpoint_path, results[:3])
+        write_checkpoint(self.checkpoint_path, results[3:])
+
+        # as if the process was killed while writing the last result
+        with open(self.checkpoint_path) as f:
+            content = f.read()
+        with open(self.checkpoint_path, 'w') as f:
+            f.write(content[:-20])
+
+        self.assertEqual(list(iterate_checkpoint(self.checkpoint_path)), results[:4])
+        self.assertEqual(load_checkpoint(self.checkpoint_path), results[:4])
+
+        # only the last line may be truncated
+        with open(self.checkpoint_path, 'a') as f:
+            f.write('\n' + json.dumps(results[4]) + '\n')
+        with self.assertRaises(json.JSONDecodeError):
+            load_checkpoint(self.checkpoint_path)
+
+    def test_truncated_only_line(self):
+        # as if the process was killed while writing the first checkpoint
+        with open(self.checkpoint_path, 'w') as f:
+            f.write(json.dumps(make_result(0))[:-20])
+        self.assertEqual(list(iterate_checkpoint(self.checkpoint_path)), [])
+        self.assertEqual(load_checkpoint(self.checkpoint_path), [])
+
+    def test_old_format(self):
+        results = [make_result(i) for i in range(3)]
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'images': results}, f, indent=1)
+        self.assertEqual(load_checkpoint(self.checkpoint_path), results)
+
+        # on one line
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'images': results}, f)
+        self.assertEqual(load_checkpoint(self.checkpoint_path), results)
+
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'results': results}, f)
+        with self.assertRaises(AssertionError):
+            load_checkpoint(self.checkpoint_path)
+
+    def test_multiple_cores(self):
+        # worker processes are replaced by threads that return a result without a model
+        im_files = [make_result(i)['file'] for i in range(10)]
+        with mock.patch.object(run_tf_detector_batch, 'workerpool', ThreadPool), \
+             mock.patch.object(run_tf_detector_batch, 'init_worker', lambda model_file: None), \
+             mock.patch.object(run_tf_detector_batch, 'process_image_in_worker',
+                               lambda im_file, confidence_threshold: make_result(int(im_file[4:8]))):
+
+            results = run_tf_detector_batch.load_and_run_detector_batch(
+                'model.pb', im_files[:7], checkpoint_path=self.checkpoint_path,
+                checkpoint_frequency=3, n_cores=2)
+            self.assertEqual(len(results), 7)
+
+            # every image up to the last checkpoint was written, once
+            checkpointed = load_checkpoint(self.checkpoint_path)
+            self.assertEqual(len(checkpointed), 6)
+            self.assertEqual(sorted(r['file'] for r in checkpointed),
+                             sorted(r['file'] for r in results[:6]))
+
+            # resuming only processes the images that were not checkpointed, and the new
+            # checkpoint (main() starts a new file) also holds the restored results
+            new_checkpoint_path = os.path.join(self.temp_dir, 'checkpoint_resumed.jsonl')
+            results = run_tf_detector_batch.load_and_run_detector_batch(
+                'model.pb', im_files, checkpoint_path=new_checkpoint_path,
+                checkpoint_frequency=2, results=checkpointed, n_cores=2)
+            self.assertEqual(sorted(r['file'] for r in results), im_files)
+            self.assertEqual(sorted(r['file'] for r in load_checkpoint(new_checkpoint_path)),
+                             im_files)
+
+
+if __name__ == '__main__':
+    unittest.main()
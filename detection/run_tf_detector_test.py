@@ -0,0 +1,105 @@
+"""
+Tests for detection.run_tf_detector that do not need a model file: the conversion of raw
+output tensors into API-format results, and the grouping of images into batches.
+"""
+
+import json
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from detection.run_tf_detector import TFDetector
+
+
+def make_raw_outputs(n_images, n_boxes=100, seed=0):
+    """
+    Random output tensors in the layout of the TF detection graph: float32 boxes as
+    [y1, x1, y2, x2], scores sorted in decreasing order and float32 class labels.
+    """
+    rng = np.random.RandomState(seed)
+
+    corners = rng.rand(n_images, n_boxes, 2, 2).astype(np.float32)
+    corners.sort(axis=2)
+    b_box = np.stack([corners[:, :, 0, 0], corners[:, :, 0, 1],
+                      corners[:, :, 1, 0], corners[:, :, 1, 1]], axis=2)
+    # boxes touching the image border, which truncate to 0
+    b_box[:, ::7, :2] = 0.0
+
+    b_score = -np.sort(-(rng.rand(n_images, n_boxes) ** 4).astype(np.float32), axis=1)
+    # an image with no detections above any reasonable threshold
+    b_score[0] = 0.0
+
+    b_class = rng.choice([1.0, 2.0, 4.0], size=(n_images, n_boxes)).astype(np.float32)
+
+    return b_box, b_score, b_class
+
+
+class ConvertRawDetectionsTest(unittest.TestCase):
+
+    def test_batch_matches_scalar(self):
+        b_box, b_score, b_class = make_raw_outputs(n_images=16)
+
+        for detection_threshold in [0.0, 0.1, 0.85]:
+            expected = [TFDetector._convert_raw_detections(b_box[i], b_score[i], b_class[i],
+                                                           detection_threshold)
+                        for i in range(len(b_box))]
+            actual = TFDetector._convert_raw_detections_batch(b_box, b_score, b_class,
+                                                              detection_threshold)
+
+            # compare the serialized values, so that e.g. 0 and 0.0 are not considered equal
+            self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+    def test_no_boxes(self):
+        b_box = np.zeros((2, 0, 4), dtype=np.float32)
+        b_score = np.zeros((2, 0), dtype=np.float32)
+        b_class = np.zeros((2, 0), dtype=np.float32)
+
+        actual = TFDetector._convert_raw_detections_batch(b_box, b_score, b_class, 0.1)
+        self.assertEqual(json.dumps(actual),
+                         json.dumps([{'max_detection_conf': 0, 'detections': []}] * 2))
+
+
+class FakeTFDetector(TFDetector):
+    """A TFDetector whose "model" derives its outputs from the mean pixel value of each image."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def _generate_detections_batch(self, images):
+        self.batch_sizes.append(len(images))
+        assert len(set(image.size for image in images)) == 1, 'Images in a batch need to have the same size'
+
+        outputs = []
+        for image in images:
+            mean_pixel_value = np.asarray(image, np.float32).mean()
+            b_box, b_score, b_class = make_raw_outputs(1, n_boxes=5, seed=int(mean_pixel_value))
+            b_score[0, 0] = mean_pixel_value / 255
+            outputs.append((b_box, b_score, b_class))
+        return tuple(np.concatenate(tensors, axis=0) for tensors in zip(*outputs))
+
+    def _generate_detections_one_image(self, image):
+        return self._generate_detections_batch([image])
+
+
+class GenerateDetectionsBatchTest(unittest.TestCase):
+
+    def test_batch_matches_one_image(self):
+        sizes = [(40, 30), (30, 40), (40, 30), (40, 30), (20, 20), (30, 40), (40, 30)]
+        images = [Image.new('RGB', size, (25 * i, 100, 0)) for i, size in enumerate(sizes)]
+        image_ids = ['image_{}.jpg'.format(i) for i in range(len(images))]
+
+        detector = FakeTFDetector()
+        expected = [detector.generate_detections_one_image(image, image_id, detection_threshold=0.05)
+                    for image, image_id in zip(images, image_ids)]
+
+        detector.batch_sizes = []
+        actual = detector.generate_detections_batch(images, image_ids, detection_threshold=0.05,
+                                                    batch_size=3)
+
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+        self.assertEqual(sorted(detector.batch_sizes), [1, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+########
+#
+# benchmark_image_loading.py
+#
+# Compares the time to load an image and resize it to preview size with a full decode
+# (resize_image(load_image(...)), what the preview generators used to do) and with
+# load_resized_image, which decodes JPEGs at a reduced resolution.
+#
+# Uses the JPEGs in image_dir if given, otherwise writes synthetic camera-trap-sized
+# JPEGs to a temporary folder.
+#
+# Command-line use:
+#
+# python benchmark_image_loading.py --image_dir /data/camera_traps/site1 --target_width 800
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from visualization import visualization_utils as vis_utils
+
+
+#%% Support functions
+
+def write_synthetic_images(image_dir, n_images, image_width, image_height, seed=0):
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:image_height, 0:image_width]
+    base = np.stack([(x * 255 // image_width), (y * 255 // image_height),
+                     ((x + y) * 255 // (image_width + image_height))], axis=-1).astype(np.int16)
+    paths = []
+    for i_image in range(n_images):
+        noise = rng.integers(-20, 20, size=(image_height // 4, image_width // 4, 1), dtype=np.int16)
+        noise = noise.repeat(4, axis=0).repeat(4, axis=1)
+        path = os.path.join(image_dir, 'IMG_{:04d}.JPG'.format(i_image))
+        Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def time_loader(paths, load):
+    start_time = time.time()
+    for path in paths:
+        load(path)
+    return (time.time() - start_time) / len(paths)
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare full and reduced-resolution JPEG decoding for preview images')
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help='Folder of JPEGs to load (default: synthetic images)')
+    parser.add_argument('--n_images', type=int, default=20)
+    parser.add_argument('--image_width', type=int, default=4608,
+                        help='Width of synthetic images')
+    parser.add_argument('--image_height', type=int, default=3456,
+                        help='Height of synthetic images')
+    parser.add_argument('--target_width', type=int, default=800)
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.image_dir is None:
+        temp_dir = tempfile.mkdtemp()
+        print('Writing {} synthetic {}x{} images to {}'.format(
+            args.n_images, args.image_width, args.image_height, temp_dir))
+        paths = write_synthetic_images(temp_dir, args.n_images, args.image_width, args.image_height)
+    else:
+        paths = sorted(glob.glob(os.path.join(args.image_dir, '*.jpg')) +
+                       glob.glob(os.path.join(args.image_dir, '*.JPG')))[:args.n_images]
+        assert len(paths) > 0, 'No JPEGs found in {}'.format(args.image_dir)
+
+    try:
+        full_seconds = time_loader(
+            paths, lambda path: vis_utils.resize_image(vis_utils.load_image(path), args.target_width))
+        draft_seconds = time_loader(
+            paths, lambda path: vis_utils.load_resized_image(path, args.target_width))
+
+        # How different the previews are
+        differences = []
+        for path in paths:
+            full = vis_utils.resize_image(vis_utils.load_image(path), args.target_width)
+            draft = vis_utils.load_resized_image(path, args.target_width)
+            differences.append(np.abs(np.asarray(full, dtype=np.float64) -
+                                      np.asarray(draft, dtype=np.float64)).mean())
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    print('{} images, target width {}'.format(len(paths), args.target_width))
+    print('Full decode + resize: {:.1f} ms per image'.format(1000 * full_seconds))
+    print('load_resized_image:   {:.1f} ms per image ({:.1f}x faster)'.format(
+        1000 * draft_seconds, full_seconds / draft_seconds))
+    print('Mean absolute pixel difference: {:.2f} (of 255)'.format(np.mean(differences)))
+
+
+if __name__ == '__main__':
+    main()
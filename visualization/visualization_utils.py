@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import numpy as np
 import requests
+import threading
 from PIL import Image, ImageFile, ImageFont, ImageDraw
 from io import BytesIO
 from data_management.annotations import annotation_constants
@@ -33,11 +34,22 @@ def open_image(input_file):
         an PIL image object in RGB mode
     """
 
-    if input_file.startswith('http://') or input_file.startswith('https://'):
+    return _convert_to_rgb(_open_image_file(input_file), input_file)
+
+
+def _open_image_file(input_file):
+    """
+    Opens an image (path, URL or file-like object) with PIL.Image.open, without converting it.
+    """
+
+    if isinstance(input_file, str) and (input_file.startswith('http://') or input_file.startswith('https://')):
         response = requests.get(input_file)
-        image = Image.open(BytesIO(response.content))
-    else:
-        image = Image.open(input_file)
+        return Image.open(BytesIO(response.content))
+    return Image.open(input_file)
+
+
+def _convert_to_rgb(image, input_file):
+
     if image.mode not in ('RGBA', 'RGB', 'L'):
         raise AttributeError('Input image {} uses unsupported mode {}'.format(input_file, image.mode))
     if image.mode == 'RGBA' or image.mode == 'L':
@@ -63,22 +75,20 @@ def load_image(input_file):
     return image
 
 
-def resize_image(image, target_width, target_height=-1):
+def get_resized_size(size, target_width, target_height=-1):
     """
-    Resizes a PIL image object to the specified width and height; does not resize
-    in place. If either width or height are -1, resizes with aspect ratio preservation.
-    If both are -1, returns the original image (does not copy in this case).
+    Returns the (width, height) that resize_image resizes an image of size *size* to.
     """
 
     # Null operation
     if target_width == -1 and target_height == -1:
 
-        return image
+        return size
 
     elif target_width == -1 or target_height == -1:
 
         # Aspect ratio as width over height
-        aspect_ratio = image.size[0] / image.size[1]
+        aspect_ratio = size[0] / size[1]
 
         if target_width != -1:
             # ar = w / h
@@ -90,10 +100,60 @@ def resize_image(image, target_width, target_height=-1):
             # w = ar * h
             target_width = int(aspect_ratio * target_height)
 
-    resized_image = image.resize((target_width, target_height), Image.ANTIALIAS)
+    return target_width, target_height
+
+
+def resize_image(image, target_width, target_height=-1):
+    """
+    Resizes a PIL image object to the specified width and height; does not resize
+    in place. If either width or height are -1, resizes with aspect ratio preservation.
+    If both are -1, returns the original image (does not copy in this case).
+    """
+
+    # Null operation
+    if target_width == -1 and target_height == -1:
+
+        return image
+
+    resized_image = image.resize(get_resized_size(image.size, target_width, target_height), Image.ANTIALIAS)
     return resized_image
 
 
+def load_resized_image(input_file, target_width, target_height=-1, return_original_size=False):
+    """
+    Loads an image in RGB mode and resizes it, like resize_image(load_image(input_file), 
+    target_width, target_height), but faster for JPEGs that are much larger than the target 
+    size: those are decoded directly at 1/2, 1/4 or 1/8 of their resolution (using PIL's 
+    Image.draft), at the largest of those reductions that still leaves the image at least 
+    as large as the target size, and only then resized.  Other images are decoded at full resolution.
+
+    Args:
+        input_file: path, URL or file-like object, see open_image
+        target_width, target_height: as in resize_image
+        return_original_size: also return the (width, height) of the image file
+
+    Returns:
+        a PIL image object in RGB mode, or (image, original size) if return_original_size is True
+    """
+
+    image = _open_image_file(input_file)
+    original_size = image.size
+    target_size = get_resized_size(original_size, target_width, target_height)
+
+    if image.format == 'JPEG' and target_size[0] < original_size[0] and target_size[1] < original_size[1]:
+        image.draft('RGB', target_size)
+
+    image = _convert_to_rgb(image, input_file)
+    if image.size != target_size:
+        image = image.resize(target_size, Image.ANTIALIAS)
+    else:
+        image.load()
+
+    if return_original_size:
+        return image, original_size
+    return image
+
+
 def show_images_in_a_row(images):
     num = len(images)
     assert num > 0
@@ -297,6 +357,32 @@ def draw_bounding_boxes_on_image(image,
                                        display_str_list=display_str_list)
 
 
+# Label fonts loaded by get_label_font, by font size.  Each thread (and so each rendering
+# worker, whether it's a thread or a process) has its own cache, since PIL fonts aren't
+# meant to be shared between threads.
+_label_fonts = threading.local()
+
+
+def get_label_font(label_font_size=16):
+    """
+    Returns arial.ttf at the given size, or PIL's default font if it's not available.  Fonts
+    are cached, since loading a font for every box takes longer than drawing the box.
+    """
+
+    fonts = getattr(_label_fonts, 'fonts', None)
+    if fonts is None:
+        fonts = {}
+        _label_fonts.fonts = fonts
+    font = fonts.get(label_font_size)
+    if font is None:
+        try:
+            font = ImageFont.truetype('arial.ttf', label_font_size)
+        except IOError:
+            font = ImageFont.load_default()
+        fonts[label_font_size] = font
+    return font
+
+
 def draw_bounding_box_on_image(image,
                                ymin,
                                xmin,
@@ -357,10 +443,7 @@ def draw_bounding_box_on_image(image,
     draw.line([(left, top), (left, bottom), (right, bottom),
                (right, top), (left, top)], width=thickness, fill=color)
 
-    try:
-        font = ImageFont.truetype('arial.ttf', label_font_size)
-    except IOError:
-        font = ImageFont.load_default()
+    font = get_label_font(label_font_size)
 
     # If the total height of the display strings added to the top of the bounding
     # box exceeds the top of the image, stack the strings below the bounding box
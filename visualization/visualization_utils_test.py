@@ -0,0 +1,63 @@
+"""
+Tests for load_resized_image: it has to give the same size as resize_image(load_image()), and
+nearly the same pixels, whether or not the image is decoded at a reduced resolution.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from visualization import visualization_utils as vis_utils
+
+
+class LoadResizedImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        # A smooth image, so the reduced-resolution decode can be compared to the full one
+        y, x = np.mgrid[0:1500, 0:2000]
+        pixels = np.stack([x * 255 // 2000, y * 255 // 1500, (x + y) * 255 // 3500], axis=-1).astype(np.uint8)
+        self.image = Image.fromarray(pixels)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_resized_image(self, file_name, target_width, target_height=-1):
+        path = os.path.join(self.temp_dir, file_name)
+        if not os.path.isfile(path):
+            self.image.save(path)
+
+        expected = vis_utils.resize_image(vis_utils.load_image(path), target_width, target_height)
+        image, original_size = vis_utils.load_resized_image(path, target_width, target_height,
+                                                            return_original_size=True)
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(image.size, expected.size)
+        self.assertEqual(original_size, self.image.size)
+        difference = np.abs(np.asarray(image, dtype=np.float64) - np.asarray(expected, dtype=np.float64))
+        self.assertLess(difference.mean(), 2)
+        return image
+
+    def test_jpeg(self):
+        self.check_resized_image('image.jpg', 700)
+        self.check_resized_image('image.jpg', 250)
+        self.check_resized_image('image.jpg', -1, 400)
+        self.check_resized_image('image.jpg', 675, 450)
+
+        # Larger than the image, and the null operation
+        self.check_resized_image('image.jpg', 2500)
+        self.check_resized_image('image.jpg', -1, -1)
+
+    def test_other_formats(self):
+        self.check_resized_image('image.png', 700)
+
+        self.image = self.image.convert('L')
+        self.check_resized_image('image_gray.jpg', 700)
+
+
+if __name__ == '__main__':
+    unittest.main()
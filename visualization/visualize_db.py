@@ -264,9 +264,8 @@ def process_images(db_path,output_dir,image_base_dir,options=None):
             return
             
         try:
-            original_image = vis_utils.open_image(img_path)
-            original_size = original_image.size
-            image = vis_utils.resize_image(original_image, options.viz_size[0], options.viz_size[1])
+            image, original_size = vis_utils.load_resized_image(img_path, options.viz_size[0], options.viz_size[1],
+                                                                return_original_size=True)
         except Exception as e:
             print('Image {} failed to open. Error: {}'.format(img_path, e))
             return
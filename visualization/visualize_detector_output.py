@@ -161,7 +161,7 @@ def visualize_detector_output(args):
             _ = blob_service.get_blob_to_stream(container_name, image_id, image_obj)
     
         # resize is for displaying them more quickly
-        image = vis_utils.resize_image(vis_utils.open_image(image_obj), args.output_image_width)
+        image = vis_utils.load_resized_image(image_obj, args.output_image_width)
     
         vis_utils.render_detection_bounding_boxes(detections, image, label_map=detector_label_map,
                                                   confidence_threshold=args.confidence)
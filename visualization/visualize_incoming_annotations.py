@@ -121,7 +121,7 @@ for i in tqdm(range(len(df_img))):
     #     break
 
     try:
-        image = vis_utils.open_image(img_path).resize(viz_size)
+        image = vis_utils.load_resized_image(img_path, viz_size[0], viz_size[1])
     except Exception as e:
         print('Image {} failed to open. Error: {}'.format(img_path, e))
         continue
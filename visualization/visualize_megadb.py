@@ -24,7 +24,7 @@ def render_image_info(rendering, args):
     _ = blob_service.get_blob_to_stream(rendering['container_name'], rendering['blob_path'], image_obj)
 
     # resize is for displaying them more quickly
-    image = vis_utils.resize_image(vis_utils.open_image(image_obj), args.output_image_width)
+    image = vis_utils.load_resized_image(image_obj, args.output_image_width)
     vis_utils.render_megadb_bounding_boxes(rendering['bbox'], image)
 
     annotated_img_name = rendering['annotated_img_name']